@@ -0,0 +1,196 @@
+"""
+Programs for the benchmarks: micro-ROMs that loop over one opcode family each, and
+small game-like loops that mix them the way real ROMs do.  All of them run forever.
+"""
+
+
+def assemble(*words):
+    """
+    Turn a list of 16 bit instructions (and data words) into bytecode
+    """
+    return b"".join(word.to_bytes(2, "big") for word in words)
+
+
+def alu_rom():
+    """
+    8xyN register arithmetic and logic
+    """
+    return assemble(
+        0x6001, 0x6102, 0x6203, 0x6304,     # V0..V3 = 1..4
+        0x8014, 0x8125, 0x8231, 0x8332,     # add, sub, or, and
+        0x8013, 0x8106, 0x820E, 0x8337,     # xor, shift right, shift left, subn
+        0x8010, 0x8124, 0x8235, 0x8343,
+        0x8016, 0x812E, 0x8231, 0x8324,
+        0x1204)                             # loop
+
+
+def draw_rom():
+    """
+    Dxyn sprite drawing, across the whole screen and wrapping off its edges
+    """
+    return assemble(
+        0x6000, 0x6100,     # x, y = 0, 0
+        0x6205,             # V2 = 5, the font character height
+        0xF229,             # I = sprite of the digit 5
+        0xD015,             # draw it
+        0x7007,             # x += 7
+        0x7103,             # y += 3
+        0xD015,
+        0x7009,
+        0x7105,
+        0xD01F,             # a 15 row sprite, wrapping
+        0x1206)             # loop
+
+
+def memory_rom():
+    """
+    Fx55 / Fx65 register block stores and loads, with Fx33 and Fx1E
+    """
+    return assemble(
+        0xA300,             # I = 0x300
+        0x6A7B,             # VA = 123
+        0xFF55,             # store V0..VF
+        0xFF65,             # load V0..VF
+        0xFA33,             # BCD of VA
+        0xF265,             # load V0..V2
+        0x6410,
+        0xF41E,             # I += 16
+        0xF755,
+        0xF765,
+        0x1200)             # loop
+
+
+def jump_rom():
+    """
+    Jumps, calls, returns and conditional skips
+    """
+    return assemble(
+        0x6000,             # 200: V0 = 0
+        0x2210,             # 202: call 210
+        0x7001,             # 204: V0 += 1
+        0x3000,             # 206: skip if V0 == 0
+        0x1202,             # 208: jump 202
+        0x120C,             # 20A: (skipped)
+        0x1202,             # 20C: jump 202
+        0x0000,             # 20E: padding
+        0x2216,             # 210: call 216
+        0x4000,             # 212: skip if V0 != 0
+        0x00EE,             # 214: ret
+        0x00EE)             # 216: ret
+
+
+def maze_rom():
+    """
+    The classic random maze: fills the screen with random diagonals, then clears it
+    and starts again
+    """
+    return assemble(
+        0x00E0,             # 200: clear
+        0x6000,             # 202: x = 0
+        0x6100,             # 204: y = 0
+        0xA224,             # 206: I = "/"
+        0xC201,             # 208: V2 = random bit
+        0x3201,             # 20A: skip if V2 == 1
+        0xA220,             # 20C: I = "\"
+        0xD014,             # 20E: draw
+        0x7004,             # 210: x += 4
+        0x3040,             # 212: skip if x == 64
+        0x1206,             # 214: next column
+        0x6000,             # 216: x = 0
+        0x7104,             # 218: y += 4
+        0x3120,             # 21A: skip if y == 32
+        0x1206,             # 21C: next row
+        0x1200,             # 21E: start again
+        0x8040, 0x2010,     # 220: "\"
+        0x2040, 0x8010)     # 224: "/"
+
+
+def paddle_rom():
+    """
+    A pong-like frame loop: move a paddle on keys 1 and 4, bounce a ball, then wait
+    for the delay timer.  The CPU skips most of the wait rather than running it, so
+    fewer instructions are executed than cycles emulated (see benchmarks.run).
+    """
+    return assemble(
+        0x6000,             # 200: paddle y = 0
+        0x6110,             # 202: ball x = 16
+        0x6208,             # 204: ball y = 8
+        0x6301,             # 206: ball dx = 1
+        0x6401,             # 208: ball dy = 1
+        0xA246,             # 20A: I = paddle
+        0x6502,             # 20C: paddle x = 2
+        0xD504,             # 20E: erase paddle
+        0x6601,             # 210: V6 = key 1
+        0xE6A1,             # 212: skip if not pressed
+        0x7001,             # 214: paddle down
+        0x6604,             # 216: V6 = key 4
+        0xE6A1,             # 218: skip if not pressed
+        0x70FF,             # 21A: paddle up
+        0xD504,             # 21C: draw paddle
+        0xA24A,             # 21E: I = ball
+        0xD121,             # 220: erase ball
+        0x8134,             # 222: x += dx
+        0x8244,             # 224: y += dy
+        0x4100,             # 226: bounce off the edges
+        0x6301,             # 228
+        0x413F,             # 22A
+        0x63FF,             # 22C
+        0x4200,             # 22E
+        0x6401,             # 230
+        0x421F,             # 232
+        0x64FF,             # 234
+        0xD121,             # 236: draw ball
+        0xA246,             # 238: I = paddle
+        0x6C03,             # 23A: VC = 3
+        0xFC15,             # 23C: delay timer = 3
+        0xF707,             # 23E: V7 = delay timer
+        0x3700,             # 240: skip if V7 == 0
+        0x123E,             # 242: keep waiting
+        0x120E,             # 244: next frame
+        0x8080, 0x8080,     # 246: paddle
+        0x8000)             # 24A: ball
+
+
+def score_rom():
+    """
+    A score display loop: BCD conversion, digit sprites and subroutine calls, saving
+    and restoring the registers each time round
+    """
+    return assemble(
+        0x6E00,             # 200: score = 0
+        0x2210,             # 202: call draw score
+        0x2210,             # 204: call draw score (to erase it)
+        0x7E01,             # 206: score += 1
+        0xA310,             # 208: I = 0x310
+        0xFE55,             # 20A: save V0..VE
+        0xFE65,             # 20C: restore V0..VE
+        0x1202,             # 20E: loop
+        0xA300,             # 210: I = 0x300
+        0xFE33,             # 212: BCD of the score
+        0xF265,             # 214: V0..V2 = digits
+        0xF029,             # 216: I = sprite of digit 0
+        0x6A00,             # 218: x = 0
+        0x6B00,             # 21A: y = 0
+        0xDAB5,             # 21C: draw
+        0xF129,             # 21E: second digit
+        0x7A05,             # 220
+        0xDAB5,             # 222
+        0xF229,             # 224: third digit
+        0x7A05,             # 226
+        0xDAB5,             # 228
+        0x00EE)             # 22A: ret
+
+
+# benchmark name -> ROM
+MICRO_ROMS = {
+    "alu": alu_rom,
+    "draw": draw_rom,
+    "memory": memory_rom,
+    "jump": jump_rom,
+}
+
+GAME_ROMS = {
+    "maze": maze_rom,
+    "paddle": paddle_rom,
+    "score": score_rom,
+}
@@ -0,0 +1,212 @@
+"""
+Benchmark suite: headless instructions per second for each opcode family and for
+some game-like loops, and frames per second of PyGameScreen.draw.
+
+    python -m benchmarks.run --output results/HEAD.json
+    python -m benchmarks.run --compare results/HEAD.json
+
+Results are saved as JSON, so runs can be compared across commits; --compare prints
+the change against an earlier result and exits with status 1 if anything got slower
+by more than --threshold.
+
+The CPU skips the cycles it would spend spinning in idle loops (see CPU._skip_idle_loop),
+so ROMs that wait for the delay timer emulate many more cycles than they execute.  Their
+instr/s counts only the instructions executed, so that it measures the engine and stays
+comparable across commits; the emulated cycles per second are reported alongside.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from .roms import GAME_ROMS, MICRO_ROMS
+
+DEFAULT_CYCLES = 200000
+DEFAULT_FRAMES = 300
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1     # fractional slowdown reported as a regression
+
+
+def engines():
+    """
+    The execution engines to benchmark
+    :return: dict of name -> CPU class
+    """
+    from chip8.cpu import CPU
+    from chip8.jit import JitCPU
+    return {"cpu": CPU, "jit": JitCPU}
+
+
+def executed_instructions(rom, cpu_cls, cycles):
+    """
+    Run a ROM headless on a virtual clock as bench_rom does, counting the cycles that were
+    not skipped as idle loop spinning
+    :return: number of instructions executed
+    """
+    from chip8.chip8 import Chip8VM
+    skipped = [0]
+
+    def skip_idle_loop(cpu, n):
+        if cpu_cls._skip_idle_loop(cpu, n):
+            skipped[0] += n
+            return True
+        return False
+
+    counting_cls = type("Counting" + cpu_cls.__name__, (cpu_cls,), {"__slots__": (), "_skip_idle_loop": skip_idle_loop})
+    vm = Chip8VM.headless(cpu_cls=counting_cls, seed=0)
+    vm.load_program(rom)
+    vm.run_for(cycles=cycles)
+    return cycles - skipped[0]
+
+
+def bench_rom(rom, cpu_cls, cycles, repeat):
+    """
+    Run a ROM headless on a virtual clock, as fast as possible
+    :return: (best instructions executed per second, best cycles emulated per second) over repeat runs
+    """
+    from chip8.chip8 import Chip8VM
+    executed = executed_instructions(rom, cpu_cls, cycles)
+    best = None
+    for _ in range(repeat):
+        vm = Chip8VM.headless(cpu_cls=cpu_cls, seed=0)
+        vm.load_program(rom)
+        t = time.perf_counter()
+        vm.run_for(cycles=cycles)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return executed / best, cycles / best
+
+
+def bench_draw(frames, repeat):
+    """
+    Time PyGameScreen.draw on the dummy SDL video driver, with the whole screen
+    changing each frame and with a single sprite changing each frame
+    :return: dict of benchmark name -> best frames per second
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    from chip8.io import PyGameScreen, init_pygame
+
+    pygame = init_pygame()
+    try:
+        screen = PyGameScreen()
+        results = {}
+        for name, rows in (("draw_full", range(screen.HEIGHT)), ("draw_sprite", range(8, 13))):
+            best = None
+            for _ in range(repeat):
+                t = time.perf_counter()
+                for frame in range(frames):
+                    for y in rows:
+                        screen.xor_sprite_row((frame * 3 + y) % screen.WIDTH, y, 0xA5)
+                    screen.draw()
+                elapsed = time.perf_counter() - t
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = frames / best
+        return results
+    finally:
+        pygame.quit()
+
+
+def git_commit():
+    """
+    :return: the commit the benchmarked tree is at, or None if it is not a git checkout
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(cycles=DEFAULT_CYCLES, frames=DEFAULT_FRAMES, repeat=DEFAULT_REPEAT, only=None, draw=True):
+    """
+    Run the suite
+    :param cycles: instructions per ROM run
+    :param frames: frames per draw run
+    :param repeat: runs of each benchmark; the best is kept
+    :param only: if given, run just the benchmarks whose names contain this string
+    :param draw: include the PyGameScreen.draw benchmarks
+    :return: dict of results, ready to save as JSON
+    """
+    results = {}
+    roms = dict(MICRO_ROMS)
+    roms.update(GAME_ROMS)
+    for engine_name, cpu_cls in engines().items():
+        for rom_name, make_rom in roms.items():
+            name = "{}/{}".format(engine_name, rom_name)
+            if only is None or only in name:
+                executed, emulated = bench_rom(make_rom(), cpu_cls, cycles, repeat)
+                results[name] = {"value": executed, "unit": "instr/s", "emulated": emulated}
+                line = "{:20} {:12,.0f} instr/s".format(name, executed)
+                if emulated != executed:
+                    line += "  ({:,.0f} cycles/s emulated)".format(emulated)
+                print(line)
+    if draw and (only is None or "draw" in only):
+        for name, fps in bench_draw(frames, repeat).items():
+            results["screen/" + name] = {"value": fps, "unit": "frames/s"}
+            print("{:20} {:12,.0f} frames/s".format("screen/" + name, fps))
+
+    return {"commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {"cycles": cycles, "frames": frames, "repeat": repeat},
+            "results": results}
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Print each benchmark's change against a baseline run
+    :param baseline: results from an earlier run_benchmarks
+    :param current: results from run_benchmarks
+    :param threshold: fractional slowdown that counts as a regression
+    :return: list of the names of benchmarks that regressed
+    """
+    regressions = []
+    print("{:20} {:>14} {:>14} {:>8}".format("benchmark", "baseline", "current", "change"))
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["value"]
+        change = result["value"] / before - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:20} {:14,.0f} {:14,.0f} {:+7.1%}{}".format(name, before, result["value"], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chip8 emulator")
+    parser.add_argument("--output", help="file to save the results to, as JSON")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="fractional slowdown reported as a regression (default %(default)s)")
+    parser.add_argument("--cycles", type=int, default=DEFAULT_CYCLES, help="instructions per ROM run")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES, help="frames per draw run")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="runs of each benchmark; the best is kept")
+    parser.add_argument("--only", help="run just the benchmarks whose names contain this")
+    parser.add_argument("--no-draw", action="store_true", help="skip the PyGameScreen.draw benchmarks")
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(cycles=args.cycles, frames=args.frames, repeat=args.repeat,
+                             only=args.only, draw=not args.no_draw)
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,354 @@
+"""
+Static analysis of CHIP-8 programs: disassembly, a control-flow graph of basic blocks,
+code and data regions, subroutines and writes that may modify code.
+
+    analysis = analyze_rom(bytecode)
+    print(analysis.disassembly())
+    for start, block in sorted(analysis.blocks.items()):
+        print(hex(start), [hex(s) for s in block.successors])
+
+Code is found by following every path from the entry point, decoding with the same
+table the CPU executes from (see chip8.decoder).  Paths that cannot be followed
+statically (Bnnn jumps) are listed rather than guessed at.  Results are cached by the
+sha1 of the program, in memory and optionally in a directory of JSON files, so a whole
+ROM library can be analysed once ahead of time (see analyze_files).
+"""
+import collections
+import hashlib
+import json
+import os
+
+from .cpu import CPU
+from .decoder import get_decode_table
+
+MEMORY_CACHE_SIZE = 1024    # analyses kept in memory, most recently used first
+ANALYSIS_VERSION = 1        # bump when the analysis changes, so that cached results are redone
+
+MNEMONICS = {
+    "clear_screen": "CLS",
+    "ret": "RET",
+    "sys_call": "SYS {0:03X}",
+    "jump": "JP {0:03X}",
+    "call": "CALL {0:03X}",
+    "skip_if_equalv": "SE V{0:X}, {1:02X}",
+    "skip_if_not_equalv": "SNE V{0:X}, {1:02X}",
+    "skip_if_equalr": "SE V{0:X}, V{1:X}",
+    "loadv": "LD V{0:X}, {1:02X}",
+    "add": "ADD V{0:X}, {1:02X}",
+    "loadr": "LD V{0:X}, V{1:X}",
+    "orr": "OR V{0:X}, V{1:X}",
+    "andr": "AND V{0:X}, V{1:X}",
+    "xorr": "XOR V{0:X}, V{1:X}",
+    "addr": "ADD V{0:X}, V{1:X}",
+    "subr": "SUB V{0:X}, V{1:X}",
+    "shift_rightr": "SHR V{0:X}",
+    "subnr": "SUBN V{0:X}, V{1:X}",
+    "shift_leftr": "SHL V{0:X}",
+    "nop": "NOP",
+    "skip_if_not_equalr": "SNE V{0:X}, V{1:X}",
+    "load_memory_register": "LD I, {0:03X}",
+    "jump_add": "JP V0, {0:03X}",
+    "rnd_and": "RND V{0:X}, {1:02X}",
+    "draw_sprite": "DRW V{0:X}, V{1:X}, {2:X}",
+    "skip_if_key_pressed": "SKP V{0:X}",
+    "skip_if_key_not_pressed": "SKNP V{0:X}",
+    "read_delay_timer": "LD V{0:X}, DT",
+    "wait_and_load_key": "LD V{0:X}, K",
+    "set_delay_timer": "LD DT, V{0:X}",
+    "set_sound_timer": "LD ST, V{0:X}",
+    "add_to_I": "ADD I, V{0:X}",
+    "set_I_to_digit_sprite": "LD F, V{0:X}",
+    "set_mem_to_bcd": "LD B, V{0:X}",
+    "store_to_mem": "LD [I], V{0:X}",
+    "read_mem": "LD V{0:X}, [I]",
+    "illegal_instruction": "DW {0:04X}",
+}
+
+SKIPS = frozenset([
+    "skip_if_equalv", "skip_if_not_equalv", "skip_if_equalr", "skip_if_not_equalr",
+    "skip_if_key_pressed", "skip_if_key_not_pressed",
+])
+
+# Instructions after which execution does not simply continue with the next one
+CONTROL_FLOW = SKIPS | frozenset(["jump", "call", "ret", "jump_add", "illegal_instruction"])
+
+# Instructions that write to memory at I, and the number of bytes they write given their arguments
+MEMORY_WRITES = {
+    "set_mem_to_bcd": lambda register: 3,
+    "store_to_mem": lambda register_to: register_to + 1,
+}
+
+
+def disassemble(opcode):
+    """
+    :param opcode: the two instruction bytes as a big endian integer
+    :return: the instruction in assembly language, e.g. "LD V3, 1F"
+    """
+    name, args, _ = get_decode_table()[opcode]
+    return MNEMONICS[name].format(*args)
+
+
+class BasicBlock:
+    """
+    A straight-line run of instructions that is only entered at its start
+    """
+
+    def __init__(self, start, end, successors, call=None):
+        self.start = start              # address of the first instruction
+        self.end = end                  # address after the last instruction
+        self.successors = successors    # addresses of the blocks control can pass to next
+        self.call = call                # address of the subroutine the block ends by calling, if any
+
+    def to_dict(self):
+        return {"start": self.start, "end": self.end, "successors": self.successors, "call": self.call}
+
+
+class RomAnalysis:
+    """
+    The result of analysing a program
+    """
+
+    def __init__(self, rom_hash, size, entry=CPU.PROGRAM_START_ADDR):
+        self.rom_hash = rom_hash            # hex sha1 of the program
+        self.size = size                    # bytes in the program
+        self.entry = entry                  # address execution starts at
+        self.instructions = {}              # address -> opcode, for every instruction reachable from entry
+        self.blocks = {}                    # start address -> BasicBlock
+        self.subroutines = {}               # entry address -> start addresses of its blocks
+        self.regions = []                   # (start, end, "code" or "data") covering the program
+        self.data_references = []           # addresses loaded into I by Annn that are not code (sprites, tables)
+        self.indirect_jumps = []            # addresses of Bnnn jumps, whose targets are not known statically
+        self.outside_jumps = []             # (address, target) of jumps and calls to outside the program
+        self.self_modifying_writes = []     # (address, start, end) of memory writes known to hit code
+        self.unknown_writes = []            # addresses of memory writes whose target is not known statically
+
+    def is_code(self, address):
+        return address in self.instructions or address - 1 in self.instructions
+
+    def disassembly(self):
+        """
+        :return: a listing of the program, with code as instructions and data as bytes
+        """
+        lines = []
+        block_starts = set(self.blocks)
+        for start, end, kind in self.regions:
+            if kind == "code":
+                for addr in range(start, end):
+                    if addr in block_starts:
+                        label = " <- sub" if addr in self.subroutines else ""
+                        lines.append("{:03X}:{}".format(addr, label))
+                    if addr in self.instructions:
+                        opcode = self.instructions[addr]
+                        lines.append("    {:03X}  {:04X}  {}".format(addr, opcode, disassemble(opcode)))
+            else:
+                lines.append("    {:03X}  data, {} bytes".format(start, end - start))
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "version": ANALYSIS_VERSION,
+            "rom_hash": self.rom_hash,
+            "size": self.size,
+            "entry": self.entry,
+            "instructions": sorted(self.instructions.items()),
+            "blocks": [block.to_dict() for _, block in sorted(self.blocks.items())],
+            "subroutines": sorted(self.subroutines.items()),
+            "regions": self.regions,
+            "data_references": self.data_references,
+            "indirect_jumps": self.indirect_jumps,
+            "outside_jumps": self.outside_jumps,
+            "self_modifying_writes": self.self_modifying_writes,
+            "unknown_writes": self.unknown_writes,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        analysis = cls(d["rom_hash"], d["size"], d["entry"])
+        analysis.instructions = dict(d["instructions"])
+        analysis.blocks = {b["start"]: BasicBlock(b["start"], b["end"], b["successors"], b["call"])
+                           for b in d["blocks"]}
+        analysis.subroutines = dict(d["subroutines"])
+        analysis.regions = [tuple(region) for region in d["regions"]]
+        analysis.data_references = d["data_references"]
+        analysis.indirect_jumps = d["indirect_jumps"]
+        analysis.outside_jumps = [tuple(jump) for jump in d["outside_jumps"]]
+        analysis.self_modifying_writes = [tuple(write) for write in d["self_modifying_writes"]]
+        analysis.unknown_writes = d["unknown_writes"]
+        return analysis
+
+
+def analyze(bytecode, entry=CPU.PROGRAM_START_ADDR):
+    """
+    Analyse a program (uncached; see analyze_rom)
+    :param bytecode: the program, as loaded at CPU.PROGRAM_START_ADDR
+    :param entry: address execution starts at
+    :return: RomAnalysis
+    """
+    decode_table = get_decode_table()
+    start = CPU.PROGRAM_START_ADDR
+    end = min(start + len(bytecode), CPU.RAM_SIZE_BYTES - 2)
+    analysis = RomAnalysis(hashlib.sha1(bytecode).hexdigest(), len(bytecode), entry)
+    instructions = analysis.instructions
+
+    # follow every path from the entry point, finding the instructions and the block leaders
+    leaders = {entry}
+    pending = [entry]
+    while pending:
+        addr = pending.pop()
+        while start <= addr and addr + 2 <= end and addr not in instructions:
+            opcode = (bytecode[addr - start] << 8) | bytecode[addr - start + 1]
+            instructions[addr] = opcode
+            name, args, _ = decode_table[opcode]
+            if name in ("jump", "call"):
+                targets = [args[0]] if name == "jump" else [args[0], addr + 2]
+                if not start <= args[0] < end:
+                    analysis.outside_jumps.append((addr, args[0]))
+                if name == "call":
+                    analysis.subroutines[args[0]] = []
+            elif name in SKIPS:
+                targets = [addr + 2, addr + 4]
+            elif name == "jump_add":
+                analysis.indirect_jumps.append(addr)
+                targets = []
+            elif name in CONTROL_FLOW:
+                targets = []
+            else:
+                addr += 2
+                continue
+            leaders.update(targets)
+            pending.extend(targets)
+            break
+
+    # cut the instructions into basic blocks
+    # (even and odd addresses apart, in case the program jumps into the middle of an instruction)
+    for addr in sorted(instructions, key=lambda a: (a & 1, a)):
+        if addr in leaders or addr - 2 not in instructions or \
+                decode_table[instructions[addr - 2]][0] in CONTROL_FLOW:
+            block_start = addr
+        next_addr = addr + 2
+        name, args, _ = decode_table[instructions[addr]]
+        if name in CONTROL_FLOW or next_addr in leaders or next_addr not in instructions:
+            call = None
+            if name == "jump":
+                successors = [args[0]]
+            elif name == "call":
+                successors = [next_addr]
+                call = args[0]
+            elif name in SKIPS:
+                successors = [next_addr, next_addr + 2]
+            elif name in CONTROL_FLOW:
+                successors = []
+            else:
+                successors = [next_addr]
+            successors = [s for s in successors if s in instructions]
+            analysis.blocks[block_start] = BasicBlock(block_start, next_addr, successors, call)
+
+    # the blocks of each subroutine: those reachable from its entry without following calls
+    for sub in analysis.subroutines:
+        reached = set()
+        pending = [sub] if sub in analysis.blocks else []
+        while pending:
+            block = analysis.blocks[pending.pop()]
+            if block.start not in reached:
+                reached.add(block.start)
+                pending.extend(block.successors)
+        analysis.subroutines[sub] = sorted(reached)
+
+    # code and data regions
+    code = bytearray(end - start)
+    for addr in instructions:
+        code[addr - start] = code[addr - start + 1] = 1
+    pos = 0
+    while pos < len(code):
+        run_end = pos
+        while run_end < len(code) and code[run_end] == code[pos]:
+            run_end += 1
+        analysis.regions.append((start + pos, start + run_end, "code" if code[pos] else "data"))
+        pos = run_end
+    if end < start + len(bytecode):
+        analysis.regions.append((end, start + len(bytecode), "data"))
+
+    # memory references: I loaded with an address that is not code, and writes through I that
+    # may land on code; I is tracked from an Annn earlier in the same block
+    data_references = set()
+    for block in analysis.blocks.values():
+        I = None
+        for addr in range(block.start, block.end, 2):
+            name, args, _ = decode_table[instructions[addr]]
+            if name == "load_memory_register":
+                I = args[0]
+                if not analysis.is_code(I):
+                    data_references.add(I)
+            elif name in ("add_to_I", "set_I_to_digit_sprite"):
+                I = None
+            elif name in MEMORY_WRITES:
+                if I is None:
+                    analysis.unknown_writes.append(addr)
+                else:
+                    write_end = I + MEMORY_WRITES[name](*args)
+                    if any(analysis.is_code(a) for a in range(I, write_end)):
+                        analysis.self_modifying_writes.append((addr, I, write_end))
+    analysis.data_references = sorted(data_references)
+    analysis.indirect_jumps.sort()
+    analysis.outside_jumps.sort()
+    analysis.self_modifying_writes.sort()
+    analysis.unknown_writes.sort()
+    return analysis
+
+
+_memory_cache = collections.OrderedDict()    # rom hash -> RomAnalysis
+
+
+def analyze_rom(bytecode, cache_dir=None):
+    """
+    Analyse a program, reusing the result of any earlier analysis of the same program
+    :param bytecode: the program
+    :param cache_dir: if given, a directory where analyses are also kept as JSON files,
+                      named by the program's sha1
+    :return: RomAnalysis
+    """
+    rom_hash = hashlib.sha1(bytecode).hexdigest()
+    analysis = _memory_cache.get(rom_hash)
+    if analysis is not None:
+        _memory_cache.move_to_end(rom_hash)
+        return analysis
+
+    cache_file = os.path.join(cache_dir, rom_hash + ".json") if cache_dir is not None else None
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            d = json.load(f)
+        if d.get("version") == ANALYSIS_VERSION:
+            analysis = RomAnalysis.from_dict(d)
+    if analysis is None:
+        analysis = analyze(bytecode)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, "w") as f:
+                json.dump(analysis.to_dict(), f)
+
+    _memory_cache[rom_hash] = analysis
+    if len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    return analysis
+
+
+def _analyze_file(args):
+    filename, cache_dir = args
+    with open(filename, "rb") as f:
+        return filename, analyze_rom(f.read(), cache_dir)
+
+
+def analyze_files(filenames, cache_dir=None, workers=None, chunksize=16):
+    """
+    Analyse many ROM files across a pool of worker processes, e.g. to fill cache_dir
+    ahead of time
+    :param filenames: ROM files
+    :param cache_dir: directory to keep the analyses in (see analyze_rom)
+    :param workers: number of worker processes (default: one per core)
+    :param chunksize: number of files handed to a worker at a time
+    :return: generator of (filename, RomAnalysis), in completion order
+    """
+    import multiprocessing      # imported here to keep it out of the start up of processes that only run ROMs
+    with multiprocessing.Pool(processes=workers) as pool:
+        for result in pool.imap_unordered(_analyze_file, [(f, cache_dir) for f in filenames], chunksize=chunksize):
+            yield result
@@ -0,0 +1,387 @@
+"""
+Lockstep emulation of many CHIP-8 machines at once, using NumPy.
+
+Every machine's registers, stack, RAM and framebuffer are held in arrays with a
+leading instance axis.  Each step fetches one instruction for every machine, groups
+the machines by decoded instruction and runs one vectorised handler per group, so
+the interpreter overhead is paid once per step rather than once per machine.
+
+Requires numpy.
+"""
+import numpy as np
+
+from .cpu import C8_FONT, CPU
+from .decoder import get_decode_table
+
+# each opcode's handler, as a kind number indexing _KIND_NAMES, and whether PC is incremented after it
+_KIND_NAMES = sorted(set(entry[0] for entry in get_decode_table()))
+_KIND_NUMBERS = {name: kind for kind, name in enumerate(_KIND_NAMES)}
+_KIND = np.array([_KIND_NUMBERS[entry[0]] for entry in get_decode_table()], dtype=np.int64)
+_INCREMENT_PC = np.array([entry[2] for entry in get_decode_table()], dtype=bool)
+_SPRITE_SHIFT = np.uint64(64 - 8)
+
+
+class BatchCPU:
+    """
+    num_instances CHIP-8 CPUs run in lockstep, with the same semantics as CPU in
+    virtual time mode (timers decrement every clock_hz / 60 steps).
+
+    Instead of raising, a machine that hits an error (stack overflow/underflow, PC or
+    memory access out of range, bad key number) is marked in faulted, with the reason in
+    fault_reasons, and takes no further steps.  Random numbers for Cxkk come from a
+    NumPy generator seeded with seed, so they differ from those of CPU.
+    """
+
+    def __init__(self, num_instances, clock_hz=1000, seed=None):
+        n = num_instances
+        self.num_instances = n
+        self.V = np.zeros((n, CPU.NUM_MAIN_REGISTERS), dtype=np.uint8)
+        self.I = np.zeros(n, dtype=np.int64)
+        self.PC = np.full(n, CPU.PROGRAM_START_ADDR, dtype=np.int64)
+        self.SP = np.zeros(n, dtype=np.int64)
+        self.DT = np.zeros(n, dtype=np.int64)
+        self.ST = np.zeros(n, dtype=np.int64)
+        self.stack = np.zeros((n, CPU.STACK_DEPTH), dtype=np.int64)
+        self.ram = np.zeros((n, CPU.RAM_SIZE_BYTES), dtype=np.uint8)
+        self.rows = np.zeros((n, CPU.SCREEN_HEIGHT), dtype=np.uint64)   # packed as in FrameBuffer
+
+        # keyboard: current key state, presses not yet seen by Fx0A, and machines waiting in Fx0A
+        self.keys = np.zeros((n, 16), dtype=bool)
+        self._new_presses = np.zeros((n, 16), dtype=bool)
+        self._waiting_for_key = np.zeros(n, dtype=bool)
+
+        self.faulted = np.zeros(n, dtype=bool)
+        self.fault_reasons = {}     # instance index -> description
+
+        self.rng = np.random.default_rng(seed)
+        self.clock_hz = clock_hz
+        self.cycles = 0
+        self._timer_phase = 0
+
+        for i, c in enumerate(C8_FONT):
+            self.ram[:, i * 5: i * 5 + 5] = np.frombuffer(bytes(c), dtype=np.uint8)
+
+        self._handlers = [getattr(self, "_" + name) for name in _KIND_NAMES]
+
+    def load_program(self, bytecode, instances=None):
+        """
+        Load a program at the program start address
+        :param bytecode: the program
+        :param instances: indices of the machines to load it into (default: all)
+        :return:
+        """
+        sel = slice(None) if instances is None else instances
+        start = CPU.PROGRAM_START_ADDR
+        self.ram[sel, start:start + len(bytecode)] = np.frombuffer(bytes(bytecode), dtype=np.uint8)
+
+    def set_keys(self, keys):
+        """
+        Set the key state of every machine
+        :param keys: (num_instances, 16) array of booleans
+        :return:
+        """
+        keys = np.asarray(keys, dtype=bool)
+        self._new_presses |= keys & ~self.keys
+        self.keys[:] = keys
+
+    def run_cycles(self, cycles):
+        """
+        Run a number of steps on every (non-faulted) machine
+        :param cycles: number of steps
+        :return:
+        """
+        for _ in range(cycles):
+            self.step()
+
+    def step(self):
+        """
+        Run one instruction on every machine that has not faulted, then advance the timers
+        :return:
+        """
+        sel = np.flatnonzero(~self.faulted)
+        pc = self.PC[sel]
+        bad_pc = pc >= CPU.RAM_SIZE_BYTES - 2
+        if bad_pc.any():
+            self._fault(sel[bad_pc], "PC out of range")
+            sel = sel[~bad_pc]
+            pc = pc[~bad_pc]
+
+        if len(sel):
+            ops = (self.ram[sel, pc].astype(np.int64) << 8) | self.ram[sel, pc + 1]
+            kinds = _KIND[ops]
+            order = np.argsort(kinds, kind="stable")
+            sel = sel[order]
+            ops = ops[order]
+            kinds = kinds[order]
+            bounds = np.flatnonzero(np.diff(kinds)) + 1
+            for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(kinds)]))):
+                group = sel[start:end]
+                group_ops = ops[start:end]
+                self._handlers[kinds[start]](group, group_ops)
+                # machines that faulted during their instruction stay where they are
+                inc = group[_INCREMENT_PC[group_ops] & ~self.faulted[group]]
+                self.PC[inc] += 2
+
+        self._advance_clock(1)
+
+    def _advance_clock(self, cycles):
+        """
+        Count cycles and decrement the timers once every clock_hz / 60 cycles
+        """
+        self.cycles += cycles
+        phase = self._timer_phase + cycles * CPU.TIMER_DEC_FREQ_HZ
+        if phase >= self.clock_hz:
+            decs = phase // self.clock_hz
+            phase -= decs * self.clock_hz
+            live = ~self.faulted
+            self.DT[live] = np.maximum(0, self.DT[live] - decs)
+            self.ST[live] = np.maximum(0, self.ST[live] - decs)
+        self._timer_phase = phase
+
+    def _fault(self, instances, reason):
+        """
+        Stop the given machines, recording why
+        """
+        self.faulted[instances] = True
+        for i in instances:
+            self.fault_reasons.setdefault(int(i), reason)
+
+    def get_state(self, instance):
+        """
+        Get a copy of the register state of one machine, in the same form as CPU.get_state
+        """
+        return {"V": bytes(self.V[instance]),
+                "I": int(self.I[instance]),
+                "PC": int(self.PC[instance]),
+                "SP": int(self.SP[instance]),
+                "DT": int(self.DT[instance]),
+                "ST": int(self.ST[instance]),
+                "stack": [int(v) for v in self.stack[instance]],
+                "cycles": self.cycles}
+
+    def get_framebuffer(self, instance):
+        """
+        Get a copy of one machine's screen, in the same form as FrameBuffer.get_framebuffer
+        """
+        bits = np.unpackbits(self.rows[instance].astype(">u8").view(np.uint8))
+        return bits.tobytes()
+
+    # Instruction handlers.  Each takes the indices of the machines running the
+    # instruction and their opcodes.
+
+    @staticmethod
+    def _x(ops):
+        return (ops >> 8) & 0xF
+
+    @staticmethod
+    def _y(ops):
+        return (ops >> 4) & 0xF
+
+    def _sys_call(self, sel, ops):
+        pass
+
+    def _nop(self, sel, ops):
+        pass
+
+    def _illegal_instruction(self, sel, ops):
+        pass
+
+    def _clear_screen(self, sel, ops):
+        self.rows[sel] = 0
+
+    def _ret(self, sel, ops):
+        empty = self.SP[sel] == 0
+        self._fault(sel[empty], "Stack Empty (attempted pop)")
+        sel = sel[~empty]
+        self.SP[sel] -= 1
+        self.PC[sel] = self.stack[sel, self.SP[sel]]
+
+    def _jump(self, sel, ops):
+        self.PC[sel] = ops & 0xFFF
+
+    def _call(self, sel, ops):
+        self.stack[sel, self.SP[sel]] = self.PC[sel]
+        self.SP[sel] += 1
+        overflow = self.SP[sel] >= CPU.STACK_DEPTH
+        self._fault(sel[overflow], "Stack Overflow")
+        self.PC[sel[~overflow]] = ops[~overflow] & 0xFFF
+
+    def _skip_if_equalv(self, sel, ops):
+        self.PC[sel[self.V[sel, self._x(ops)] == (ops & 0xFF)]] += 2
+
+    def _skip_if_not_equalv(self, sel, ops):
+        self.PC[sel[self.V[sel, self._x(ops)] != (ops & 0xFF)]] += 2
+
+    def _skip_if_equalr(self, sel, ops):
+        self.PC[sel[self.V[sel, self._x(ops)] == self.V[sel, self._y(ops)]]] += 2
+
+    def _skip_if_not_equalr(self, sel, ops):
+        self.PC[sel[self.V[sel, self._x(ops)] != self.V[sel, self._y(ops)]]] += 2
+
+    def _loadv(self, sel, ops):
+        self.V[sel, self._x(ops)] = ops & 0xFF
+
+    def _add(self, sel, ops):
+        x = self._x(ops)
+        self.V[sel, x] = (self.V[sel, x] + (ops & 0xFF)) & 0xFF
+
+    def _loadr(self, sel, ops):
+        self.V[sel, self._x(ops)] = self.V[sel, self._y(ops)]
+
+    def _orr(self, sel, ops):
+        x = self._x(ops)
+        self.V[sel, x] = self.V[sel, x] | self.V[sel, self._y(ops)]
+
+    def _andr(self, sel, ops):
+        x = self._x(ops)
+        self.V[sel, x] = self.V[sel, x] & self.V[sel, self._y(ops)]
+
+    def _xorr(self, sel, ops):
+        x = self._x(ops)
+        self.V[sel, x] = self.V[sel, x] ^ self.V[sel, self._y(ops)]
+
+    # In the arithmetic instructions VF is written before Vx is calculated, exactly as
+    # in CPU, so that the results match when x or y is 0xF
+
+    def _addr(self, sel, ops):
+        x, y = self._x(ops), self._y(ops)
+        self.V[sel, 0xF] = self.V[sel, x].astype(np.int64) + self.V[sel, y] > 255
+        self.V[sel, x] = (self.V[sel, x].astype(np.int64) + self.V[sel, y]) & 0xFF
+
+    def _subr(self, sel, ops):
+        x, y = self._x(ops), self._y(ops)
+        self.V[sel, 0xF] = self.V[sel, x] > self.V[sel, y]
+        self.V[sel, x] = (self.V[sel, x].astype(np.int64) - self.V[sel, y]) & 0xFF
+
+    def _shift_rightr(self, sel, ops):
+        x = self._x(ops)
+        self.V[sel, 0xF] = self.V[sel, x] & 0x01
+        self.V[sel, x] = self.V[sel, x] >> 1
+
+    def _subnr(self, sel, ops):
+        x, y = self._x(ops), self._y(ops)
+        self.V[sel, 0xF] = self.V[sel, y] > self.V[sel, x]
+        self.V[sel, x] = (self.V[sel, y].astype(np.int64) - self.V[sel, x]) & 0xFF
+
+    def _shift_leftr(self, sel, ops):
+        x = self._x(ops)
+        self.V[sel, 0xF] = self.V[sel, x] >= 128
+        self.V[sel, x] = (self.V[sel, x].astype(np.int64) << 1) & 0xFF
+
+    def _load_memory_register(self, sel, ops):
+        self.I[sel] = ops & 0xFFF
+
+    def _jump_add(self, sel, ops):
+        self.PC[sel] = (ops & 0xFFF) + self.V[sel, 0]
+
+    def _rnd_and(self, sel, ops):
+        self.V[sel, self._x(ops)] = self.rng.integers(0, 256, size=len(sel)) & ops & 0xFF
+
+    def _draw_sprite(self, sel, ops):
+        x_st = self.V[sel, self._x(ops)].astype(np.int64) % CPU.SCREEN_WIDTH
+        y_st = self.V[sel, self._y(ops)].astype(np.int64)
+        size = ops & 0xF
+        I = self.I[sel]
+
+        out_of_range = I + size > CPU.RAM_SIZE_BYTES
+        self._fault(sel[out_of_range], "Memory out of range")
+        ok = ~out_of_range
+        sel, x_st, y_st, size, I = sel[ok], x_st[ok], y_st[ok], size[ok], I[ok]
+
+        # rotate each sprite row into place, as FrameBuffer.xor_sprite_row does
+        shift = x_st.astype(np.uint64)
+        wrap_shift = ((CPU.SCREEN_WIDTH - x_st) % CPU.SCREEN_WIDTH).astype(np.uint64)
+        collision = np.zeros(len(sel), dtype=bool)
+        for j in range(int(size.max()) if len(size) else 0):
+            live = j < size
+            rows_sel = sel[live]
+            bits = self.ram[rows_sel, I[live] + j].astype(np.uint64) << _SPRITE_SHIFT
+            wrapped = np.where(x_st[live] == 0, np.uint64(0), bits << wrap_shift[live])
+            bits = (bits >> shift[live]) | wrapped
+            y = (y_st[live] + j) % CPU.SCREEN_HEIGHT
+            row = self.rows[rows_sel, y]
+            collision[live] |= (row & bits) != 0
+            self.rows[rows_sel, y] = row ^ bits
+        self.V[sel, 0xF] = collision
+
+    def _key_numbers(self, sel, ops):
+        """
+        The key numbers in Vx, faulting machines whose Vx is not a key
+        :return: (machines with a valid key number, their key numbers)
+        """
+        k = self.V[sel, self._x(ops)].astype(np.int64)
+        bad = k >= 16
+        self._fault(sel[bad], "Key number out of range")
+        return sel[~bad], k[~bad]
+
+    def _skip_if_key_pressed(self, sel, ops):
+        sel, k = self._key_numbers(sel, ops)
+        self.PC[sel[self.keys[sel, k]]] += 2
+
+    def _skip_if_key_not_pressed(self, sel, ops):
+        sel, k = self._key_numbers(sel, ops)
+        self.PC[sel[~self.keys[sel, k]]] += 2
+
+    def _read_delay_timer(self, sel, ops):
+        self.V[sel, self._x(ops)] = self.DT[sel]
+
+    def _wait_and_load_key(self, sel, ops):
+        # only presses made after the wait started count
+        starting = sel[~self._waiting_for_key[sel]]
+        self._new_presses[starting] = False
+        self._waiting_for_key[sel] = True
+
+        pressed = self._new_presses[sel].any(axis=1)
+        done = sel[pressed]
+        key = np.argmax(self._new_presses[done], axis=1)
+        self.V[done, self._x(ops[pressed])] = key
+        self._new_presses[done] = False
+        self._waiting_for_key[done] = False
+
+        # machines still waiting run this instruction again next step
+        self.PC[sel[~pressed]] -= 2
+
+    def _set_delay_timer(self, sel, ops):
+        self.DT[sel] = self.V[sel, self._x(ops)]
+
+    def _set_sound_timer(self, sel, ops):
+        self.ST[sel] = self.V[sel, self._x(ops)]
+
+    def _add_to_I(self, sel, ops):
+        self.I[sel] += self.V[sel, self._x(ops)]
+
+    def _set_I_to_digit_sprite(self, sel, ops):
+        self.I[sel] = CPU.FONT_CHAR_HEIGHT * self.V[sel, self._x(ops)].astype(np.int64)
+
+    def _memory_range_ok(self, sel, length):
+        """
+        Fault machines for which I .. I + length - 1 is not in RAM
+        :return: (machines for which it is, the mask of those within sel)
+        """
+        ok = self.I[sel] + length <= CPU.RAM_SIZE_BYTES
+        self._fault(sel[~ok], "Memory out of range")
+        return sel[ok], ok
+
+    def _set_mem_to_bcd(self, sel, ops):
+        sel, ok = self._memory_range_ok(sel, 3)
+        v = self.V[sel, self._x(ops[ok])]
+        I = self.I[sel]
+        self.ram[sel, I] = v // 100
+        self.ram[sel, I + 1] = (v % 100) // 10
+        self.ram[sel, I + 2] = v % 10
+
+    def _store_to_mem(self, sel, ops):
+        x = self._x(ops)
+        sel, ok = self._memory_range_ok(sel, x + 1)
+        x = x[ok]
+        for i in range(int(x.max()) + 1 if len(x) else 0):
+            m = sel[x >= i]
+            self.ram[m, self.I[m] + i] = self.V[m, i]
+
+    def _read_mem(self, sel, ops):
+        x = self._x(ops)
+        sel, ok = self._memory_range_ok(sel, x + 1)
+        x = x[ok]
+        for i in range(int(x.max()) + 1 if len(x) else 0):
+            m = sel[x >= i]
+            self.V[m, i] = self.ram[m, self.I[m] + i]
@@ -1,79 +1,700 @@
-import pygame
+import hashlib
+import math
+import random
+import struct
 import time
-import traceback
 
+from .analysis import analyze_rom
 from .cpu import CPU
-from .io import PyGameKeyboard, PyGameScreen
+from .headless import NullScreen, ScriptedKeyboard
+from .inputlog import InputLogReader, InputLogWriter, LOG_END, RecordingKeyboard, ReplayKeyboard
+from .io import PyGameKeyboard, PyGameScreen, init_pygame
+from .profiler import Profiler
+from .rewind import RewindBuffer
+from .trace import TraceWriter
 
 DEFAULT_CPU_FREQUENCY_HZ = 1000
 DEFAULT_IO_FREQUENCY_HZ = 60
+STATE_FILE_MAGIC = b"C8ST"
+STATE_FILE_VERSION = 2
+STATE_FILE_HEADER = struct.Struct("<4sHI")     # magic, version, snapshot size
+SUBSCRIBER_QUEUE_FRAMES = 8     # frames a run_async subscriber may fall behind before older ones are dropped
+MAX_FRAME_LAG = 5   # frames the real-time scheduler may fall behind before it stops trying to catch up
+REWIND_KEY = "K_BACKSPACE"     # pygame key to hold to run backwards through the rewind history
+TURBO_KEY = "K_TAB"             # pygame key to hold to fast-forward at DEFAULT_TURBO times normal speed
+DEFAULT_TURBO = 8
+MAX_FRAME_SKIP = 30     # in turbo mode the screen is still drawn at least once every this many frame slices
+COST_SMOOTHING = 0.1    # weight of the newest measurement in the running averages of per-frame costs
+
+
+class RunResult:
+    """
+    Outcome of Chip8VM.run_for
+    """
+
+    def __init__(self, cycles, frames, framebuffer, state):
+        self.cycles = cycles            # number of instructions run
+        self.frames = frames            # number of I/O frames run
+        self.framebuffer = framebuffer  # final screen contents (see FrameBuffer.get_framebuffer)
+        self.state = state              # final CPU registers (see CPU.get_state)
 
 
 class Chip8VM:
 
-    def __init__(self, cpu_freq_hz=DEFAULT_CPU_FREQUENCY_HZ, io_freq_hz=DEFAULT_IO_FREQUENCY_HZ):
+    def __init__(self, cpu_freq_hz=DEFAULT_CPU_FREQUENCY_HZ, io_freq_hz=DEFAULT_IO_FREQUENCY_HZ, cpu_cls=CPU,
+                 screen_factory=PyGameScreen, keyboard_factory=PyGameKeyboard, virtual_clock=False,
+                 seed=None):
+        """
+        :param cpu_freq_hz: instructions per second
+        :param io_freq_hz: screen refreshes / keyboard reads per second
+        :param cpu_cls: execution engine, e.g. CPU (interpreter) or chip8.jit.JitCPU (block translation cache)
+        :param screen_factory: callable that makes the screen backend, e.g. PyGameScreen or headless.NullScreen
+        :param keyboard_factory: callable that makes the keyboard backend, e.g. PyGameKeyboard or a
+                                 function returning a headless.ScriptedKeyboard
+        :param virtual_clock: run the delay/sound timers from the instruction count (one decrement
+                              every cpu_freq_hz / 60 instructions) instead of the wall clock, so runs
+                              are reproducible at any emulation speed
+        :param seed: seed for the CPU's RND instruction (default: unpredictable)
+        """
         self.screen = None
         self.keyboard = None
         self.cpu = None
         self.running=False
         self.cpu_freq_hz = cpu_freq_hz
         self.io_freq_hz = io_freq_hz
-        pygame.init()
+        self.cpu_cls = cpu_cls
+        self.screen_factory = screen_factory
+        self.keyboard_factory = keyboard_factory
+        self.virtual_clock = virtual_clock
+        self.seed = seed
+        self.rewind = None
+        self.recorder = None    # InputLogWriter while recording input
+        self.profiler = None    # Profiler while profiling
+        self.tracer = None      # TraceWriter while tracing
+        self.program = None     # the loaded program
+        self.rom_hash = None    # sha1 digest of the loaded program
+        self.subscribers = []   # asyncio queues that run_async publishes frames to
+        self.frames_run = 0     # frames completed by run_for, over all its calls (kept if a run fails part way)
+        self.turbo = 1          # CPU speed, as a multiple of cpu_freq_hz (see set_turbo)
+        self.frame_skip = 1     # in turbo mode, frame slices per screen draw
+        self._frames_since_draw = 0
+        self._cpu_cost = 0.     # running average of the seconds per frame slice spent running the CPU
+        self._draw_cost = 0.    # running average of the seconds per screen draw
+        self._uses_pygame = False     # is either backend a pygame one?  Set by restart
+        self._pygame = None
         self.restart()
 
+    @classmethod
+    def headless(cls, script=(), **kwargs):
+        """
+        Make a VM that needs no display: the screen is a NullScreen, the keyboard
+        plays back script (see ScriptedKeyboard) and the timers run in virtual time
+        """
+        kwargs.setdefault("virtual_clock", True)
+        kwargs.setdefault("screen_factory", NullScreen)
+        kwargs.setdefault("keyboard_factory", lambda: ScriptedKeyboard(script))
+        return cls(**kwargs)
+
     def restart(self):
-        self.screen = PyGameScreen()
-        self.keyboard = PyGameKeyboard()
-        self.cpu = CPU(keyboard=self.keyboard, screen=self.screen)
+        old_cpu = self.cpu
+        self.screen = self.screen_factory()
+        self.keyboard = self.keyboard_factory()
+        # decided from the backends themselves, as the factories may be functions that make them
+        self._uses_pygame = isinstance(self.screen, PyGameScreen) or isinstance(self.keyboard, PyGameKeyboard)
+        self._pygame = init_pygame() if self._uses_pygame else None
+        self.cpu = self.cpu_cls(keyboard=self.keyboard,
+                                screen=self.screen,
+                                clock_hz=int(self.cpu_freq_hz) if self.virtual_clock else None,
+                                seed=self.seed)
+        if self.profiler is not None and self.profiler.is_attached(old_cpu):
+            self.profiler.detach(old_cpu)
+            self.profiler.attach(self.cpu)
+        if self.tracer is not None and self.tracer.is_attached(old_cpu):
+            self.tracer.detach(old_cpu)
+            self.tracer.attach(self.cpu)
 
     def shutdown(self):
-        pygame.quit()
+        if self._uses_pygame:
+            self._pygame.quit()
+
+    def run_for(self, cycles=None, frames=None):
+        """
+        Run the VM as fast as possible (no waiting for the wall clock) for a number of
+        CPU cycles and/or I/O frames, whichever runs out first.  Each frame handles the
+        pygame events (if a backend uses pygame), reads the keyboard, runs
+        cpu_freq_hz / io_freq_hz instructions and draws the screen.
+        :param cycles: maximum number of instructions to run
+        :param frames: maximum number of frames to run
+        :return: RunResult
+        """
+        if cycles is None and frames is None:
+            raise ValueError("run_for needs a number of cycles and/or frames")
+
+        cycles_run = 0
+        frames_run = 0
+        while (cycles is None or cycles_run < cycles) and (frames is None or frames_run < frames):
+            frame_cycles = self._frame_cycles(frames_run)
+            if cycles is not None:
+                frame_cycles = min(frame_cycles, cycles - cycles_run)
+
+            if self._uses_pygame:
+                self._pump_events()
+            self.keyboard.key_reader()
+            self.cpu.run_cycles(frame_cycles)
+            self.screen.draw()
+
+            cycles_run += frame_cycles
+            frames_run += 1
+            self.frames_run += 1
+
+        return RunResult(cycles=cycles_run,
+                         frames=frames_run,
+                         framebuffer=self.screen.get_framebuffer(),
+                         state=self.cpu.get_state())
+
+    def _frame_cycles(self, frame):
+        """
+        Number of CPU cycles to run in the given I/O frame.  Fractional cycles per
+        frame are spread evenly, so that the long-run rate is exactly cpu_freq_hz.
+        :param frame: frame number, counting from 0
+        :return:
+        """
+        cycles_per_frame = self.cpu_freq_hz / self.io_freq_hz
+        return int((frame + 1) * cycles_per_frame) - int(frame * cycles_per_frame)
 
     def run(self):
-        t_last_io = time.time()
-        t_last_cpu = 0
-        cpu_cycles = 0
+        """
+        Run the VM in real time until the window is closed.  Each 1 / io_freq_hz frame
+        slice runs that frame's batch of instructions, then reads the keyboard and draws
+        the screen, then sleeps until the slice's deadline.  Deadlines are absolute, so
+        oversleeping in one frame is made up in the next rather than accumulating; if the
+        host falls more than MAX_FRAME_LAG frames behind, the schedule is reset instead
+        of trying to catch up.
+
+        In turbo mode (see set_turbo, or hold TURBO_KEY) each slice runs the instructions of
+        several frames, and the screen is drawn only in as many slices as the host has time
+        for (see _draw_turbo).
+
+        With an event-driven keyboard (see PyGameKeyboard) the instructions are spread over
+        the slice instead, so that key changes take effect part way through a frame (see
+        _run_paced).
+        """
+        frame_time = 1. / self.io_freq_hz
+        frame = 0
+        stats_cycles = 0
+        stats_frames = 0
+        t_stats = time.perf_counter()
+        deadline = t_stats + frame_time
 
         self.running = True
         try:
             while self.running:
-                tnow = time.time()
+                turbo = 1
+                if self._rewind_held():
+                    # step back through the history instead of running
+                    self.rewind_step()
+                    frame_cycles = 0
+                    cpu_seconds = 0.
+                else:
+                    turbo = self._turbo_multiple()
+                    frame_cycles = sum(self._frame_cycles(f) for f in range(frame, frame + turbo))
+                    if self._uses_pygame and self.keyboard.events is not None:
+                        cpu_seconds = self._run_paced(frame_cycles, deadline - frame_time, deadline)
+                    else:
+                        t_cpu = time.perf_counter()
+                        self.cpu.run_cycles(frame_cycles)
+                        cpu_seconds = time.perf_counter() - t_cpu
+                    if self.rewind is not None:
+                        self.rewind.frame(self)
 
-                time.sleep(max(0, 1. / self.cpu_freq_hz - (tnow - t_last_cpu) - 0.001))
+                # time for IO
+                self.keyboard.key_reader()
+                if turbo == 1:
+                    self.screen.draw()
+                    self.frame_skip = 1
+                else:
+                    self._draw_turbo(cpu_seconds, frame_time)
 
-                if tnow - t_last_cpu > 1. / self.cpu_freq_hz:
-                    self.cpu.tick()
-                    cpu_cycles += 1
-                    t_last_cpu = tnow
+                if self._uses_pygame:
+                    self._pump_events()
 
-                if tnow - t_last_io > 1. / self.io_freq_hz:
-                    # time for IO
-                    fps = 1. / (time.time() - t_last_io)
-                    print("cpu {:.2f}kHz  {:2.0f}fps  kb={} ".format(cpu_cycles * fps / 1000, fps, self.keyboard.key_pressed), end="\r")
+                frame += turbo
+                stats_cycles += frame_cycles
+                stats_frames += 1
 
-                    cpu_cycles = 0
+                tnow = time.perf_counter()
+                if tnow - t_stats >= 1.:
+                    fps = stats_frames / (tnow - t_stats)
+                    print("cpu {:.2f}kHz  {:2.0f}fps  kb={} ".format(stats_cycles / (tnow - t_stats) / 1000, fps, self.keyboard.key_pressed), end="\r")
+                    stats_cycles = 0
+                    stats_frames = 0
+                    t_stats = tnow
 
-                    self.keyboard.key_reader()
-                    self.screen.draw()
-
-                    t_last_io = time.time()
-                    # Did the user click the window close button?
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            self.running = False
-                            pygame.quit()
+                # sleep until the end of this frame's slice
+                if deadline > tnow:
+                    self._sleep_until(deadline)
+                elif tnow - deadline > MAX_FRAME_LAG * frame_time:
+                    # too far behind to catch up; start the schedule again from now
+                    deadline = tnow
+                deadline += frame_time
 
         except Exception as e:
             self.cpu.print_state()
             print(e)
+            import traceback    # only needed here, and slow to import
             traceback.print_exc()
         finally:
-            pygame.quit()
+            self._end_run()
+
+    def set_turbo(self, multiple):
+        """
+        Run at a multiple of the normal speed, e.g. to fast-forward through intros and
+        attract loops.  The timers run from the instruction count, so they stay in step
+        with the CPU and the program behaves exactly as it would at normal speed; only the
+        screen is drawn less often if the host cannot keep up.  Needs a virtual clock.
+        :param multiple: whole number of frames to run per frame slice; 1 for normal speed
+        :return:
+        """
+        if multiple < 1 or multiple != int(multiple):
+            raise ValueError("Turbo multiple must be a whole number of at least 1; got {}".format(multiple))
+        if multiple != 1 and not self.virtual_clock:
+            raise ValueError("Turbo mode needs a VM with a virtual clock")
+        self.turbo = int(multiple)
+
+    def _turbo_multiple(self):
+        """
+        The speed to run the next frame slice at: the turbo setting, or DEFAULT_TURBO
+        while the user holds the turbo key
+        """
+        if (self.turbo == 1 and self.virtual_clock and self._uses_pygame
+                and self._pygame.key.get_pressed()[getattr(self._pygame, TURBO_KEY)]):
+            return DEFAULT_TURBO
+        return self.turbo
+
+    def _draw_turbo(self, cpu_seconds, frame_time):
+        """
+        Draw the screen in turbo mode, once every frame_skip frame slices.  The skip
+        adapts so that drawing fits in the time the CPU leaves free in each slice: with
+        the running averages of the CPU's cost per slice and of the cost of a draw, it
+        is the number of slices whose spare time adds up to one draw.
+        :param cpu_seconds: time spent running the CPU in this slice
+        :param frame_time: length of a slice
+        :return:
+        """
+        self._cpu_cost += COST_SMOOTHING * (cpu_seconds - self._cpu_cost)
+        self._frames_since_draw += 1
+        if self._frames_since_draw < self.frame_skip:
+            return
+        t = time.perf_counter()
+        self.screen.draw()
+        self._draw_cost += COST_SMOOTHING * (time.perf_counter() - t - self._draw_cost)
+        self._frames_since_draw = 0
+        spare = frame_time - self._cpu_cost
+        if spare <= 0:
+            self.frame_skip = MAX_FRAME_SKIP
+        else:
+            self.frame_skip = max(1, min(MAX_FRAME_SKIP, math.ceil(self._draw_cost / spare)))
+
+    def _end_run(self):
+        """
+        Finish off a run: close any input log and trace, and shut down the backends
+        """
+        if self.recorder is not None:
+            self.stop_recording()
+        if self.tracer is not None:
+            self.stop_trace()
+        self.shutdown()
+
+    async def run_async(self, input_queue=None, frames=None):
+        """
+        Coroutine that runs the VM in real time on the running asyncio event loop, so that
+        one process can host many VMs.  Each frame slice drains input_queue into the
+        keyboard, runs that frame's batch of instructions, publishes the frame to the
+        subscribers if the screen changed, and then awaits the slice's deadline.  Deadlines
+        are scheduled as in run().
+        :param input_queue: asyncio.Queue of (key, pressed) changes to apply to the keyboard
+        :param frames: number of frames to run (default: until self.running is cleared)
+        :return: number of frames run
+        """
+        import asyncio      # imported here, as it is slow to import and only needed here
+        loop = asyncio.get_running_loop()
+        frame_time = 1. / self.io_freq_hz
+        frame = 0
+        deadline = loop.time() + frame_time
+
+        self.running = True
+        try:
+            while self.running and (frames is None or frame < frames):
+                while input_queue is not None and not input_queue.empty():
+                    key, pressed = input_queue.get_nowait()
+                    self.keyboard.set_key(key, pressed)
+                self.keyboard.key_reader()
+                self.cpu.run_cycles(self._frame_cycles(frame))
+                if self.screen.dirty_rows:
+                    self._publish_frame(frame)
+                self.screen.draw()
+
+                if self._uses_pygame:
+                    self._pump_events()
+
+                frame += 1
+                tnow = loop.time()
+                if deadline > tnow:
+                    await asyncio.sleep(deadline - tnow)
+                else:
+                    if tnow - deadline > MAX_FRAME_LAG * frame_time:
+                        deadline = tnow
+                    # behind schedule: still let the loop's other tasks have a turn
+                    await asyncio.sleep(0)
+                deadline += frame_time
+        finally:
+            self._end_run()
+        return frame
+
+    def subscribe(self, max_frames=SUBSCRIBER_QUEUE_FRAMES):
+        """
+        Subscribe to the frames published by run_async.  The queue receives
+        (frame number, packed screen) items (see FrameBuffer.get_packed): first the current
+        screen, with frame number None, then each frame in which the screen changed.  A subscriber that
+        falls max_frames behind loses its oldest frames rather than holding up the VM.
+        :param max_frames: length of the queue
+        :return: asyncio.Queue
+        """
+        import asyncio
+        queue = asyncio.Queue(maxsize=max_frames)
+        queue.put_nowait((None, self.screen.get_packed()))
+        self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.remove(queue)
+
+    def _publish_frame(self, frame):
+        """
+        Send the current screen to every subscriber
+        """
+        if not self.subscribers:
+            return
+        item = (frame, self.screen.get_packed())
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    def _run_paced(self, cycles, start, end):
+        """
+        Run a frame slice's instructions spread over the slice, applying the keyboard's
+        queued key changes at the instructions due at the times they were read.  Between
+        key events the thread sleeps in pygame's event wait, and the instructions due by
+        then are run when it wakes, so a change, such as the key press that ends an Fx0A
+        wait, takes effect within the frame it happened in rather than at the next one.
+        Which instruction sees a change depends on host timing, but RecordingKeyboard logs
+        the cycle it was applied at, so replays are still exact.
+        :param cycles: number of instructions in the slice
+        :param start: perf_counter time of the start of the slice
+        :param end: perf_counter time of its deadline
+        :return: seconds spent running the CPU
+        """
+        events = self.keyboard.events
+        span = end - start
+        done = 0
+        cpu_seconds = 0.
+        while True:
+            now = time.perf_counter()
+            while events:
+                timestamp, key, pressed = events.popleft()
+                due = min(cycles, max(done, int(cycles * (timestamp - start) / span)))
+                self.cpu.run_cycles(due - done)
+                done = due
+                self.keyboard.set_key(key, pressed)
+            due = cycles if now >= end else int(cycles * (now - start) / span)
+            if due > done:
+                self.cpu.run_cycles(due - done)
+                done = due
+            cpu_seconds += time.perf_counter() - now
+            if done >= cycles:
+                return cpu_seconds
+            event = self._pygame.event.wait(timeout=max(1, int((end - time.perf_counter()) * 1000)))
+            self._handle_event(event, time.perf_counter())
+            self._pump_events()
+
+    def _pump_events(self):
+        """
+        Handle the pygame events waiting, stamped with the time they were read
+        :return:
+        """
+        timestamp = time.perf_counter()
+        for event in self._pygame.event.get():
+            self._handle_event(event, timestamp)
+
+    def _handle_event(self, event, timestamp):
+        """
+        Closing the window ends the run; other events go to the keyboard.  A timed out
+        event wait returns a NOEVENT, which is dropped.
+        """
+        if event.type == self._pygame.QUIT:
+            self.running = False
+        elif event.type != self._pygame.NOEVENT:
+            self.keyboard.handle_event(event, timestamp)
+
+    def _sleep_until(self, deadline):
+        """
+        Sleep until the perf_counter time deadline.  While the CPU is waiting for a key
+        (Fx0A), wake for each input event instead, and read the keyboard at once so that
+        even a tap shorter than a frame ends the wait.
+        :param deadline:
+        :return:
+        """
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            if not (self.cpu.waiting_for_key and self._uses_pygame):
+                time.sleep(remaining)
+                return
+            event = self._pygame.event.wait(timeout=max(1, int(remaining * 1000)))
+            self._handle_event(event, time.perf_counter())
+            if not self.running:
+                return
+            if event.type == self._pygame.KEYDOWN:
+                self.keyboard.key_reader()
 
     def load_rom(self, filename):
         with open(filename, "rb") as f:
             bytecode = f.read()
-            self.cpu.load_program(bytecode)
+            self.load_program(bytecode)
 
     def load_program(self, bytecode):
         self.cpu.load_program(bytecode)
+        self.program = bytes(bytecode)
+        self.rom_hash = hashlib.sha1(bytecode).digest()
+
+    def analyze(self, cache_dir=None):
+        """
+        Static analysis of the loaded program (see chip8.analysis).  Engines that can use
+        it, such as chip8.jit.JitCPU, are given it to prepare ahead of time.
+        :param cache_dir: directory to cache analyses in, if any
+        :return: RomAnalysis
+        """
+        if self.program is None:
+            raise ValueError("No program loaded")
+        analysis = analyze_rom(self.program, cache_dir)
+        if hasattr(self.cpu, "precompile"):
+            self.cpu.precompile(analysis)
+        return analysis
+
+    def snapshot(self, buffer=None):
+        """
+        Capture the complete machine state; see CPU.snapshot
+        """
+        return self.cpu.snapshot(buffer)
+
+    def restore(self, snapshot):
+        """
+        Restore the machine state from a snapshot; see CPU.restore
+        """
+        self.cpu.restore(snapshot)
+
+    def enable_rewind(self, capacity=None, interval_frames=1, history_bytes=None):
+        """
+        Start keeping rewind history (see RewindBuffer).  While run() is running,
+        holding REWIND_KEY steps back one recorded snapshot per frame.
+        :param capacity: number of snapshots of history to keep (default: an hour at one per frame)
+        :param interval_frames: record a snapshot once every this many frames
+        :param history_bytes: memory to keep the history in (default: rewind.DEFAULT_HISTORY_BYTES)
+        :return:
+        """
+        kwargs = {} if capacity is None else {"capacity": capacity}
+        if history_bytes is not None:
+            kwargs["history_bytes"] = history_bytes
+        self.rewind = RewindBuffer(interval_frames=interval_frames, **kwargs)
+
+    def disable_rewind(self):
+        self.rewind = None
+
+    def rewind_step(self):
+        """
+        Go back to the previous snapshot in the rewind history
+        :return: True if there was history to go back to
+        """
+        snapshot = self.rewind.step_back() if self.rewind is not None else None
+        if snapshot is None:
+            return False
+        self.restore(snapshot)
+        return True
+
+    def _rewind_held(self):
+        """
+        Is the user holding the rewind key?  (Ignored while recording input, since a
+        recording must run forwards.)
+        """
+        return (self.rewind is not None and self.recorder is None and self._uses_pygame
+                and self._pygame.key.get_pressed()[getattr(self._pygame, REWIND_KEY)])
+
+    def start_recording(self, filename, seed=None):
+        """
+        Start logging keyboard input to a file (see chip8.inputlog), so that the run can be
+        replayed exactly by replay().  Needs a virtual clock, and must be started before the
+        program starts running.
+        :param filename: input log file to write
+        :param seed: seed for the RND instruction (default: the VM's seed, or a new random one)
+        :return:
+        """
+        if not self.virtual_clock:
+            raise ValueError("Recording input needs a VM with a virtual clock")
+        if self.cpu.cycles != 0:
+            raise ValueError("Recording input must start before the program runs")
+        if seed is None:
+            seed = self.seed if self.seed is not None else random.randrange(2 ** 63)
+        self.cpu.rng.seed(seed)
+        self.recorder = InputLogWriter(filename, seed=seed, clock_hz=self.cpu.clock_hz,
+                                       io_freq_hz=int(self.io_freq_hz), rom_hash=self.rom_hash)
+        self.keyboard = RecordingKeyboard(self.keyboard, self.recorder, clock=lambda: self.cpu.cycles)
+        self.cpu.keyboard = self.keyboard
+
+    def stop_recording(self):
+        """
+        Finish the input log started by start_recording
+        :return:
+        """
+        self.recorder.close(self.cpu.cycles)
+        self.recorder = None
+        self.keyboard = self.keyboard.detach()
+        self.cpu.keyboard = self.keyboard
+
+    def replay(self, filename):
+        """
+        Replay an input log written by start_recording, as fast as possible.  Load the same
+        program first; the run then ends in exactly the state the recorded run ended in.
+        The log is read as the replay goes, so it may be any length.
+        :param filename: input log file
+        :return: RunResult
+        """
+        reader = InputLogReader(filename)
+        if not self.virtual_clock or self.cpu.clock_hz != reader.clock_hz:
+            raise ValueError("Replaying {} needs a VM with a virtual clock of {}Hz".format(filename, reader.clock_hz))
+        if self.io_freq_hz != reader.io_freq_hz:
+            # the frame boundaries, where the recorded run read the keyboard and drew, would not match
+            raise ValueError("{} was recorded at {} frames per second, not {}".format(filename, reader.io_freq_hz,
+                                                                                      self.io_freq_hz))
+        if self.cpu.cycles != 0:
+            raise ValueError("Replay must start before the program runs")
+        if reader.rom_hash is not None and self.rom_hash is not None and reader.rom_hash != self.rom_hash:
+            raise ValueError("{} was recorded with a different program".format(filename))
+        self.cpu.rng.seed(reader.seed)
+        keyboard = ReplayKeyboard(reader.events())
+        self.keyboard = keyboard
+        self.cpu.keyboard = keyboard
+
+        # run frame by frame as the recording did, stopping within a frame to apply each key change
+        # at exactly the cycle it was logged at
+        frames_run = 0
+        end = None
+        while end is None or self.cpu.cycles < end:
+            frame_end = self.cpu.cycles + self._frame_cycles(frames_run)
+            while True:
+                cycle, _, kind = keyboard.next_event
+                if kind == LOG_END:
+                    end = cycle
+                    frame_end = min(frame_end, end)
+                    break
+                if cycle > frame_end:
+                    break
+                self.cpu.run_cycles(cycle - self.cpu.cycles)
+                keyboard.apply_next()
+            self.cpu.run_cycles(frame_end - self.cpu.cycles)
+            self.screen.draw()
+            frames_run += 1
+
+        return RunResult(cycles=self.cpu.cycles,
+                         frames=frames_run,
+                         framebuffer=self.screen.get_framebuffer(),
+                         state=self.cpu.get_state())
+
+    def enable_profiling(self):
+        """
+        Start profiling the CPU (see chip8.profiler).  Costs nothing until enabled.  A CPU
+        can be profiled or traced, but not both at once.
+        :return: the Profiler
+        """
+        if self.tracer is not None:
+            raise ValueError("Cannot profile while tracing to {}; stop the trace first".format(self.tracer.filename))
+        if self.profiler is None:
+            self.profiler = Profiler()
+        if not self.profiler.is_attached(self.cpu):
+            self.profiler.attach(self.cpu)
+        return self.profiler
+
+    def disable_profiling(self):
+        """
+        Stop profiling; the results collected so far stay in self.profiler, and enabling
+        profiling again adds to them
+        :return:
+        """
+        if self.profiler is not None and self.profiler.is_attached(self.cpu):
+            self.profiler.detach(self.cpu)
+
+    def profile_report(self, top=20):
+        """
+        Summary of the profile: counts and times per opcode family and hot address, the
+        call graph and a heatmap of executed addresses (see Profiler.report)
+        :param top: number of hot addresses to include
+        :return: dict, ready to save as JSON
+        """
+        if self.profiler is None:
+            raise ValueError("Profiling has not been enabled")
+        return self.profiler.report(top)
+
+    def start_trace(self, filename, compression=None):
+        """
+        Start writing a trace of every instruction run to a file (see chip8.trace).
+        Costs nothing until started.  A CPU can be profiled or traced, but not both at once.
+        :param filename: trace file to write
+        :param compression: None, "gzip", "bz2" or "lzma"
+        :return:
+        """
+        if self.tracer is not None:
+            raise ValueError("Already tracing to {}".format(self.tracer.filename))
+        if self.profiler is not None and self.profiler.is_attached(self.cpu):
+            raise ValueError("Cannot trace while profiling; disable profiling first")
+        tracer = TraceWriter(filename, compression=compression, first_cycle=self.cpu.cycles)
+        try:
+            tracer.attach(self.cpu)
+        except Exception:
+            tracer.close()
+            raise
+        self.tracer = tracer
+
+    def stop_trace(self):
+        """
+        Stop tracing and finish the trace file
+        :return:
+        """
+        self.tracer.close()
+        self.tracer = None
+
+    def save_state(self, filename):
+        """
+        Save the machine state to a file
+        :param filename:
+        :return:
+        """
+        snapshot = self.snapshot()
+        with open(filename, "wb") as f:
+            f.write(STATE_FILE_HEADER.pack(STATE_FILE_MAGIC, STATE_FILE_VERSION, len(snapshot)))
+            f.write(snapshot)
+
+    def load_state(self, filename):
+        """
+        Restore the machine state from a file written by save_state
+        :param filename:
+        :return:
+        """
+        with open(filename, "rb") as f:
+            magic, version, size = STATE_FILE_HEADER.unpack(f.read(STATE_FILE_HEADER.size))
+            if magic != STATE_FILE_MAGIC:
+                raise ValueError("{} is not a chip8 state file".format(filename))
+            if version != STATE_FILE_VERSION:
+                raise ValueError("Unsupported state file version {} (expected {})".format(version, STATE_FILE_VERSION))
+            snapshot = f.read(size)
+        self.restore(snapshot)
@@ -1,6 +1,10 @@
+import array
 import random
+import struct
 import time
 
+from .decoder import NUM_OPCODES, decode
+
 C8_FONT = [
      bytearray([0xF0, 0x90, 0x90, 0x90, 0xF0]),  # 0
      bytearray([0x20, 0x60, 0x20, 0x20, 0x70]),  # 1
@@ -34,8 +38,43 @@ class CPU:
     TIMER_DEC_FREQ_HZ = 60
     TIMER_DEC_TIMESTEP_S = 1. / TIMER_DEC_FREQ_HZ
     PROGRAM_START_ADDR = 0x200
+    WALL_CLOCK_CHECK_CYCLES = 16    # instructions run between wall-clock timer checks in run_cycles
+
+    # Machine state buffer: the register file (V, stack, I, PC, SP, DT, ST, cycles, timer phase), then
+    # RAM.  RAM is a view into it.  V, the stack and the other registers are kept in attributes
+    # while the CPU runs, where they are quickest to update, and are stored into it when the state is
+    # exported (see state_view); the stack is stored little-endian whatever the host's byte order
+    REGISTER_FILE = struct.Struct("<16s16HIHBBBxQI")
+    STACK_OFFSET = NUM_MAIN_REGISTERS
+    REGISTER_STACK = struct.Struct("<16H")
+    SCALARS_OFFSET = STACK_OFFSET + 2 * STACK_DEPTH
+    REGISTER_SCALARS = struct.Struct("<IHBBBxQI")   # I, PC, SP, DT, ST, cycles, timer phase
+    RAM_OFFSET = REGISTER_FILE.size
+    STATE_SIZE = RAM_OFFSET + RAM_SIZE_BYTES
+
+    # Snapshot layout: the machine state buffer, then the packed screen
+    SNAPSHOT_REGISTERS = REGISTER_FILE
+    SNAPSHOT_RAM_OFFSET = RAM_OFFSET
+    SNAPSHOT_SCREEN_OFFSET = STATE_SIZE
+    SNAPSHOT_SIZE = SNAPSHOT_SCREEN_OFFSET + SCREEN_WIDTH * SCREEN_HEIGHT // 8
+
+    __slots__ = ("_state", "V", "stack", "ram", "I", "PC", "SP", "DT", "ST",
+                 "screen", "keyboard", "_dispatch", "_time_at_last_dec",
+                 "clock_hz", "cycles", "_timer_phase", "waiting_for_key", "_rng", "_seed",
+                 "_profiler", "_tracer")
+
+    def __init__(self, keyboard=None, screen=None, clock_hz=None, seed=None):
+        """
+        :param keyboard: keyboard backend
+        :param screen: screen backend
+        :param clock_hz: if given, run the timers in virtual time: they decrement once every
+                         clock_hz / 60 instructions rather than every 1/60 s of wall-clock time
+        :param seed: seed for the random numbers of the RND instruction (default: unpredictable)
+        """
+        # The whole machine state, in one buffer
+        self._state = bytearray(self.STATE_SIZE)
+        state = memoryview(self._state)
 
-    def __init__(self, keyboard=None, screen=None):
         # User accessible registers
         self.V = bytearray(self.NUM_MAIN_REGISTERS)  # 16 x 8-bit general purpose registers
         self.I = 0              # memory address register
@@ -47,8 +86,8 @@ class CPU:
         self.SP = 0             # stack pointer
 
         # Memory
-        self.stack = [0] * self.STACK_DEPTH   # the stack, 16 x 16-bit values
-        self.ram = bytearray(self.RAM_SIZE_BYTES)  # the main memory
+        self.stack = array.array("H", bytes(2 * self.STACK_DEPTH))   # the stack, 16 x 16-bit values
+        self.ram = state[self.RAM_OFFSET:]      # the main memory
 
         # Screen (externally provided)
         self.screen = screen
@@ -56,10 +95,32 @@ class CPU:
         # Keyboard (externally provided)
         self.keyboard = keyboard
 
+        # Opcode dispatch table (shared by all instances of the class)
+        self._dispatch = self._get_dispatch_table()
+
         # initialization
         self._init_font()   # places the default font into the first bit of the RAM
         self._time_at_last_dec = time.time()  # time since the 60Hz timers were last decremented
 
+        # Clock
+        self.clock_hz = clock_hz    # None for wall-clock timers
+        self.cycles = 0             # number of instructions run
+        self._timer_phase = 0       # progress towards the next virtual-time timer decrement
+
+        # Set while an Fx0A instruction is waiting for a key press
+        self.waiting_for_key = False
+
+        # Random numbers for rnd_and, private to this CPU so that a seed reproduces a run.  The
+        # generator holds a few KB of state, so it is only made once it is first needed.
+        self._rng = None
+        self._seed = seed
+
+    @property
+    def rng(self):
+        if self._rng is None:
+            self._rng = random.Random(self._seed)
+        return self._rng
+
     def print_state(self):
         for i in range(0, self.NUM_MAIN_REGISTERS, 2):
             print("V[{:2}]: {:3}          V[{:2}]: {:3}".format(i, self.V[i], i + 1, self.V[i + 1]))
@@ -68,12 +129,79 @@ class CPU:
         print("DT: {:3}        SP: {:3}".format(self.DT, self.SP))
         print("ST: {:3}        Instr @ PC: {}".format(self.ST, self.ram[self.PC:self.PC+2].hex()))
         print()
-        print("Stack: {}".format(self.stack))
+        print("Stack: {}".format(list(self.stack)))
         print()
         print("Memory at I: {}".format(self.ram[self.I]))
         print()
+        print("Cycles: {}".format(self.cycles))
         print("Time since last dec: {:.3f}s".format(time.time() - self._time_at_last_dec))
 
+    def get_state(self):
+        """
+        Get a copy of the register state of the CPU
+        :return: dict of register name -> value
+        """
+        return {"V": bytes(self.V),
+                "I": self.I,
+                "PC": self.PC,
+                "SP": self.SP,
+                "DT": self.DT,
+                "ST": self.ST,
+                "stack": list(self.stack),
+                "cycles": self.cycles}
+
+    def state_view(self):
+        """
+        Get the machine state (registers, stack and RAM) without copying it
+        :return: read-only memoryview of STATE_SIZE bytes, laid out as REGISTER_FILE followed by
+                 RAM.  It stays a view of the live state, but the registers (V, the stack and the
+                 rest) are only brought up to date by calls to state_view or snapshot.
+        """
+        self._store_registers()
+        return memoryview(self._state).toreadonly()
+
+    def _store_registers(self):
+        """
+        Store the registers kept as attributes into the state buffer
+        """
+        self._state[:self.NUM_MAIN_REGISTERS] = self.V
+        self.REGISTER_STACK.pack_into(self._state, self.STACK_OFFSET, *self.stack)
+        self.REGISTER_SCALARS.pack_into(self._state, self.SCALARS_OFFSET, self.I, self.PC, self.SP, self.DT,
+                                        self.ST, self.cycles, self._timer_phase)
+
+    def snapshot(self, buffer=None):
+        """
+        Capture the complete machine state (registers, stack, RAM and screen) in the
+        fixed layout described by the SNAPSHOT_* constants
+        :param buffer: a writable buffer of SNAPSHOT_SIZE bytes to fill, so that the caller
+                       can reuse preallocated buffers; a new bytearray if None
+        :return: the buffer
+        """
+        if buffer is None:
+            buffer = bytearray(self.SNAPSHOT_SIZE)
+        self._store_registers()
+        buffer[:self.STATE_SIZE] = self._state
+        if self.screen is not None:
+            buffer[self.SNAPSHOT_SCREEN_OFFSET:self.SNAPSHOT_SIZE] = self.screen.get_packed()
+        return buffer
+
+    def restore(self, snapshot):
+        """
+        Restore the machine state from a snapshot
+        :param snapshot: bytes-like object made by snapshot()
+        :return:
+        """
+        if len(snapshot) != self.SNAPSHOT_SIZE:
+            raise ValueError("Snapshot is {} bytes; expected {}".format(len(snapshot), self.SNAPSHOT_SIZE))
+        self._state[:] = snapshot[:self.STATE_SIZE]
+        self.V[:] = self._state[:self.NUM_MAIN_REGISTERS]
+        self.stack[:] = array.array("H", self.REGISTER_STACK.unpack_from(self._state, self.STACK_OFFSET))
+        (self.I, self.PC, self.SP, self.DT, self.ST,
+         self.cycles, self._timer_phase) = self.REGISTER_SCALARS.unpack_from(self._state, self.SCALARS_OFFSET)
+        self.waiting_for_key = False    # an Fx0A at the PC starts its wait afresh
+        if self.screen is not None:
+            self.screen.set_packed(snapshot[self.SNAPSHOT_SCREEN_OFFSET:self.SNAPSHOT_SIZE])
+
     def _init_font(self):
         """
         Places the font into system memory
@@ -83,206 +211,233 @@ class CPU:
             self.ram[i * 5: i * 5 + 5] = c
 
     def load_program(self, bytecode):
+        if len(bytecode) > self.RAM_SIZE_BYTES - self.PROGRAM_START_ADDR:
+            raise ValueError("Program is {} bytes; at most {} fit in RAM".format(
+                len(bytecode), self.RAM_SIZE_BYTES - self.PROGRAM_START_ADDR))
         self.ram[self.PROGRAM_START_ADDR:self.PROGRAM_START_ADDR + len(bytecode)] = bytecode
 
+    @classmethod
+    def _get_dispatch_table(cls):
+        """
+        Get the opcode dispatch table for this class: for each opcode, the function that
+        implements it, its arguments and whether to increment the PC afterwards, so that
+        running an instruction is a single lookup and a single call.  One table per class.
+        Opcodes are decoded as they are first run (see _run_undecoded), so making the
+        table costs next to nothing.
+        :return: list of (function, args, increment_pc), indexed by opcode
+        """
+        table = cls.__dict__.get("_dispatch_table")
+        if table is None:
+            table = cls._dispatch_table = [(CPU._run_undecoded, (), False)] * NUM_OPCODES
+        return table
+
+    def _dispatch_entry(self, opcode):
+        """
+        The dispatch table entry for an opcode, decoding it into the table if it has not
+        been run before
+        :return: (function, args, increment_pc)
+        """
+        entry = self._dispatch[opcode]
+        if entry[0] is CPU._run_undecoded:
+            name, args, increment_pc = decode(opcode)
+            entry = self._dispatch[opcode] = (getattr(type(self), name), args, increment_pc)
+        return entry
+
+    def _run_undecoded(self):
+        """
+        Stands in the dispatch table for the opcodes that have not been run yet: decodes
+        the instruction at PC into the table and runs it
+        """
+        pc = self.PC
+        handler, args, increment_pc = self._dispatch_entry((self.ram[pc] << 8) | self.ram[pc + 1])
+        handler(self, *args)
+        if increment_pc:
+            self.PC += 2
+
     def tick(self):
         """
         Run a single cycle of the CPU (one instruction)
         :return:
         """
-        # run the instruction and increment PC
-        if self.PC >= self.RAM_SIZE_BYTES - 2:
-            raise ValueError("PC out of range: PC = {}    (max addr = {})".format(self.PC, self.RAM_SIZE_BYTES - 2))
-        instr = self.ram[self.PC:self.PC + 2]   # instructions are two bytes
-        #print(self.PC, instr.hex())
-        increment_pc = self.run_instruction(instr)
-        if increment_pc:
-            self.PC += 2
+        self._execute(1)
+        self._advance_clock(1)
 
+    def run_cycles(self, cycles):
+        """
+        Run a number of CPU cycles (instructions) back to back.  In virtual time mode the
+        instructions are run in stretches that end exactly where the timers decrement, so
+        the timers cost nothing per instruction and the result is identical to calling
+        tick() cycles times.  Stretches spent spinning in an idle loop are skipped rather
+        than run (see _skip_idle_loop).
+        :param cycles: number of instructions to run
+        :return:
+        """
+        while cycles > 0:
+            if self.clock_hz is None:
+                n = min(cycles, self.WALL_CLOCK_CHECK_CYCLES)
+            else:
+                n = min(cycles, self.cycles_until_timer_dec())
+            if not self._skip_idle_loop(n):
+                self._execute(n)
+            self._advance_clock(n)
+            cycles -= n
 
+    def _execute(self, cycles):
+        """
+        Run instructions back to back without updating the timers
+        :param cycles: number of instructions to run
+        :return:
+        """
+        ram = self.ram
+        dispatch = self._dispatch
+        max_pc = self.RAM_SIZE_BYTES - 2
+        for _ in range(cycles):
+            # run the instruction and increment PC
+            pc = self.PC
+            if pc >= max_pc:
+                raise ValueError("PC out of range: PC = {}    (max addr = {})".format(pc, max_pc))
+            handler, args, increment_pc = dispatch[(ram[pc] << 8) | ram[pc + 1]]   # instructions are two bytes
+            handler(self, *args)
+            if increment_pc:
+                self.PC += 2
+
+    def _skip_idle_loop(self, cycles):
+        """
+        If the PC is in an idle loop that nothing can break out of for the next cycles
+        instructions, skip them: set the registers to what running them would leave.
+        Only the timers and the keyboard can end these loops, and neither changes
+        within a stretch of run_cycles.  The loops are
+            L: Fx07  /  3x00  /  1L     wait for the delay timer to reach 0 (while DT != 0)
+            L: Ex9E  /  1L              wait for the key in Vx to be pressed (while it is not)
+            L: ExA1  /  1L              wait for the key in Vx to be released (while it is not)
+            L: Fx0A                     wait for a key press (once the wait has begun)
+        :param cycles: number of instructions to skip
+        :return: True if they were skipped, False if they must be run
+        """
+        ram = self.ram
+        pc = self.PC
+        if pc + 2 > self.RAM_SIZE_BYTES - 2:
+            return False
+
+        # which instruction of which loop the PC would be at: the loop starts pos instructions back
+        hi = ram[pc]
+        lo = ram[pc + 1]
+        family = hi & 0xF0
+        if family == 0x10:
+            target = ((hi & 0x0F) << 8) | lo
+            if target == pc - 4:
+                timer_loop, pos = True, 2
+            elif target == pc - 2:
+                timer_loop, pos = False, 1
+            else:
+                return False
+        elif family == 0xF0 and lo == 0x07:
+            timer_loop, pos = True, 0
+        elif family == 0x30 and lo == 0x00:
+            timer_loop, pos = True, 1
+        elif family == 0xE0 and (lo == 0x9E or lo == 0xA1):
+            timer_loop, pos = False, 0
+        elif family == 0xF0 and lo == 0x0A:
+            # an Fx0A that is already waiting for a key keeps waiting: presses only arrive between stretches
+            return self.waiting_for_key and self.keyboard.key_press() is None
+        else:
+            return False
+        start = pc - 2 * pos
+        if start < 0 or start + (6 if timer_loop else 4) > self.RAM_SIZE_BYTES:
+            return False
+
+        if timer_loop:
+            x = ram[start] & 0x0F
+            if not ((ram[start] & 0xF0) == 0xF0 and ram[start + 1] == 0x07 and
+                    ram[start + 2] == 0x30 | x and ram[start + 3] == 0x00 and
+                    ram[start + 4] == 0x10 | (start >> 8) and ram[start + 5] == start & 0xFF):
+                return False
+            if self.DT == 0 or (pos == 1 and self.V[x] == 0):
+                return False    # the loop is about to exit
+            if pos == 0 or cycles > 3 - pos:
+                self.V[x] = self.DT     # the Fx07 (instruction 3 - pos, counting from 0) runs at least once
+            self.PC = start + 2 * ((pos + cycles) % 3)
+        else:
+            if not ((ram[start] & 0xF0) == 0xE0 and ram[start + 1] in (0x9E, 0xA1) and
+                    ram[start + 2] == 0x10 | (start >> 8) and ram[start + 3] == start & 0xFF):
+                return False
+            key = self.V[ram[start] & 0x0F]
+            if key > 0xF:
+                return False    # let the instruction fail as it would when run
+            if bool(self.keyboard.is_pressed(key)) == (ram[start + 1] == 0x9E):
+                return False    # the loop is about to exit
+            self.PC = start + 2 * ((pos + cycles) % 2)
+        return True
+
+    def cycles_until_timer_dec(self):
+        """
+        Number of cycles to run before the timers next decrement (virtual time mode only)
+        :return:
+        """
+        return (self.clock_hz - self._timer_phase + self.TIMER_DEC_FREQ_HZ - 1) // self.TIMER_DEC_FREQ_HZ
 
-        # if sufficient time has passed, decrement the timers
-        self._update_delay_timers()
+    def _advance_clock(self, cycles):
+        """
+        Count cycles that have been run and update the delay timers to match
+        :param cycles: number of instructions run since the last call
+        :return:
+        """
+        self.cycles += cycles
+        if self.clock_hz is None:
+            # if sufficient time has passed, decrement the timers
+            self._update_delay_timers()
+        else:
+            # the timers decrement once every clock_hz / 60 cycles; the phase counts in 1 / clock_hz steps
+            phase = self._timer_phase + cycles * self.TIMER_DEC_FREQ_HZ
+            if phase >= self.clock_hz:
+                decs = phase // self.clock_hz
+                phase -= decs * self.clock_hz
+                self.ST = max(0, self.ST - decs)
+                self.DT = max(0, self.DT - decs)
+            self._timer_phase = phase
 
     def _update_delay_timers(self):
         """
-        Decrement the delay and sound timers if sufficient time has passed
-        since the last time that happened.
+        Decrement the delay and sound timers once for each timer step of wall-clock
+        time that has passed since the last time that happened.
         :return:
         """
-        #
-        tnow = time.time()
-        if tnow - self._time_at_last_dec > self.TIMER_DEC_TIMESTEP_S:
-            self._time_at_last_dec = tnow
-            self.ST = max(0, self.ST - 1)
-            self.DT = max(0, self.DT - 1)
+        elapsed = time.time() - self._time_at_last_dec
+        if elapsed > self.TIMER_DEC_TIMESTEP_S:
+            decs = int(elapsed / self.TIMER_DEC_TIMESTEP_S)
+            self._time_at_last_dec += decs * self.TIMER_DEC_TIMESTEP_S
+            self.ST = max(0, self.ST - decs)
+            self.DT = max(0, self.DT - decs)
 
     def run_instruction(self, instr):
         """
         Run the two-byte instruction instr
+        :return: True if the PC should be incremented after the instruction
         """
-        nibs = [(instr[0] & 0xF0) >> 4,
-                instr[0] & 0x0F,
-                (instr[1] & 0xF0) >> 4,
-                instr[1] & 0x0F]
-
-        #print(instr.hex(), nibs)
-        instr_i = int(instr[0] * 256 + instr[1])
-
-        increment_pc = True
-
-
-        if instr_i == 0x00E0:
-            # 00e0
-            # CLS
-            self.clear_screen()
-        elif instr_i == 0x00EE:
-            # 00ee
-            # RET
-            self.ret()
-        elif nibs[0] == 0:
-            # 0nnn
-            # SYS addr
-            pass
-        elif nibs[0] == 1:
-            # 1nnn
-            # JP addr
-            # addr is 12-bit
-            self.jump(address=instr_i & 0x0FFF)
-            increment_pc = False
-        elif nibs[0] == 2:
-            # 2nnn
-            # CALL addr
-            self.call(address=instr_i & 0x0FFF)
-            increment_pc = False
-        elif nibs[0] == 3:
-            # 3xbb
-            # SE Vx, byte
-            self.skip_if_equalv(register=nibs[1], value=instr[1])
-        elif nibs[0] == 4:
-            # 4xbb
-            # SNE Vx, byte
-            self.skip_if_not_equalv(register=nibs[1], value=instr[1])
-        elif nibs[0] == 5 and nibs[3] == 0:
-            # 5xy0
-            # SE Vx, Vy
-            self.skip_if_equalr(register1=nibs[1], register2=nibs[2])
-        elif nibs[0] == 6:
-            # 6xkk
-            # LD Vx, byte
-            self.loadv(register=nibs[1], value=instr[1])
-        elif nibs[0] == 7:
-            # 7xkk
-            # ADD Vx, byte
-            self.add(register=nibs[1], value=instr[1])
-        elif nibs[0] == 8:
-            if nibs[3] == 0:
-                # 8xy0
-                # LD Vx, Vy
-                self.loadr(target_register=nibs[1], source_register=nibs[2])
-            elif nibs[3] == 1:
-                # 8xy1
-                # OR Vx, Vy
-                self.orr(register1=nibs[1], register2=nibs[2])
-            elif nibs[3] == 2:
-                # 8xy2
-                # AND Vx, Vy
-                self.andr(register1=nibs[1], register2=nibs[2])
-            elif nibs[3] == 3:
-                # 8xy3
-                # XOR Vx, Vy
-                self.xorr(register1=nibs[1], register2=nibs[2])
-            elif nibs[3] == 4:
-                # 8xy4
-                # ADD Vx, Vy
-                self.addr(register1=nibs[1], register2=nibs[2])
-            elif nibs[3] == 5:
-                # 8xy5
-                # SUB Vx, Vy
-                self.subr(register1=nibs[1], register2=nibs[2])
-            elif nibs[3] == 6:
-                # 8xy6
-                # SHR Vx, {Vy}
-                self.shift_rightr(register=nibs[1])
-            elif nibs[3] == 7:
-                # 8xy7
-                # SUBN Vx, Vy
-                self.subnr(register1=nibs[1], register2=nibs[2])
-            elif nibs[3] == 0xE:
-                # 8xyE
-                # SHL Vx, {Vy}
-                self.shift_leftr(register=nibs[1])
-        elif nibs[0] == 9 and nibs[3] == 0:
-            # 9xy0
-            # SNE Vx, Vy
-            self.skip_if_not_equalr(register1=nibs[1], register2=nibs[2])
-        elif nibs[0] == 0xA:
-            # Annn
-            # LD I, addr
-            self.load_memory_register(address=instr_i & 0x0FFF)
-        elif nibs[0] == 0xB:
-            # Bnnn
-            # JP V0, addr
-            self.jump_add(address=instr_i & 0x0FFF)
-        elif nibs[0] == 0xC:
-            # Cxkk
-            # RND Vx, byte
-            self.rnd_and(register=nibs[1], value=instr[1])
-        elif nibs[0] == 0xD:
-            # Dxyn
-            # DRW Vx, Vy, size
-            self.draw_sprite(register1=nibs[1], register2=nibs[2], sprite_size=nibs[3])
-        elif nibs[0] == 0xE and instr[1] == 0x9E:
-            # Ex9E
-            # SKP Vx
-            self.skip_if_key_pressed(key_register=nibs[1])
-        elif nibs[0] == 0xE and instr[1] == 0xA1:
-            # ExA1
-            # SKNP Vx
-            self.skip_if_key_not_pressed(key_register=nibs[1])
-        elif nibs[0] == 0xF:
-            if instr[1] == 0x07:
-                # Fx07
-                # LD Vx, DT
-                self.read_delay_timer(register=nibs[1])
-            elif instr[1] == 0x0A:
-                # Fx0A
-                # LD Vx, K
-                self.wait_and_load_key(register=nibs[1])
-            elif instr[1] == 0x15:
-                # Fx15
-                # LD DT, Vx
-                self.set_delay_timer(register=nibs[1])
-            elif instr[1] == 0x18:
-                # Fx18
-                # LD ST, Vx
-                self.set_sound_timer(register=nibs[1])
-            elif instr[1] == 0x1E:
-                # Fx1E
-                # ADD I, Vx
-                self.add_to_I(register=nibs[1])
-            elif instr[1] == 0x29:
-                # Fx29
-                # LD F, Vx
-                self.set_I_to_digit_sprite(register=nibs[1])
-            elif instr[1] == 0x33:
-                # Fx33
-                # LD B, Vx
-                self.set_mem_to_bcd(register=nibs[1])
-            elif instr[1] == 0x55:
-                # Fx55
-                # LD [I], Vx
-                self.store_to_mem(register_to=nibs[1])
-            elif instr[1] == 0x65:
-                # Fx0A
-                # LD Vx, [I]
-                self.read_mem(register_to=nibs[1])
-        else:
-            # do nothing - illegal instruction
-            print("Illegal instruction: {}".format(instr.hex()))
-
+        handler, args, increment_pc = self._dispatch_entry((instr[0] << 8) | instr[1])
+        handler(self, *args)
         return increment_pc
 
+    def sys_call(self, address):
+        """
+        call a machine code routine on the original hardware; ignored here
+        Instruction:  SYS addr
+        Bytecode: 0x0nnn
+        """
+        pass
+
+    def nop(self):
+        """
+        unassigned instruction in the 0x8xyN or 0xFxkk families; does nothing
+        """
+        pass
+
+    def illegal_instruction(self, opcode):
+        """
+        do nothing - illegal instruction
+        """
+        print("Illegal instruction: {:04x}".format(opcode))
+
     def clear_screen(self):
         """
         Clear screen
@@ -497,7 +652,8 @@ class CPU:
         Instruction:  JMP V0, addr
         Bytecode: 0xCxkk
         """
-        self.V[register] = random.randrange(0, self.TO_8BIT) & value
+        rng = self._rng if self._rng is not None else self.rng
+        self.V[register] = rng.randrange(0, self.TO_8BIT) & value
 
     def draw_sprite(self, register1, register2, sprite_size):
         """
@@ -509,16 +665,11 @@ class CPU:
         x_st = self.V[register1]
         y_st = self.V[register2]
         collision = False
+        xor_sprite_row = self.screen.xor_sprite_row
         for j in range(sprite_size):
-            ram_ix = self.I + j   # eight bits per byte = 8 pixels per line as sprites are 8px wide
-            for i in range(self.SPRITE_WIDTH):
-                v = self.ram[ram_ix] & (1 << (7 - i)) > 0
-                if (self.screen.get(x_st + i, y_st + j) & v) > 0:
-                    collision = True
-                self.screen.set(x=x_st + i,
-                                y=y_st + j,
-                                v=(self.screen.get(x_st + i, y_st + j) ^ v)
-                                )
+            # eight bits per byte = 8 pixels per line as sprites are 8px wide
+            if xor_sprite_row(x_st, y_st + j, self.ram[self.I + j]):
+                collision = True
         self.V[0xF] = int(collision)
 
     def skip_if_key_pressed(self, key_register):
@@ -553,7 +704,17 @@ class CPU:
         Instruction:  LD Vx, K
         Bytecode: 0xFx0A
         """
-        self.V[register] = self.keyboard.wait_for_key(callbacks=[self._update_delay_timers])
+        # the wait does not block: until a key is pressed the PC stays on this instruction, so
+        # it runs again next cycle while the timers, screen and keyboard carry on as normal
+        if not self.waiting_for_key:
+            self.keyboard.begin_key_wait()
+            self.waiting_for_key = True
+        key = self.keyboard.key_press()
+        if key is None:
+            self.PC -= 2
+            return
+        self.waiting_for_key = False
+        self.V[register] = key
 
     def set_delay_timer(self, register):
         """
@@ -0,0 +1,181 @@
+"""
+Instruction decoding for the CHIP-8 CPU.
+
+The decode table holds, for every one of the 65,536 possible opcodes, the name of
+the CPU method that executes it, the (pre-extracted) arguments for that method and
+whether the program counter should be advanced once it has run.  The table is
+built a family (leading nibble) at a time, filling whole ranges of it with slices,
+rather than by calling decode on each opcode; decode gives the same entries one
+opcode at a time, which is how the CPU's dispatch table is filled in as opcodes are
+first run.
+"""
+import gc
+from itertools import repeat
+
+NUM_OPCODES = 2 ** 16
+
+_decode_table = None
+
+
+def decode(opcode):
+    """
+    Decode a single 16-bit opcode
+    :param opcode: the two instruction bytes as a big endian integer
+    :return: (method_name, args, increment_pc) where args are positional arguments for the CPU method
+    """
+    nibs = ((opcode & 0xF000) >> 12,
+            (opcode & 0x0F00) >> 8,
+            (opcode & 0x00F0) >> 4,
+            opcode & 0x000F)
+    x = nibs[1]
+    y = nibs[2]
+    n = nibs[3]
+    kk = opcode & 0x00FF
+    nnn = opcode & 0x0FFF
+
+    if opcode == 0x00E0:
+        return "clear_screen", (), True                     # 00E0 CLS
+    elif opcode == 0x00EE:
+        return "ret", (), True                              # 00EE RET
+    elif nibs[0] == 0:
+        return "sys_call", (nnn,), True                     # 0nnn SYS addr
+    elif nibs[0] == 1:
+        return "jump", (nnn,), False                        # 1nnn JP addr
+    elif nibs[0] == 2:
+        return "call", (nnn,), False                        # 2nnn CALL addr
+    elif nibs[0] == 3:
+        return "skip_if_equalv", (x, kk), True              # 3xkk SE Vx, byte
+    elif nibs[0] == 4:
+        return "skip_if_not_equalv", (x, kk), True          # 4xkk SNE Vx, byte
+    elif nibs[0] == 5 and n == 0:
+        return "skip_if_equalr", (x, y), True               # 5xy0 SE Vx, Vy
+    elif nibs[0] == 6:
+        return "loadv", (x, kk), True                       # 6xkk LD Vx, byte
+    elif nibs[0] == 7:
+        return "add", (x, kk), True                         # 7xkk ADD Vx, byte
+    elif nibs[0] == 8:
+        if n == 0:
+            return "loadr", (x, y), True                    # 8xy0 LD Vx, Vy
+        elif n == 1:
+            return "orr", (x, y), True                      # 8xy1 OR Vx, Vy
+        elif n == 2:
+            return "andr", (x, y), True                     # 8xy2 AND Vx, Vy
+        elif n == 3:
+            return "xorr", (x, y), True                     # 8xy3 XOR Vx, Vy
+        elif n == 4:
+            return "addr", (x, y), True                     # 8xy4 ADD Vx, Vy
+        elif n == 5:
+            return "subr", (x, y), True                     # 8xy5 SUB Vx, Vy
+        elif n == 6:
+            return "shift_rightr", (x,), True               # 8xy6 SHR Vx, {Vy}
+        elif n == 7:
+            return "subnr", (x, y), True                    # 8xy7 SUBN Vx, Vy
+        elif n == 0xE:
+            return "shift_leftr", (x,), True                # 8xyE SHL Vx, {Vy}
+        return "nop", (), True
+    elif nibs[0] == 9 and n == 0:
+        return "skip_if_not_equalr", (x, y), True           # 9xy0 SNE Vx, Vy
+    elif nibs[0] == 0xA:
+        return "load_memory_register", (nnn,), True         # Annn LD I, addr
+    elif nibs[0] == 0xB:
+        return "jump_add", (nnn,), True                     # Bnnn JP V0, addr
+    elif nibs[0] == 0xC:
+        return "rnd_and", (x, kk), True                     # Cxkk RND Vx, byte
+    elif nibs[0] == 0xD:
+        return "draw_sprite", (x, y, n), True               # Dxyn DRW Vx, Vy, size
+    elif nibs[0] == 0xE and kk == 0x9E:
+        return "skip_if_key_pressed", (x,), True            # Ex9E SKP Vx
+    elif nibs[0] == 0xE and kk == 0xA1:
+        return "skip_if_key_not_pressed", (x,), True        # ExA1 SKNP Vx
+    elif nibs[0] == 0xF:
+        if kk == 0x07:
+            return "read_delay_timer", (x,), True           # Fx07 LD Vx, DT
+        elif kk == 0x0A:
+            return "wait_and_load_key", (x,), True          # Fx0A LD Vx, K
+        elif kk == 0x15:
+            return "set_delay_timer", (x,), True            # Fx15 LD DT, Vx
+        elif kk == 0x18:
+            return "set_sound_timer", (x,), True            # Fx18 LD ST, Vx
+        elif kk == 0x1E:
+            return "add_to_I", (x,), True                   # Fx1E ADD I, Vx
+        elif kk == 0x29:
+            return "set_I_to_digit_sprite", (x,), True      # Fx29 LD F, Vx
+        elif kk == 0x33:
+            return "set_mem_to_bcd", (x,), True             # Fx33 LD B, Vx
+        elif kk == 0x55:
+            return "store_to_mem", (x,), True               # Fx55 LD [I], Vx
+        elif kk == 0x65:
+            return "read_mem", (x,), True                   # Fx65 LD Vx, [I]
+        return "nop", (), True
+
+    # illegal instruction
+    return "illegal_instruction", (opcode,), True
+
+
+def build_decode_table():
+    """
+    Decode every opcode, a family at a time
+    :return: list of (method_name, args, increment_pc), indexed by opcode
+    """
+    def entries(name, args, increment_pc=True):
+        return list(zip(repeat(name), args, repeat(increment_pc)))
+
+    nnn = [(a,) for a in range(0x1000)]                         # operands of the _nnn families
+    xkk = [(x, kk) for x in range(16) for kk in range(0x100)]   # of the _xkk families
+    xy = [(x, y) for x in range(16) for y in range(16)]         # of _xy_, at a stride of 16 opcodes
+    xyn = [(x, y, n) for x in range(16) for y in range(16) for n in range(16)]
+    x_only = [(x,) for x in range(16)]                          # of _x__, at a stride of 256 opcodes
+    x_of_xy = [(x,) for x in range(16) for _ in range(16)]      # of _xy_ instructions that only use x
+    no_args = [()] * 0x1000
+
+    # the tables hold no reference cycles, so there is nothing for the garbage collector to
+    # find in the tens of thousands of tuples made here
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        table = entries("sys_call", nnn)
+        table[0x00E0] = entries("clear_screen", [()])[0]
+        table[0x00EE] = entries("ret", [()])[0]
+        table += entries("jump", nnn, False)
+        table += entries("call", nnn, False)
+        table += entries("skip_if_equalv", xkk)
+        table += entries("skip_if_not_equalv", xkk)
+        table += entries("illegal_instruction", [(opcode,) for opcode in range(0x5000, 0x6000)])
+        table[0x5000:0x6000:16] = entries("skip_if_equalr", xy)
+        table += entries("loadv", xkk)
+        table += entries("add", xkk)
+        table += entries("nop", no_args)
+        for n, name in ((0, "loadr"), (1, "orr"), (2, "andr"), (3, "xorr"), (4, "addr"), (5, "subr"), (7, "subnr")):
+            table[0x8000 + n:0x9000:16] = entries(name, xy)
+        table[0x8006:0x9000:16] = entries("shift_rightr", x_of_xy)
+        table[0x800E:0x9000:16] = entries("shift_leftr", x_of_xy)
+        table += entries("illegal_instruction", [(opcode,) for opcode in range(0x9000, 0xA000)])
+        table[0x9000:0xA000:16] = entries("skip_if_not_equalr", xy)
+        table += entries("load_memory_register", nnn)
+        table += entries("jump_add", nnn)
+        table += entries("rnd_and", xkk)
+        table += entries("draw_sprite", xyn)
+        table += entries("illegal_instruction", [(opcode,) for opcode in range(0xE000, 0xF000)])
+        table[0xE09E:0xF000:0x100] = entries("skip_if_key_pressed", x_only)
+        table[0xE0A1:0xF000:0x100] = entries("skip_if_key_not_pressed", x_only)
+        table += entries("nop", no_args)
+        for kk, name in ((0x07, "read_delay_timer"), (0x0A, "wait_and_load_key"), (0x15, "set_delay_timer"),
+                         (0x18, "set_sound_timer"), (0x1E, "add_to_I"), (0x29, "set_I_to_digit_sprite"),
+                         (0x33, "set_mem_to_bcd"), (0x55, "store_to_mem"), (0x65, "read_mem")):
+            table[0xF000 + kk:0x10000:0x100] = entries(name, x_only)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return table
+
+
+def get_decode_table():
+    """
+    Get the table of all decoded opcodes, indexed by opcode.  The table is built
+    the first time it is requested and shared from then on.
+    :return: list of (method_name, args, increment_pc), one per opcode
+    """
+    global _decode_table
+    if _decode_table is None:
+        _decode_table = build_decode_table()
+    return _decode_table
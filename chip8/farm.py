@@ -0,0 +1,120 @@
+"""
+Run many headless ROM/scenario jobs across a pool of worker processes.
+
+    jobs = [Job("roms/INVADERS", script=[(10, 5, 1), (20, 5, 0)], seed=1, cycles=100000), ...]
+    for result in run_jobs(jobs):
+        print(result.job_id, result.state_hash, result.error)
+
+Results stream back as jobs finish, in completion order.  Each worker reads a ROM
+file only once, however many jobs use it.
+"""
+import hashlib
+import multiprocessing
+import traceback
+
+from .chip8 import Chip8VM, DEFAULT_CPU_FREQUENCY_HZ, DEFAULT_IO_FREQUENCY_HZ
+from .cpu import CPU
+
+
+class Job:
+    """
+    One headless run: a ROM (file name or bytecode), a ScriptedKeyboard script, a
+    random seed and a budget of CPU cycles
+    """
+
+    def __init__(self, rom, script=(), seed=None, cycles=100000, job_id=None):
+        self.rom = rom
+        self.script = list(script)
+        self.seed = seed
+        self.cycles = cycles
+        self.job_id = job_id
+
+
+class JobResult:
+    """
+    Compact outcome of a Job
+    """
+
+    def __init__(self, job_id, state_hash, framebuffer, cycles, frames, error=None):
+        self.job_id = job_id
+        self.state_hash = state_hash        # hex digest of the final registers, RAM and screen
+        self.framebuffer = framebuffer      # final screen (see FrameBuffer.get_packed)
+        self.cycles = cycles                # instructions run
+        self.frames = frames                # I/O frames run
+        self.error = error                  # None, or the error that stopped the run early
+
+
+def state_hash(vm):
+    """
+    Hash the complete machine state of a VM
+    :param vm: Chip8VM
+    :return: hex digest of the VM's snapshot
+    """
+    return hashlib.sha1(vm.snapshot()).hexdigest()
+
+
+# Per-worker state, set up by _init_worker
+_worker_vm_args = {}
+_worker_roms = {}
+
+
+def _init_worker(vm_args):
+    global _worker_vm_args
+    _worker_vm_args = vm_args
+    _worker_roms.clear()
+
+
+def _load_rom(rom):
+    """
+    Get the bytecode for a job's ROM, reading each file once per worker
+    """
+    if isinstance(rom, (bytes, bytearray)):
+        return rom
+    if rom not in _worker_roms:
+        with open(rom, "rb") as f:
+            _worker_roms[rom] = f.read()
+    return _worker_roms[rom]
+
+
+def run_job(job, **vm_args):
+    """
+    Run a single job in this process
+    :param job: Job
+    :param vm_args: extra arguments for Chip8VM.headless, e.g. cpu_freq_hz or cpu_cls
+    :return: JobResult
+    """
+    vm = Chip8VM.headless(script=job.script, seed=job.seed, **vm_args)
+    error = None
+    try:
+        vm.load_program(_load_rom(job.rom))
+        vm.run_for(cycles=job.cycles)
+    except Exception as e:
+        error = "".join(traceback.format_exception_only(type(e), e)).strip()
+    return JobResult(job_id=job.job_id,
+                     state_hash=state_hash(vm),
+                     framebuffer=vm.screen.get_packed(),
+                     cycles=vm.cpu.cycles,
+                     frames=vm.frames_run,
+                     error=error)
+
+
+def _run_job_in_worker(job):
+    return run_job(job, **_worker_vm_args)
+
+
+def run_jobs(jobs, workers=None, chunksize=1, cpu_freq_hz=DEFAULT_CPU_FREQUENCY_HZ,
+             io_freq_hz=DEFAULT_IO_FREQUENCY_HZ, cpu_cls=CPU):
+    """
+    Run jobs across a pool of worker processes, yielding results as they finish
+    :param jobs: iterable of Job
+    :param workers: number of worker processes (default: one per core)
+    :param chunksize: number of jobs handed to a worker at a time; raise it for many short jobs
+    :param cpu_freq_hz: instructions per second of emulated time
+    :param io_freq_hz: frames per second of emulated time
+    :param cpu_cls: execution engine, e.g. CPU or chip8.jit.JitCPU
+    :return: generator of JobResult, in completion order
+    """
+    vm_args = {"cpu_freq_hz": cpu_freq_hz, "io_freq_hz": io_freq_hz, "cpu_cls": cpu_cls}
+    with multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(vm_args,)) as pool:
+        for result in pool.imap_unordered(_run_job_in_worker, jobs, chunksize=chunksize):
+            yield result
@@ -0,0 +1,108 @@
+import struct
+
+
+class FrameBuffer:
+    """
+    The 64 x 32 monochrome CHIP-8 screen, held in memory.  Each row is packed into
+    one WIDTH-bit integer, with x = 0 in the most significant bit, so a sprite row is
+    drawn with a shift, a wraparound mask, an AND (for collision) and an XOR.  Screen
+    backends subclass this and implement draw() to show the buffer somewhere.
+    """
+    WIDTH = 64
+    HEIGHT = 32
+    ROW_MASK = 2 ** WIDTH - 1
+    SPRITE_WIDTH = 8
+    PACKED_ROWS = struct.Struct(">{}Q".format(HEIGHT))  # one big endian 64-bit integer per row
+
+    def __init__(self):
+        self.rows = [0] * self.HEIGHT
+        self.dirty_rows = set(range(self.HEIGHT))   # rows changed since the last draw
+
+    def clear(self):
+        """
+        Clears the screen buffer
+        :return:
+        """
+        for y, row in enumerate(self.rows):
+            if row:
+                self.dirty_rows.add(y)
+        self.rows = [0] * self.HEIGHT
+
+    def draw(self):
+        """
+        Show the screen buffer; nothing to do for a plain buffer
+        :return:
+        """
+        self.dirty_rows.clear()
+
+    def get(self, x, y):
+        """
+        Get the value of the screen (buffer) at (x, y)
+        :param x:
+        :param y:
+        :return:
+        """
+        return (self.rows[y % self.HEIGHT] >> (self.WIDTH - 1 - x % self.WIDTH)) & 1
+
+    def set(self, x, y, v):
+        """
+        Set the value of the screen buffer at (x, y) to v.  v must be 0 or 1
+        :param x:
+        :param y:
+        :param v:
+        :return:
+        """
+        if v > 1:
+            raise ValueError("Screen values must be 0 or 1; got {}".format(v))
+        y %= self.HEIGHT
+        bit = 1 << (self.WIDTH - 1 - x % self.WIDTH)
+        row = (self.rows[y] | bit) if v else (self.rows[y] & ~bit)
+        if row != self.rows[y]:
+            self.rows[y] = row
+            self.dirty_rows.add(y)
+
+    def xor_sprite_row(self, x, y, sprite_byte):
+        """
+        XOR one 8-pixel row of a sprite into the screen with its left edge at (x, y),
+        wrapping around the edges of the screen
+        :param x:
+        :param y:
+        :param sprite_byte: the sprite row, most significant bit leftmost
+        :return: True if any pixel that was on has been turned off (a collision)
+        """
+        y %= self.HEIGHT
+        x %= self.WIDTH
+        bits = sprite_byte << (self.WIDTH - self.SPRITE_WIDTH)
+        bits = ((bits >> x) | (bits << (self.WIDTH - x))) & self.ROW_MASK
+        row = self.rows[y]
+        if bits:
+            self.rows[y] = row ^ bits
+            self.dirty_rows.add(y)
+        return (row & bits) != 0
+
+    def get_framebuffer(self):
+        """
+        Get a copy of the screen contents
+        :return: bytes of WIDTH * HEIGHT pixel values (0 or 1), row by row
+        """
+        shifts = range(self.WIDTH - 1, -1, -1)
+        return bytes((row >> shift) & 1 for row in self.rows for shift in shifts)
+
+    def get_packed(self):
+        """
+        Get a compact copy of the screen contents
+        :return: bytes with each row as a big endian WIDTH-bit integer, top row first
+        """
+        return self.PACKED_ROWS.pack(*self.rows)
+
+    def set_packed(self, packed):
+        """
+        Set the screen contents from the form returned by get_packed
+        :param packed: bytes-like object
+        :return:
+        """
+        rows = list(self.PACKED_ROWS.unpack(packed))
+        for y in range(self.HEIGHT):
+            if rows[y] != self.rows[y]:
+                self.dirty_rows.add(y)
+        self.rows = rows
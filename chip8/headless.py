@@ -0,0 +1,62 @@
+"""
+Screen and keyboard backends that need no display, for running ROMs on
+batch/CI machines.
+"""
+from .framebuffer import FrameBuffer
+from .keyboard import Keyboard
+
+
+class NullScreen(FrameBuffer):
+    """
+    Screen that keeps the framebuffer (so sprite collisions work) but never shows it
+    """
+    pass
+
+
+class BufferScreen(FrameBuffer):
+    """
+    Screen that counts the frames drawn and can keep a copy of each one
+    """
+
+    def __init__(self, keep_frames=False):
+        super().__init__()
+        self.keep_frames = keep_frames
+        self.frames_drawn = 0
+        self.frames = []
+
+    def draw(self):
+        super().draw()
+        self.frames_drawn += 1
+        if self.keep_frames:
+            self.frames.append(self.get_framebuffer())
+
+
+class ScriptedKeyboard(Keyboard):
+    """
+    Keyboard that plays back a script of key changes.  The script is a sequence of
+    (frame, key, pressed) tuples, in frame order; each change is applied by the
+    key_reader call for that frame (frames are counted from 0).
+    """
+
+    def __init__(self, script=()):
+        super().__init__()
+        self.script = sorted(script, key=lambda event: event[0])
+        self.frame = 0
+        self._next_event = 0
+
+    def _apply_events(self, frame):
+        """
+        Apply all scripted changes up to and including those for the given frame
+        """
+        while self._next_event < len(self.script) and self.script[self._next_event][0] <= frame:
+            _, key, pressed = self.script[self._next_event]
+            self.set_key(key, pressed)
+            self._next_event += 1
+
+    def key_reader(self):
+        """
+        Apply the scripted key changes for the current frame and move on to the next frame
+        :return:
+        """
+        self._apply_events(self.frame)
+        self.frame += 1
@@ -0,0 +1,195 @@
+"""
+Recording and replay of keyboard input, for reproducing runs exactly.
+
+A run with a virtual clock is determined by the ROM, the RND seed and the keyboard,
+so an input log holds just the seed and a cycle-stamped record of every key change:
+
+    vm = Chip8VM(virtual_clock=True)
+    vm.load_rom("roms/INVADERS")
+    vm.start_recording("invaders.c8in")
+    vm.run()
+
+    vm = Chip8VM.headless()
+    vm.load_rom("roms/INVADERS")
+    result = vm.replay("invaders.c8in")
+
+Logs are written as the run goes and read back in blocks, so their length is not
+limited by memory.
+"""
+import struct
+
+from .keyboard import Keyboard
+
+INPUT_LOG_MAGIC = b"C8IN"
+INPUT_LOG_VERSION = 2
+INPUT_LOG_HEADER = struct.Struct("<4sHQIH20s")  # magic, version, seed, clock Hz, I/O Hz, ROM sha1
+INPUT_LOG_EVENT = struct.Struct("<QBB")         # cycle, key, kind
+READ_BLOCK_EVENTS = 4096
+
+# Event kinds
+KEY_RELEASE = 0     # key went up
+KEY_PRESS = 1       # key went down
+LOG_END = 3         # end of the recording; the cycle is the total run length
+
+
+class InputLogWriter:
+    """
+    Writes an input log to a file as events happen
+    """
+
+    def __init__(self, filename, seed, clock_hz, io_freq_hz, rom_hash=None):
+        """
+        :param filename: file to write
+        :param seed: seed of the CPU's RND generator
+        :param clock_hz: virtual clock rate of the CPU
+        :param io_freq_hz: keyboard reads per second
+        :param rom_hash: sha1 digest of the program, so that replay can check it has the same one
+        """
+        self.filename = filename
+        self._file = open(filename, "wb")
+        self._file.write(INPUT_LOG_HEADER.pack(INPUT_LOG_MAGIC, INPUT_LOG_VERSION, seed, clock_hz,
+                                               io_freq_hz, rom_hash or bytes(20)))
+
+    def event(self, cycle, key, kind):
+        self._file.write(INPUT_LOG_EVENT.pack(cycle, key, kind))
+
+    def close(self, cycle):
+        """
+        Write the end of the log and close the file
+        :param cycle: number of cycles the recorded run lasted
+        :return:
+        """
+        self.event(cycle, 0, LOG_END)
+        self._file.close()
+
+
+class InputLogReader:
+    """
+    Reads an input log written by InputLogWriter
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        header = self._file.read(INPUT_LOG_HEADER.size)
+        if len(header) != INPUT_LOG_HEADER.size:
+            raise ValueError("{} is not a chip8 input log".format(filename))
+        magic, version, self.seed, self.clock_hz, self.io_freq_hz, rom_hash = INPUT_LOG_HEADER.unpack(header)
+        if magic != INPUT_LOG_MAGIC:
+            raise ValueError("{} is not a chip8 input log".format(filename))
+        if version != INPUT_LOG_VERSION:
+            raise ValueError("Unsupported input log version {} (expected {})".format(version, INPUT_LOG_VERSION))
+        self.rom_hash = None if rom_hash == bytes(20) else rom_hash
+
+    def events(self):
+        """
+        Generator of the logged (cycle, key, kind) events, in order, ending with the LOG_END event
+        """
+        try:
+            while True:
+                block = self._file.read(INPUT_LOG_EVENT.size * READ_BLOCK_EVENTS)
+                whole = len(block) - len(block) % INPUT_LOG_EVENT.size
+                for event in INPUT_LOG_EVENT.iter_unpack(block[:whole]):
+                    yield event
+                    if event[2] == LOG_END:
+                        return
+                if len(block) < INPUT_LOG_EVENT.size * READ_BLOCK_EVENTS:
+                    raise ValueError("Input log {} ends without an end record".format(self.filename))
+        finally:
+            self._file.close()
+
+
+class RecordingKeyboard:
+    """
+    Wraps a keyboard backend, logging every change of key state it makes.  Changes are
+    logged as the backend applies them, so a press and release within one key_reader
+    call (which may still end an Fx0A wait) are both logged.
+    """
+
+    def __init__(self, keyboard, writer, clock):
+        """
+        :param keyboard: the keyboard backend to record
+        :param writer: InputLogWriter
+        :param clock: callable returning the current CPU cycle count
+        """
+        self.keyboard = keyboard
+        self.writer = writer
+        self.clock = clock
+        self._logged = [0] * 16     # key state as of the last logged event
+        keyboard.key_listener = self._log_key
+
+    def detach(self):
+        """
+        Stop recording
+        :return: the wrapped keyboard backend
+        """
+        self.keyboard.key_listener = None
+        return self.keyboard
+
+    @property
+    def key_pressed(self):
+        return self.keyboard.key_pressed
+
+    def key_reader(self):
+        self.keyboard.key_reader()
+        self._log_changes()
+
+    @property
+    def events(self):
+        return self.keyboard.events
+
+    def handle_event(self, event, timestamp):
+        return self.keyboard.handle_event(event, timestamp)
+
+    def set_key(self, k, pressed):
+        self.keyboard.set_key(k, pressed)
+
+    def is_pressed(self, k):
+        return self.keyboard.is_pressed(k)
+
+    def begin_key_wait(self):
+        self.keyboard.begin_key_wait()
+
+    def key_press(self):
+        return self.keyboard.key_press()
+
+    def _log_key(self, k, pressed):
+        self._logged[k] = pressed
+        self.writer.event(self.clock(), k, KEY_PRESS if pressed else KEY_RELEASE)
+
+    def _log_changes(self):
+        # backends that write key_pressed directly rather than through set_key
+        cycle = self.clock()
+        pressed = self.keyboard.key_pressed
+        for key in range(16):
+            if bool(pressed[key]) != self._logged[key]:
+                self._logged[key] = int(bool(pressed[key]))
+                self.writer.event(cycle, key, KEY_PRESS if self._logged[key] else KEY_RELEASE)
+
+
+class ReplayKeyboard(Keyboard):
+    """
+    Keyboard that plays back the events of an input log.  Key changes are applied by
+    Chip8VM.replay at the cycles they were logged at.
+    """
+
+    def __init__(self, events):
+        """
+        :param events: iterator of (cycle, key, kind) events, e.g. InputLogReader.events()
+        """
+        super().__init__()
+        self._events = events
+        self.next_event = next(self._events, None)    # the next key change or the end of the log
+        if self.next_event is None:
+            raise ValueError("Input log ends without an end record")
+
+    def apply_next(self):
+        """
+        Apply the next key change and read ahead to the one after it
+        :return:
+        """
+        _, key, kind = self.next_event
+        self.set_key(key, kind == KEY_PRESS)
+        self.next_event = next(self._events, None)
+        if self.next_event is None:
+            raise ValueError("Input log ends without an end record")
@@ -0,0 +1,47 @@
+"""
+Swapping a CPU's execution loop for an instrumented one (used by the profiler and the
+tracer).  Rather than the normal loop checking whether it is being watched, the CPU's
+class is switched to a generated subclass with a different _execute, and switched back
+afterwards, so instrumentation costs nothing while it is off.  A CPU has one
+instrumented loop at a time, so it can be profiled or traced but not both at once.
+"""
+
+_instrumented_classes = {}      # (CPU class, _execute function) -> generated subclass
+
+
+def _run_idle_loops(self, cycles):
+    """
+    Replaces CPU._skip_idle_loop, so that instrumented CPUs see every instruction
+    """
+    return False
+
+
+def instrument(cpu, execute, prefix):
+    """
+    Switch a CPU to a subclass of its class that runs instructions with execute
+    :param cpu: CPU, or an instance of a subclass such as JitCPU
+    :param execute: replacement for CPU._execute
+    :param prefix: added to the class name of the subclass, e.g. "Profiled"
+    :return:
+    """
+    cls = type(cpu)
+    if is_instrumented(cpu):
+        raise ValueError("CPU is already instrumented ({})".format(cls.__name__))
+    key = (cls, execute)
+    if key not in _instrumented_classes:
+        _instrumented_classes[key] = type(prefix + cls.__name__, (cls,),
+                                          {"__slots__": (), "_execute": execute, "_skip_idle_loop": _run_idle_loops,
+                                           "_uninstrumented_class": cls})
+    cpu.__class__ = _instrumented_classes[key]
+
+
+def uninstrument(cpu):
+    """
+    Switch an instrumented CPU back to its original class
+    """
+    if is_instrumented(cpu):
+        cpu.__class__ = type(cpu)._uninstrumented_class
+
+
+def is_instrumented(cpu):
+    return "_uninstrumented_class" in type(cpu).__dict__
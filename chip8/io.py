@@ -1,120 +1,172 @@
-import pygame
-
-DEFAULT_KEY_MAP = {
-    pygame.K_3: 0x1,
-    pygame.K_4: 0x2,
-    pygame.K_5: 0x3,
-    pygame.K_6: 0xC,
-    pygame.K_e: 0x4,
-    pygame.K_r: 0x5,
-    pygame.K_t: 0x6,
-    pygame.K_y: 0xD,
-    pygame.K_d: 0x7,
-    pygame.K_f: 0x8,
-    pygame.K_g: 0x9,
-    pygame.K_h: 0xE,
-    pygame.K_c: 0xA,
-    pygame.K_v: 0x0,
-    pygame.K_b: 0xB,
-    pygame.K_n: 0xF
+import collections
+import importlib
+
+from .framebuffer import FrameBuffer
+from .keyboard import Keyboard
+
+# pygame key name -> CHIP-8 key
+DEFAULT_KEY_NAMES = {
+    "K_3": 0x1,
+    "K_4": 0x2,
+    "K_5": 0x3,
+    "K_6": 0xC,
+    "K_e": 0x4,
+    "K_r": 0x5,
+    "K_t": 0x6,
+    "K_y": 0xD,
+    "K_d": 0x7,
+    "K_f": 0x8,
+    "K_g": 0x9,
+    "K_h": 0xE,
+    "K_c": 0xA,
+    "K_v": 0x0,
+    "K_b": 0xB,
+    "K_n": 0xF
 }
 
+pygame = None   # the pygame module, once init_pygame has imported it
 
-class PyGameKeyboard:
-    def __init__(self, key_map=DEFAULT_KEY_MAP):
-        self.key_pressed = [0] * 16   # array to store key status 0x0 to 0xF
-        self.key_map = key_map
 
-    def key_reader(self):
+def init_pygame():
+    """
+    Import pygame and start its display subsystem, which also delivers keyboard input.
+    pygame is only loaded when a pygame backend is made, and the other SDL subsystems
+    (audio, joystick, ...) are never started, so CPU-only use does not pay for them.
+    :return: the pygame module
+    """
+    global pygame
+    if pygame is None:
+        pygame = importlib.import_module("pygame")
+    if not pygame.display.get_init():
+        pygame.display.init()
+    return pygame
+
+
+class PyGameKeyboard(Keyboard):
+    """
+    Keyboard driven by pygame key events.  Chip8VM.run passes it each KEYDOWN / KEYUP,
+    stamped with the time it was read, and applies the queued changes at the points in
+    the instruction stream that match their times; key_reader applies any that are left.
+    Nothing is polled, and a tap shorter than a frame is still seen.
+
+    Until something passes it a key or focus event, e.g. when it is used on its own in a
+    loop that handles the events itself, key_reader polls pygame's key state instead.
+    """
+
+    def __init__(self, key_map=None):
         """
-        Read the keyboard and put the status of the keys into the key_pressed array
-        :return:
+        :param key_map: dict of pygame key code -> CHIP-8 key (default: DEFAULT_KEY_NAMES)
         """
-        keys = pygame.key.get_pressed()
-        for k, v in self.key_map.items():
-            self.key_pressed[v] = keys[k]
+        super().__init__()
+        init_pygame()
+        if key_map is None:
+            key_map = {getattr(pygame, name): key for name, key in DEFAULT_KEY_NAMES.items()}
+        self.key_map = key_map
+        self.events = collections.deque()   # (timestamp, key, pressed), oldest first
+        self._fed = False   # has handle_event been given a key or focus event?
 
-    def is_pressed(self, k):
-        return self.key_pressed[k]
+    def handle_event(self, event, timestamp):
+        """
+        Queue the key change made by a pygame event.  Losing the window's focus releases
+        every key, since their key up events will go elsewhere.
+        :param event: pygame event
+        :param timestamp: time.perf_counter() time it was read at
+        :return: True if it queued a key change
+        """
+        if event.type == pygame.WINDOWFOCUSLOST:
+            self._fed = True
+            held = [k for k in range(self.NUM_KEYS) if self.key_pressed[k]]
+            self.events.extend((timestamp, k, 0) for k in held)
+            return bool(held)
+        if event.type != pygame.KEYDOWN and event.type != pygame.KEYUP:
+            return False
+        self._fed = True
+        key = self.key_map.get(event.key)
+        if key is None:
+            return False
+        self.events.append((timestamp, key, int(event.type == pygame.KEYDOWN)))
+        return True
 
-    def wait_for_key(self, callbacks=[]):
+    def key_reader(self):
         """
-        Waits for a key to be pressed, and once one is, returns its code.
-        Run callbacks every checking loop (these should be fast to run)
-        :return: code of the pressed key
+        Apply the key changes still queued, or if nothing passes events to handle_event,
+        read pygame's key state
+        :return:
         """
-        pygame.event.clear()
-        while True:
-            # the timeout will give the callbacks a chance to run
-            event = pygame.event.wait(timeout=10)
-            if event.type == pygame.QUIT:
-                pygame.quit()
-            elif event.type == pygame.KEYDOWN:
-                if event.key in self.key_map:
-                    return self.key_map[event.key]
-
-            for callback in callbacks:
-                callback()
-
-class PyGameScreen:
-    WIDTH = 64
-    HEIGHT = 32
+        if not self._fed:
+            pygame.event.pump()
+            keys = pygame.key.get_pressed()
+            for k, v in self.key_map.items():
+                self.set_key(v, keys[k])
+        while self.events:
+            _, key, pressed = self.events.popleft()
+            self.set_key(key, pressed)
 
+
+class PyGameScreen(FrameBuffer):
     COLOR_ON = (205, 205, 255)
     COLOR_OFF = (0, 0, 0)
 
 
     def __init__(self, scale=10):
-        self.buffer = [0] * self.WIDTH * self.HEIGHT
+        super().__init__()
+        init_pygame()
         self.scale = scale
         self.screen = pygame.display.set_mode([self.WIDTH * self.scale,
                                                self.HEIGHT * self.scale])
 
-    def clear(self):
+        # each lit pixel is drawn as a circle that is a bit bigger than its cell, so
+        # pre-render it once and blit it; pixels within reach rows of a changed row
+        # overlap that row's band of the window, and vice versa
+        self._offset = int(self.scale / 2)
+        self._radius = int(self.scale / 2) + 2
+        self._stamp = self._make_stamp()
+        self._reach = max((self._offset + self._radius) // self.scale,
+                          (self.scale - self._offset + self._radius - 1) // self.scale)
+
+    def _make_stamp(self):
         """
-        Clears the screen buffer
-        :return:
+        Pre-render the circle drawn for a lit pixel
+        :return: surface, with COLOR_OFF transparent
         """
-        self.buffer = [0] * self.WIDTH * self.HEIGHT
-        #self.screen.fill(self.COLOR_OFF)
-        #pygame.display.flip()
+        size = 2 * self._radius + 2
+        stamp = pygame.Surface((size, size)).convert()
+        stamp.fill(self.COLOR_OFF)
+        pygame.draw.circle(stamp,
+                           center=(self._radius, self._radius),
+                           radius=self._radius,
+                           color=self.COLOR_ON)
+        stamp.set_colorkey(self.COLOR_OFF)
+        return stamp
 
     def draw(self):
-        self.screen.fill(self.COLOR_OFF)
-        for x in range(self.WIDTH):
-            for y in range(self.HEIGHT):
-                #color = self.COLOR_ON if self.get(x, y) else self.COLOR_OFF
-                #pygame.draw.rect(self.screen,
-                #                 rect=pygame.Rect(x * self.scale,
-                #                                  y * self.scale,
-                #                                  self.scale - 1,
-                #                                  self.scale - 1),
-                #                                  color=color)
-                if self.get(x, y):
-                    pygame.draw.circle(self.screen,
-                                       center=(x * self.scale + int(self.scale / 2),
-                                               y * self.scale + int(self.scale / 2)),
-                                       radius=int(self.scale / 2) + 2,
-                                       color=self.COLOR_ON)
-        pygame.display.flip()
-
-    def get(self, x, y):
         """
-        Get the value of the screen (buffer) at (x, y)
-        :param x:
-        :param y:
+        Redraw the bands of the window affected by rows that changed since the last draw,
+        and update just those bands on the display.  Does nothing if nothing has changed.
         :return:
         """
-        return self.buffer[(y % self.HEIGHT) * self.WIDTH + (x % self.WIDTH)]
+        if not self.dirty_rows:
+            return
 
-    def set(self, x, y, v):
-        """
-        Set the value of the screen buffer at (x, y) to v.  v must be 0 or 1
-        :param x:
-        :param y:
-        :param v:
-        :return:
-        """
-        if v > 1:
-            raise ValueError("Screen values must be 0 or 1; got {}".format(v))
-        self.buffer[(y % self.HEIGHT) * self.WIDTH + (x % self.WIDTH)] = v
+        bands = set()
+        for y in self.dirty_rows:
+            bands.update(range(max(0, y - self._reach), min(self.HEIGHT, y + self._reach + 1)))
+        self.dirty_rows.clear()
+
+        rects = []
+        for band in sorted(bands):
+            rect = pygame.Rect(0, band * self.scale, self.WIDTH * self.scale, self.scale)
+            self.screen.set_clip(rect)
+            self.screen.fill(self.COLOR_OFF, rect)
+            for y in range(max(0, band - self._reach), min(self.HEIGHT, band + self._reach + 1)):
+                row = self.rows[y]
+                while row:
+                    # lit pixels, taken from the most significant (leftmost) bit down
+                    bit = row.bit_length() - 1
+                    row ^= 1 << bit
+                    x = self.WIDTH - 1 - bit
+                    self.screen.blit(self._stamp, (x * self.scale + self._offset - self._radius,
+                                                   y * self.scale + self._offset - self._radius))
+            rects.append(rect)
+        self.screen.set_clip(None)
+        pygame.display.update(rects)
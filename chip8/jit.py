@@ -0,0 +1,281 @@
+"""
+Basic-block translation cache for the CHIP-8 CPU.
+
+Straight-line runs of instructions (basic blocks) are translated into Python source,
+compiled into a single function and cached by their start address.  A block ends at
+the first instruction that changes control flow (jump, call, skip, return), waits for
+a key or writes to memory, so a block never has to re-check the code it is running.
+When the cycle budget of a run ends part way through a block (in virtual time mode every
+stretch between timer decrements does), a shorter block covering just the instructions
+that fit is compiled and cached alongside it, so budgets are met without falling back
+to the interpreter.
+
+The code of compiled blocks can be exported and imported again (see export_blocks), so
+that a ROM's blocks are translated and compiled only once across runs (see chip8.library).
+"""
+import marshal
+import types
+
+from .cpu import CPU
+from .decoder import decode
+
+# Instructions that are translated into inline Python.  Operands are substituted for
+# {0}, {1}...; the block function has the locals cpu, V (registers) and ram.
+INLINE_TEMPLATES = {
+    "sys_call": [],
+    "nop": [],
+    "loadv": ["V[{0}] = {1}"],
+    "add": ["V[{0}] = (V[{0}] + {1}) & 0xFF"],
+    "loadr": ["V[{0}] = V[{1}]"],
+    "orr": ["V[{0}] = V[{0}] | V[{1}]"],
+    "andr": ["V[{0}] = V[{0}] & V[{1}]"],
+    "xorr": ["V[{0}] = V[{0}] ^ V[{1}]"],
+    "addr": ["V[15] = V[{0}] + V[{1}] > 255",
+             "V[{0}] = (V[{0}] + V[{1}]) & 0xFF"],
+    "subr": ["V[15] = V[{0}] > V[{1}]",
+             "V[{0}] = (V[{0}] - V[{1}]) & 0xFF"],
+    "shift_rightr": ["V[15] = V[{0}] & 0x01",
+                     "V[{0}] >>= 1"],
+    "subnr": ["V[15] = V[{1}] > V[{0}]",
+              "V[{0}] = (V[{1}] - V[{0}]) & 0xFF"],
+    "shift_leftr": ["V[15] = V[{0}] >= 128",
+                    "V[{0}] = (V[{0}] << 1) & 0xFF"],
+    "load_memory_register": ["cpu.I = {0}"],
+    "read_delay_timer": ["V[{0}] = cpu.DT"],
+    "set_delay_timer": ["cpu.DT = V[{0}]"],
+    "set_sound_timer": ["cpu.ST = V[{0}]"],
+    "add_to_I": ["cpu.I += V[{0}]"],
+    "set_I_to_digit_sprite": ["cpu.I = 5 * V[{0}]"],
+}
+
+# Instructions that end a basic block: they change (or may change) the PC, block
+# waiting for input, or write to memory that may hold code
+BLOCK_TERMINATORS = frozenset([
+    "ret", "jump", "call", "jump_add",
+    "skip_if_equalv", "skip_if_not_equalv", "skip_if_equalr", "skip_if_not_equalr",
+    "skip_if_key_pressed", "skip_if_key_not_pressed",
+    "wait_and_load_key", "set_mem_to_bcd", "store_to_mem",
+])
+
+MAX_BLOCK_INSTRUCTIONS = 64
+INVALIDATION_PAGE_BYTES = 64
+BLOCK_CODE_VERSION = 1      # bump when translation changes, so that exported block code is redone
+
+
+class JitCPU(CPU):
+    """
+    CPU that runs cached, compiled basic blocks rather than single instructions.
+    Behaves exactly like CPU.  Use run_cycles to get the benefit; tick still runs
+    one instruction.
+
+    How much faster it is depends on the clock rate.  At 1 MHz, run_cycles stretches are
+    long and whole blocks run back to back: ALU-heavy code runs about 4.7 times as fast
+    as on CPU, and jumps and memory access run 1.4 to 2.5 times as fast.  At the default
+    1 kHz the timers decrement every 16 or 17 instructions, and each stretch ends in a
+    prefix block and timer bookkeeping that both engines share, so the gain in the
+    benchmarks (benchmarks.run) is 1.1 to 3 times.  Sprite drawing costs the same
+    on both engines, so draw-heavy code gains next to nothing at either rate.
+    """
+
+    __slots__ = ("_blocks", "_prefix_blocks", "_page_blocks")
+
+    def __init__(self, keyboard=None, screen=None, clock_hz=None, seed=None):
+        self._blocks = {}       # start address -> (block function, number of instructions)
+        self._prefix_blocks = {}    # start address -> {number of instructions: block function},
+                                    # for the first instructions of the block starting there
+        self._page_blocks = {}  # page number -> set of start addresses of blocks touching the page
+        super().__init__(keyboard=keyboard, screen=screen, clock_hz=clock_hz, seed=seed)
+
+    def _execute(self, cycles):
+        """
+        Run instructions a whole basic block at a time, without updating the timers
+        :param cycles: number of instructions to run
+        :return:
+        """
+        blocks = self._blocks
+        V = self.V
+        ram = self.ram
+        while cycles > 0:
+            block = blocks.get(self.PC)
+            if block is None:
+                block = self._compile_block(self.PC)
+                if block is None:
+                    # no block can start here (e.g. PC out of range); let the interpreter deal with it
+                    super()._execute(1)
+                    cycles -= 1
+                    continue
+            fn, length = block
+            if length > cycles:
+                # not enough of the budget left for the whole block; run as much of it as fits
+                self._prefix_block(self.PC, cycles)(self, V, ram)
+                return
+            fn(self, V, ram)
+            cycles -= length
+
+    def _prefix_block(self, start, length):
+        """
+        The block function for the first length instructions of the cached block starting
+        at address start, compiled the first time it is needed
+        """
+        prefixes = self._prefix_blocks.setdefault(start, {})
+        fn = prefixes.get(length)
+        if fn is None:
+            fn = prefixes[length] = self._compile(start, *self.block_source(start, length))
+        return fn
+
+    def block_source(self, start, max_instructions=MAX_BLOCK_INSTRUCTIONS):
+        """
+        Translate the basic block starting at address start into Python source
+        :param start: address of the first instruction of the block
+        :param max_instructions: end the block after this many instructions
+        :return: (source, number of instructions) or None if no block can start at that address
+        """
+        max_addr = self.RAM_SIZE_BYTES - 2
+        if start >= max_addr:
+            return None
+
+        lines = ["def block(cpu, V, ram):"]
+        addr = start
+        length = 0
+        while addr < max_addr and length < max_instructions:
+            name, args, increment_pc = decode((self.ram[addr] << 8) | self.ram[addr + 1])
+            length += 1
+            if name in INLINE_TEMPLATES:
+                lines.extend("    " + line.format(*args) for line in INLINE_TEMPLATES[name])
+            elif name == "read_mem":
+                # unrolled register load; PC is set first so that errors report the right instruction
+                lines.append("    cpu.PC = {}".format(addr))
+                lines.append("    I = cpu.I")
+                lines.extend("    V[{0}] = ram[I + {0}]".format(i) for i in range(args[0] + 1))
+            else:
+                # everything else runs through the CPU method so that behaviour is identical
+                lines.append("    cpu.PC = {}".format(addr))
+                lines.append("    cpu.{}({})".format(name, ", ".join(str(a) for a in args)))
+                if name in BLOCK_TERMINATORS:
+                    if increment_pc:
+                        lines.append("    cpu.PC += 2")
+                    break
+            addr += 2
+        else:
+            # the block ran into its size limit or the end of memory
+            lines.append("    cpu.PC = {}".format(addr))
+        return "\n".join(lines) + "\n", length
+
+    def _compile_block(self, start):
+        """
+        Translate and compile the block starting at address start and add it to the cache
+        :return: (block function, number of instructions) or None if no block can start there
+        """
+        translated = self.block_source(start)
+        if translated is None:
+            return None
+        source, length = translated
+        return self._add_block(start, self._compile(start, source, length), length)
+
+    def _add_block(self, start, fn, length):
+        """
+        Add a compiled block to the cache
+        :return: (block function, number of instructions)
+        """
+        block = (fn, length)
+        self._blocks[start] = block
+        for page in range(start // INVALIDATION_PAGE_BYTES, (start + 2 * length - 1) // INVALIDATION_PAGE_BYTES + 1):
+            self._page_blocks.setdefault(page, set()).add(start)
+        return block
+
+    @staticmethod
+    def _compile(start, source, length):
+        """
+        :return: the block function defined by source
+        """
+        namespace = {}
+        exec(compile(source, "<chip8 block 0x{:03X} ({})>".format(start, length), "exec"), namespace)
+        return namespace["block"]
+
+    def precompile(self, analysis):
+        """
+        Compile ahead of time a block at the start of each basic block found by static
+        analysis of the loaded program, rather than as execution first reaches them
+        :param analysis: chip8.analysis.RomAnalysis of the loaded program
+        :return:
+        """
+        for start in analysis.blocks:
+            if start not in self._blocks:
+                self._compile_block(start)
+
+    def export_blocks(self, start=0, end=None):
+        """
+        The code of the cached blocks that lie wholly within [start, end), as bytes that can
+        be saved and given to import_blocks later, by this or another process running the
+        same Python version
+        :param start: first address
+        :param end: one past the last address (default: end of RAM)
+        :return: {start address: (marshalled code of the block function, number of instructions)}
+        """
+        if end is None:
+            end = self.RAM_SIZE_BYTES
+        return {block_start: (marshal.dumps(fn.__code__), length)
+                for block_start, (fn, length) in self._blocks.items()
+                if start <= block_start and block_start + 2 * length <= end}
+
+    def import_blocks(self, blocks):
+        """
+        Add blocks exported by export_blocks to the cache without translating or compiling
+        them.  The RAM they cover must hold the code it held when they were exported.
+        :param blocks: {start address: (marshalled code, number of instructions)}
+        :return:
+        """
+        for start, (code, length) in blocks.items():
+            if start not in self._blocks:
+                self._add_block(start, types.FunctionType(marshal.loads(code), {}), length)
+
+    def invalidate_blocks(self, start=0, end=None):
+        """
+        Drop every cached block that covers any of the bytes in [start, end).  Must be
+        called after writing to RAM other than through the CPU's own instructions.
+        :param start: first address written
+        :param end: one past the last address written (default: end of RAM)
+        :return:
+        """
+        if end is None:
+            end = self.RAM_SIZE_BYTES
+        for page in range(start // INVALIDATION_PAGE_BYTES, (end - 1) // INVALIDATION_PAGE_BYTES + 1):
+            for block_start in list(self._page_blocks.get(page, ())):
+                if block_start in self._blocks:
+                    length = self._blocks[block_start][1]
+                    if block_start < end and start < block_start + 2 * length:
+                        self._drop_block(block_start)
+
+    def _drop_block(self, start):
+        """
+        Remove a block from the cache
+        """
+        _, length = self._blocks.pop(start)
+        self._prefix_blocks.pop(start, None)
+        for page in range(start // INVALIDATION_PAGE_BYTES, (start + 2 * length - 1) // INVALIDATION_PAGE_BYTES + 1):
+            self._page_blocks[page].discard(start)
+
+    def load_program(self, bytecode):
+        super().load_program(bytecode)
+        self.invalidate_blocks(self.PROGRAM_START_ADDR, self.PROGRAM_START_ADDR + len(bytecode))
+
+    def restore(self, snapshot):
+        # only the blocks covering RAM that the snapshot changes need to go
+        start = self.SNAPSHOT_RAM_OFFSET
+        if self.ram == snapshot[start:start + self.RAM_SIZE_BYTES]:
+            super().restore(snapshot)
+            return
+        changed = [page for page in range(self.RAM_SIZE_BYTES // INVALIDATION_PAGE_BYTES)
+                   if self.ram[page * INVALIDATION_PAGE_BYTES:(page + 1) * INVALIDATION_PAGE_BYTES] !=
+                   snapshot[start + page * INVALIDATION_PAGE_BYTES:start + (page + 1) * INVALIDATION_PAGE_BYTES]]
+        super().restore(snapshot)
+        for page in changed:
+            self.invalidate_blocks(page * INVALIDATION_PAGE_BYTES, (page + 1) * INVALIDATION_PAGE_BYTES)
+
+    def set_mem_to_bcd(self, register):
+        super().set_mem_to_bcd(register)
+        self.invalidate_blocks(self.I, self.I + 3)
+
+    def store_to_mem(self, register_to):
+        super().store_to_mem(register_to)
+        self.invalidate_blocks(self.I, self.I + register_to + 1)
@@ -0,0 +1,65 @@
+class Keyboard:
+    """
+    Key state common to the keyboard backends, and the key wait used by Fx0A.  Backends
+    set the state of keys through set_key, which notices the presses that end a wait.
+    """
+    NUM_KEYS = 16
+    events = None   # event-driven backends: queue of timestamped key changes (see PyGameKeyboard)
+    key_listener = None     # if set, called as key_listener(k, pressed) for every change of a key's state
+
+    def __init__(self):
+        self.key_pressed = [0] * self.NUM_KEYS   # array to store key status 0x0 to 0xF
+        self._waiting = False       # has a key wait begun?
+        self._wait_presses = set()  # keys pressed since the wait began
+
+    def set_key(self, k, pressed):
+        """
+        Set the state of a key
+        :param k: key code, 0x0 to 0xF
+        :param pressed: is it down?
+        :return:
+        """
+        pressed = int(bool(pressed))
+        if pressed == self.key_pressed[k]:
+            return
+        if pressed and self._waiting:
+            self._wait_presses.add(k)
+        self.key_pressed[k] = pressed
+        if self.key_listener is not None:
+            self.key_listener(k, pressed)
+
+    def key_reader(self):
+        """
+        Read the keyboard into key_pressed; called once per I/O frame
+        :return:
+        """
+        pass
+
+    def handle_event(self, event, timestamp):
+        """
+        Take an input event from the window system; backends that are not event-driven
+        ignore them
+        :param event: the event
+        :param timestamp: time.perf_counter() time it was read at
+        :return: True if it was a key change for this keyboard
+        """
+        return False
+
+    def is_pressed(self, k):
+        return self.key_pressed[k]
+
+    def begin_key_wait(self):
+        """
+        Start waiting for a key press; only keys pressed from now on end the wait
+        :return:
+        """
+        self._waiting = True
+        self._wait_presses.clear()
+
+    def key_press(self):
+        """
+        :return: the code of a key pressed since begin_key_wait, or None if there has not
+                 been one yet.  If several have been pressed, the lowest code wins, so that
+                 the result does not depend on the order a backend reads keys in.
+        """
+        return min(self._wait_presses) if self._wait_presses else None
@@ -0,0 +1,277 @@
+"""
+A ROM library: the ROMs in a directory, indexed by the sha1 of their contents, with the
+work of analysing them kept in an on-disk cache between runs.
+
+    library = RomLibrary("roms", cache_dir="~/.cache/chip8")
+    vm = Chip8VM.headless()
+    library.load(vm, "INVADERS")        # by file name, or by sha1
+    vm.run_for(frames=600)
+
+The first launch of a ROM analyses the program (see chip8.analysis) and, for a CPU that
+compiles blocks (JitCPU), translates and compiles its basic blocks; later launches, in
+this process or any other sharing the cache, read the analysis and the compiled block
+code back instead.  The cache is kept under a size limit by removing the least recently
+used entries.  The index of file hashes is saved with the cache, so files whose size and
+modification time have not changed are not read again to be hashed.
+
+ROM files are read through mmap, so repeated loads of a ROM are copies from pages
+shared with the OS cache rather than file reads.
+"""
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import sys
+
+from .analysis import ANALYSIS_VERSION, RomAnalysis, analyze
+from .cpu import CPU
+from .jit import BLOCK_CODE_VERSION
+
+DEFAULT_CACHE_BYTES = 256 * 2 ** 20
+INDEX_FILE = "index.json"
+MAX_PROGRAM_BYTES = CPU.RAM_SIZE_BYTES - CPU.PROGRAM_START_ADDR
+
+
+class ArtifactCache:
+    """
+    A directory of pickled objects, each stored under a key, that is kept below a total
+    size by removing the least recently used.  Recency is the file's modification time,
+    which each get refreshes, so that processes sharing the directory share the order.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        :param directory: where to keep the cache; made if it does not exist
+        :param max_bytes: total size the cache files are kept below
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """
+        :param key: name of the object, e.g. "analysis-<sha1>"
+        :return: the object, or None if it is not in the cache
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def put(self, key, value):
+        """
+        Store an object, then remove the least recently used objects until the cache is
+        below its size limit again
+        :return:
+        """
+        path = self._path(key)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)      # so that other processes never read a partly written file
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used objects until the cache is below its size limit
+        :return: number of objects removed
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pickle"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass        # removed by another process
+            total -= size
+            removed += 1
+        return removed
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith(".pickle"))
+
+
+class RomEntry:
+    """
+    A ROM file in a library
+    """
+
+    def __init__(self, path, size, mtime_ns, rom_hash):
+        self.path = path            # path of the file, relative to the library directory
+        self.size = size            # bytes in the file
+        self.mtime_ns = mtime_ns    # modification time of the file when it was hashed
+        self.rom_hash = rom_hash    # hex sha1 of the contents
+
+
+class RomLibrary:
+    """
+    The ROMs in a directory (and its subdirectories), by content hash
+    """
+
+    def __init__(self, directory, cache_dir=None, cache_bytes=DEFAULT_CACHE_BYTES):
+        """
+        :param directory: directory of ROM files
+        :param cache_dir: directory for the index, the cached analyses and the compiled blocks
+                          (default: nothing is kept between runs)
+        :param cache_bytes: size limit of the cache
+        """
+        self.directory = os.path.expanduser(directory)
+        self.cache = ArtifactCache(cache_dir, cache_bytes) if cache_dir is not None else None
+        self.entries = {}       # rom hash -> RomEntry (the first file found, if several have the same contents)
+        self._by_path = {}      # relative path -> RomEntry
+        self._maps = {}         # rom hash -> mmap of its file
+        self._analyses = {}     # rom hash -> RomAnalysis
+        self._block_code = {}   # rom hash -> compiled blocks (see JitCPU.export_blocks)
+        self.scan()
+
+    def _index_file(self):
+        return os.path.join(self.cache.directory, INDEX_FILE) if self.cache is not None else None
+
+    def scan(self):
+        """
+        (Re)build the index from the files in the directory, hashing only the files that
+        are new or have changed since they were last hashed.  Files that are empty or too
+        big to be CHIP-8 programs are left out.
+        :return:
+        """
+        known = dict(self._by_path)
+        index_file = self._index_file()
+        if not known and index_file is not None and os.path.exists(index_file):
+            with open(index_file) as f:
+                known = {path: RomEntry(path, *fields) for path, fields in json.load(f).items()}
+
+        self.entries = {}
+        self._by_path = {}
+        for root, dirs, files in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                stat = os.stat(full_path)
+                if not 0 < stat.st_size <= MAX_PROGRAM_BYTES:
+                    continue
+                path = os.path.relpath(full_path, self.directory)
+                entry = known.get(path)
+                if entry is None or entry.size != stat.st_size or entry.mtime_ns != stat.st_mtime_ns:
+                    with open(full_path, "rb") as f:
+                        rom_hash = hashlib.sha1(f.read()).hexdigest()
+                    entry = RomEntry(path, stat.st_size, stat.st_mtime_ns, rom_hash)
+                self._by_path[path] = entry
+                self.entries.setdefault(entry.rom_hash, entry)
+
+        self.close()    # files may have changed; map them again as they are read
+        if index_file is not None:
+            temp = "{}.{}.tmp".format(index_file, os.getpid())
+            with open(temp, "w") as f:
+                json.dump({path: [e.size, e.mtime_ns, e.rom_hash] for path, e in self._by_path.items()}, f)
+            os.replace(temp, index_file)
+
+    def find(self, rom):
+        """
+        :param rom: sha1 of a ROM, or the path of its file relative to the library directory
+        :return: RomEntry
+        """
+        entry = self.entries.get(rom) or self._by_path.get(rom)
+        if entry is None:
+            raise ValueError("No ROM {} in library {}".format(rom, self.directory))
+        return entry
+
+    def read(self, rom):
+        """
+        The contents of a ROM, copied from a mapping of its file that is kept open for
+        later reads
+        :param rom: sha1 or path (see find)
+        :return: bytes
+        """
+        entry = self.find(rom)
+        m = self._maps.get(entry.rom_hash)
+        if m is None:
+            with open(os.path.join(self.directory, entry.path), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[entry.rom_hash] = m
+        return m[:]
+
+    def analysis(self, rom):
+        """
+        The static analysis of a ROM (see chip8.analysis), from the cache if it has been
+        done before
+        :param rom: sha1 or path (see find)
+        :return: RomAnalysis
+        """
+        entry = self.find(rom)
+        analysis = self._analyses.get(entry.rom_hash)
+        if analysis is None:
+            key = "analysis-{}-{}".format(ANALYSIS_VERSION, entry.rom_hash)
+            d = self.cache.get(key) if self.cache is not None else None
+            if d is not None:
+                analysis = RomAnalysis.from_dict(d)
+            else:
+                analysis = analyze(self.read(rom))
+                if self.cache is not None:
+                    self.cache.put(key, analysis.to_dict())
+            self._analyses[entry.rom_hash] = analysis
+        return analysis
+
+    def load(self, vm, rom, precompile=True):
+        """
+        Load a ROM into a VM
+        :param vm: Chip8VM
+        :param rom: sha1 or path (see find)
+        :param precompile: if the VM's CPU compiles blocks ahead of time (e.g. JitCPU), give
+                           it the ROM's blocks compiled by an earlier load, and compile the
+                           rest from the ROM's analysis
+        :return: RomEntry
+        """
+        entry = self.find(rom)
+        vm.load_program(self.read(rom))
+        if precompile and hasattr(vm.cpu, "precompile"):
+            self._precompile(vm.cpu, entry)
+        return entry
+
+    def _precompile(self, cpu, entry):
+        """
+        Compile the blocks of a ROM that has just been loaded into cpu, importing the code
+        of blocks compiled for it before rather than compiling them again
+        """
+        blocks = self._block_code.get(entry.rom_hash)
+        # code objects are specific to the Python version
+        key = "blocks-{}-{}-{}".format(BLOCK_CODE_VERSION, sys.implementation.cache_tag, entry.rom_hash)
+        if blocks is None and self.cache is not None:
+            blocks = self.cache.get(key)
+        if blocks is not None:
+            cpu.import_blocks(blocks)
+        cpu.precompile(self.analysis(entry.rom_hash))
+        if blocks is None:
+            blocks = cpu.export_blocks(CPU.PROGRAM_START_ADDR, CPU.PROGRAM_START_ADDR + entry.size)
+            if self.cache is not None:
+                self.cache.put(key, blocks)
+        self._block_code[entry.rom_hash] = blocks
+
+    def close(self):
+        """
+        Unmap the ROM files
+        :return:
+        """
+        for m in self._maps.values():
+            m.close()
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, rom):
+        return rom in self.entries or rom in self._by_path
@@ -0,0 +1,175 @@
+"""
+Opt-in profiler: counts executions and time per opcode family (the CPU method that
+implements the instruction) and per PC address, and builds a call graph from
+call / ret.
+
+Profiling costs nothing while it is off.  Attaching a Profiler switches the CPU to a
+subclass whose _execute is instrumented (see chip8.instrument); detaching switches it
+back, so the normal execution path never checks whether it is being profiled.
+
+    profiler = Profiler()
+    profiler.attach(vm.cpu)
+    vm.run_for(cycles=100000)
+    profiler.detach()
+    print(profiler.format_heatmap())
+    profiler.dump_json("profile.json")
+"""
+import json
+import time
+
+from .cpu import CPU
+from .instrument import instrument, uninstrument
+
+HEATMAP_CELL_BYTES = 16
+HEATMAP_ROW_CELLS = 32
+HEATMAP_SHADES = " .:-=+*#%@"
+MAIN_ROUTINE = CPU.PROGRAM_START_ADDR   # routine that code not reached by a call is counted against
+
+
+def _profiled_execute(self, cycles):
+    """
+    CPU._execute, reporting each instruction to the CPU's profiler
+    """
+    ram = self.ram
+    dispatch_entry = self._dispatch_entry
+    profiler = self._profiler
+    max_pc = self.RAM_SIZE_BYTES - 2
+    clock = time.perf_counter
+    for _ in range(cycles):
+        pc = self.PC
+        if pc >= max_pc:
+            raise ValueError("PC out of range: PC = {}    (max addr = {})".format(pc, max_pc))
+        handler, args, increment_pc = dispatch_entry((ram[pc] << 8) | ram[pc + 1])
+        t = clock()
+        handler(self, *args)
+        if increment_pc:
+            self.PC += 2
+        profiler.count(pc, handler.__name__, clock() - t, args)
+
+
+class Profiler:
+    """
+    Collects execution counts and times from the CPUs it is attached to
+    """
+
+    def __init__(self):
+        self.address_counts = [0] * CPU.RAM_SIZE_BYTES
+        self.address_times = [0.] * CPU.RAM_SIZE_BYTES
+        self.family_counts = {}     # CPU method name -> executions
+        self.family_times = {}      # CPU method name -> seconds
+        self.calls = {}             # (caller routine, callee routine) -> number of calls
+        self.routine_times = {}     # routine start address -> seconds spent in the routine itself
+        self._call_stack = [MAIN_ROUTINE]
+        self._cpus = []
+
+    def attach(self, cpu):
+        """
+        Start profiling a CPU
+        :param cpu: CPU, or an instance of a subclass such as JitCPU
+        :return:
+        """
+        instrument(cpu, _profiled_execute, "Profiled")
+        cpu._profiler = self
+        self._cpus.append(cpu)
+
+    def detach(self, cpu=None):
+        """
+        Stop profiling a CPU, leaving it exactly as fast as it was before attach
+        :param cpu: the CPU to stop profiling (default: all of them)
+        :return:
+        """
+        for c in ([cpu] if cpu is not None else list(self._cpus)):
+            uninstrument(c)
+            c._profiler = None
+            self._cpus.remove(c)
+
+    def is_attached(self, cpu):
+        return any(c is cpu for c in self._cpus)
+
+    def reset(self):
+        cpus = self._cpus
+        self.__init__()
+        self._cpus = cpus
+
+    def count(self, pc, family, seconds, args):
+        """
+        Record one executed instruction
+        :param pc: its address
+        :param family: name of the CPU method that ran it
+        :param seconds: time it took
+        :param args: its decoded arguments
+        :return:
+        """
+        self.address_counts[pc] += 1
+        self.address_times[pc] += seconds
+        self.family_counts[family] = self.family_counts.get(family, 0) + 1
+        self.family_times[family] = self.family_times.get(family, 0.) + seconds
+        routine = self._call_stack[-1]
+        self.routine_times[routine] = self.routine_times.get(routine, 0.) + seconds
+        if family == "call":
+            edge = (routine, args[0])
+            self.calls[edge] = self.calls.get(edge, 0) + 1
+            self._call_stack.append(args[0])
+        elif family == "ret" and len(self._call_stack) > 1:
+            self._call_stack.pop()
+
+    def hot_addresses(self, top=20):
+        """
+        The most executed addresses
+        :param top: number of addresses
+        :return: list of (address, count, seconds), most executed first
+        """
+        hot = sorted((pc for pc, n in enumerate(self.address_counts) if n),
+                     key=lambda pc: self.address_counts[pc], reverse=True)[:top]
+        return [(pc, self.address_counts[pc], self.address_times[pc]) for pc in hot]
+
+    def heatmap(self, cell_bytes=HEATMAP_CELL_BYTES, row_cells=HEATMAP_ROW_CELLS):
+        """
+        Execution counts summed over cells of memory
+        :param cell_bytes: bytes of memory per cell
+        :param row_cells: cells per row
+        :return: list of rows, each a list of counts; row r, cell c covers the addresses from
+                 (r * row_cells + c) * cell_bytes
+        """
+        cells = [sum(self.address_counts[a:a + cell_bytes]) for a in range(0, CPU.RAM_SIZE_BYTES, cell_bytes)]
+        return [cells[r:r + row_cells] for r in range(0, len(cells), row_cells)]
+
+    def format_heatmap(self, cell_bytes=HEATMAP_CELL_BYTES, row_cells=HEATMAP_ROW_CELLS):
+        """
+        The heatmap as text, one line per row, with a character per cell shaded by how
+        hot the cell is relative to the hottest; rows that never ran are left out
+        """
+        rows = self.heatmap(cell_bytes, row_cells)
+        hottest = max(max(row) for row in rows) or 1
+        lines = []
+        for r, row in enumerate(rows):
+            if any(row):
+                shades = "".join(HEATMAP_SHADES[(n * (len(HEATMAP_SHADES) - 1) + hottest - 1) // hottest] for n in row)
+                lines.append("{:03x}: |{}|".format(r * row_cells * cell_bytes, shades))
+        return "\n".join(lines)
+
+    def report(self, top=20):
+        """
+        Summary of the profile, made of plain types so that it can be saved as JSON
+        :param top: number of hot addresses to include
+        :return: dict
+        """
+        return {
+            "instructions": sum(self.family_counts.values()),
+            "seconds": sum(self.family_times.values()),
+            "families": {name: {"count": self.family_counts[name], "seconds": self.family_times[name]}
+                         for name in sorted(self.family_counts, key=self.family_counts.get, reverse=True)},
+            "hot_addresses": [{"address": pc, "count": n, "seconds": t} for pc, n, t in self.hot_addresses(top)],
+            "routines": [{"address": r, "calls": sum(n for (_, callee), n in self.calls.items() if callee == r),
+                          "seconds": t} for r, t in sorted(self.routine_times.items())],
+            "call_graph": [{"caller": caller, "callee": callee, "count": n}
+                           for (caller, callee), n in sorted(self.calls.items())],
+            "heatmap": {"cell_bytes": HEATMAP_CELL_BYTES, "rows": self.heatmap()},
+        }
+
+    def dump_json(self, filename, top=20):
+        """
+        Save the report to a file as JSON
+        """
+        with open(filename, "w") as f:
+            json.dump(self.report(top), f, indent=2)
@@ -0,0 +1,225 @@
+"""
+Rewind history for a Chip8VM.
+
+Snapshots are recorded every few frames, but only the newest is kept whole.  Each
+older one is kept as an XOR delta against its successor, holding just the parts of
+the snapshot that changed: the registers, the RAM pages and the screen rows, each
+trimmed to the span of its bytes that changed.  Most frames touch only a few bytes,
+so a long history fits in little memory.  Stepping back applies the newest delta to
+the newest snapshot.
+
+The cycle count and timer phase change in every frame, so rather than as XOR chunks
+they are kept as the (small) differences from the successor's values.  The deltas are
+packed one after another into a single preallocated ring buffer, each with its length
+before and after it so that the ring can be walked from either end.
+"""
+import struct
+
+from .cpu import CPU
+
+DEFAULT_CAPACITY = 60 * 60 * 60     # an hour of frames at 60 fps
+DEFAULT_HISTORY_BYTES = 16 * 2 ** 20    # size of the ring buffer the deltas are kept in: an hour of
+                                        # frames of a busy game (25-63 bytes each) fits
+DEFAULT_PAGE_BYTES = 64
+REGISTER_CHUNK_BYTES = 8
+CHUNK_HEADER = struct.Struct("<HB")     # offset and length of each changed part in a delta
+DELTA_LENGTH = struct.Struct("<H")      # before and after each delta in the ring
+COUNTERS = struct.Struct("<QI")         # cycles and timer phase, at the end of the register file
+COUNTERS_OFFSET = CPU.RAM_OFFSET - COUNTERS.size
+
+
+def _xor(a, b):
+    """
+    XOR two equal length byte strings
+    """
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+
+def _append_varint(out, value):
+    """
+    Append a signed integer to out in as few bytes as it needs (zigzag, then 7 bits a byte)
+    """
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    """
+    Invert _append_varint
+    :return: (value, position after it)
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    return (value >> 1 if not value & 1 else -(value >> 1) - 1), pos
+
+
+class RewindBuffer:
+    """
+    Fixed-size ring buffer of snapshot deltas; when it is full the oldest history is dropped
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, interval_frames=1, page_bytes=DEFAULT_PAGE_BYTES,
+                 history_bytes=DEFAULT_HISTORY_BYTES):
+        """
+        :param capacity: number of steps of history to keep
+        :param interval_frames: record a snapshot once every this many frames
+        :param page_bytes: size of the RAM pages that deltas are made of, 1 to 255
+        :param history_bytes: size of the ring buffer; when the deltas fill it, the oldest
+                              history is dropped even if there are fewer than capacity steps
+        """
+        if capacity < 1:
+            raise ValueError("Rewind capacity must be at least 1 step, not {}".format(capacity))
+        if not 1 <= page_bytes <= 255:
+            # a changed part's length is kept in one byte of its CHUNK_HEADER
+            raise ValueError("Rewind page_bytes must be from 1 to 255, not {}".format(page_bytes))
+        self.capacity = capacity
+        self.interval_frames = interval_frames
+        self._ring = bytearray(history_bytes)
+        self._head = 0              # ring offset of the oldest delta
+        self._tail = 0              # ring offset just past the newest delta
+        self._used = 0              # bytes of the ring in use
+        self._count = 0             # number of deltas in the ring
+        self._latest = None         # the newest snapshot, whole
+        self._frames_since_record = 0
+
+        # the parts of a snapshot that deltas are made of, by region: the registers (but for
+        # the counters), RAM pages and screen rows
+        ram_start = CPU.SNAPSHOT_RAM_OFFSET
+        screen_start = CPU.SNAPSHOT_SCREEN_OFFSET
+        row_bytes = CPU.SCREEN_WIDTH // 8
+        self._regions = [
+            (0, COUNTERS_OFFSET, [(o, min(o + REGISTER_CHUNK_BYTES, COUNTERS_OFFSET))
+                                  for o in range(0, COUNTERS_OFFSET, REGISTER_CHUNK_BYTES)]),
+            (ram_start, screen_start, [(o, min(o + page_bytes, screen_start))
+                                       for o in range(ram_start, screen_start, page_bytes)]),
+            (screen_start, CPU.SNAPSHOT_SIZE, [(o, o + row_bytes)
+                                               for o in range(screen_start, CPU.SNAPSHOT_SIZE, row_bytes)]),
+        ]
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        self._head = self._tail = self._used = self._count = 0
+        self._latest = None
+        self._frames_since_record = 0
+
+    def frame(self, vm):
+        """
+        Call once per frame; records a snapshot of vm every interval_frames frames
+        :param vm: Chip8VM
+        :return:
+        """
+        self._frames_since_record += 1
+        if self._latest is None or self._frames_since_record >= self.interval_frames:
+            self.record(bytes(vm.snapshot()))
+
+    def record(self, snapshot):
+        """
+        Add a snapshot to the history
+        :param snapshot: bytes from CPU.snapshot
+        :return:
+        """
+        previous = self._latest
+        self._latest = snapshot
+        self._frames_since_record = 0
+        if previous is None:
+            return
+        # a delta is the differences of the counters, then a header and the XORed bytes for every changed part
+        cycles, phase = COUNTERS.unpack_from(snapshot, COUNTERS_OFFSET)
+        previous_cycles, previous_phase = COUNTERS.unpack_from(previous, COUNTERS_OFFSET)
+        delta = bytearray(DELTA_LENGTH.size)
+        _append_varint(delta, cycles - previous_cycles)
+        _append_varint(delta, phase - previous_phase)
+        for region_start, region_end, chunks in self._regions:
+            if previous[region_start:region_end] == snapshot[region_start:region_end]:
+                continue
+            for start, end in chunks:
+                if previous[start:end] != snapshot[start:end]:
+                    # only the span of the part from its first to its last changed byte
+                    changed = _xor(previous[start:end], snapshot[start:end])
+                    trimmed = changed.strip(b"\0")
+                    delta += CHUNK_HEADER.pack(start + len(changed) - len(changed.lstrip(b"\0")), len(trimmed))
+                    delta += trimmed
+        length = len(delta) - DELTA_LENGTH.size
+        DELTA_LENGTH.pack_into(delta, 0, length)
+        delta += DELTA_LENGTH.pack(length)
+
+        if len(delta) > len(self._ring):
+            # too big to keep at all; the history before it can no longer be reached
+            self._head = self._tail = self._used = self._count = 0
+            return
+        while self._count >= self.capacity or self._used + len(delta) > len(self._ring):
+            self._drop_oldest()
+        self._write(self._tail, delta)
+        self._tail = (self._tail + len(delta)) % len(self._ring)
+        self._used += len(delta)
+        self._count += 1
+
+    def step_back(self):
+        """
+        Drop the newest snapshot from the history
+        :return: the snapshot before it, or None if there is no more history
+        """
+        if not self._count:
+            return None
+        size = len(self._ring)
+        length = DELTA_LENGTH.unpack(self._read((self._tail - DELTA_LENGTH.size) % size, DELTA_LENGTH.size))[0]
+        start = (self._tail - length - 2 * DELTA_LENGTH.size) % size
+        delta = self._read((start + DELTA_LENGTH.size) % size, length)
+        self._tail = start
+        self._used -= length + 2 * DELTA_LENGTH.size
+        self._count -= 1
+
+        snapshot = bytearray(self._latest)
+        cycles, phase = COUNTERS.unpack_from(snapshot, COUNTERS_OFFSET)
+        cycles_step, pos = _read_varint(delta, 0)
+        phase_step, pos = _read_varint(delta, pos)
+        COUNTERS.pack_into(snapshot, COUNTERS_OFFSET, cycles - cycles_step, phase - phase_step)
+        while pos < len(delta):
+            start, length = CHUNK_HEADER.unpack_from(delta, pos)
+            pos += CHUNK_HEADER.size
+            snapshot[start:start + length] = _xor(snapshot[start:start + length], delta[pos:pos + length])
+            pos += length
+        self._latest = bytes(snapshot)
+        self._frames_since_record = 0
+        return self._latest
+
+    def _drop_oldest(self):
+        length = DELTA_LENGTH.unpack(self._read(self._head, DELTA_LENGTH.size))[0] + 2 * DELTA_LENGTH.size
+        self._head = (self._head + length) % len(self._ring)
+        self._used -= length
+        self._count -= 1
+
+    def _write(self, pos, data):
+        """
+        Copy data into the ring at offset pos, wrapping round its end
+        """
+        first = min(len(data), len(self._ring) - pos)
+        self._ring[pos:pos + first] = data[:first]
+        self._ring[:len(data) - first] = data[first:]
+
+    def _read(self, pos, length):
+        """
+        :return: length bytes from the ring at offset pos, wrapping round its end
+        """
+        end = pos + length
+        if end <= len(self._ring):
+            return bytes(self._ring[pos:end])
+        return bytes(self._ring[pos:]) + bytes(self._ring[:end - len(self._ring)])
+
+    def memory_bytes(self):
+        """
+        Approximate number of bytes of snapshot data held
+        """
+        return (len(self._latest) if self._latest else 0) + self._used
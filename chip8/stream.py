@@ -0,0 +1,283 @@
+"""
+Streaming a VM's screen to remote displays over TCP or Unix sockets, and taking their
+key presses back.
+
+    vm = Chip8VM.headless()
+    vm.load_rom("roms/INVADERS")
+    server = FrameStreamServer(vm)
+    await server.start_tcp("localhost", 8688)
+    await vm.run_async()
+
+A client reads the frames with receive_frames, and sends its key state with send_keys
+whenever it changes:
+
+    reader, writer = await asyncio.open_connection("localhost", 8688)
+    async for frame, packed in receive_frames(reader):
+        ...
+
+Frames are published by Chip8VM.run_async only when the screen changes, so a static
+screen sends nothing.  Each message is a keyframe (the whole screen) or a delta (the XOR
+of the rows that changed since the last message); either way the bytes are run-length
+encoded, since most of a CHIP-8 screen, and nearly all of a delta, is zero.  A client
+gets a keyframe when it connects and every KEYFRAME_INTERVAL messages after that.
+
+Key state sent by clients is ORed together and applied to the VM's keyboard, so several
+players can share one VM; a spectator simply never sends.
+"""
+import asyncio
+import struct
+
+from .framebuffer import FrameBuffer
+
+STREAM_HEADER = struct.Struct("<BIH")   # kind, frame number, payload length
+ROW_MASK = struct.Struct("<I")          # bit y set: row y is in the delta
+KEY_STATE = struct.Struct("<H")         # client -> server: bit k set: key k is down
+ROW_BYTES = FrameBuffer.WIDTH // 8
+KEYFRAME_INTERVAL = 60                  # messages between keyframes
+MAX_RUN = 255
+
+# Message kinds
+KEYFRAME = 0    # payload: the run-length encoded packed screen
+DELTA = 1       # payload: row mask, then the run-length encoded XOR of the changed rows
+
+
+def rle_encode(data):
+    """
+    Run-length encode the runs of zero bytes in data: a zero byte is followed by the
+    length of its run (1 to MAX_RUN), other bytes are copied as they are
+    :param data: bytes-like object
+    :return: bytes
+    """
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        if data[i]:
+            out.append(data[i])
+            i += 1
+        else:
+            j = i + 1
+            while j < n and j - i < MAX_RUN and not data[j]:
+                j += 1
+            out += bytes((0, j - i))
+            i = j
+    return bytes(out)
+
+
+def rle_decode(data):
+    """
+    Invert rle_encode
+    :param data: bytes-like object
+    :return: bytes
+    """
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        if data[i]:
+            out.append(data[i])
+            i += 1
+        else:
+            if i + 1 >= n:
+                raise ValueError("Run-length encoded data ends part way through a run")
+            out += bytes(data[i + 1])
+            i += 2
+    return bytes(out)
+
+
+class FrameEncoder:
+    """
+    Turns a sequence of screens (see FrameBuffer.get_packed) into stream messages for one client
+    """
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self._rows = None           # rows as of the last message; None until the first keyframe
+        self._since_keyframe = 0
+
+    def encode(self, frame, packed):
+        """
+        :param frame: frame number
+        :param packed: the screen, as returned by FrameBuffer.get_packed
+        :return: the message bytes, or None if the screen is the same as at the last message
+        """
+        rows = FrameBuffer.PACKED_ROWS.unpack(packed)
+        if self._rows is None or self._since_keyframe >= self.keyframe_interval:
+            payload = rle_encode(packed)
+            kind = KEYFRAME
+            self._since_keyframe = 0
+        else:
+            changed = [y for y in range(FrameBuffer.HEIGHT) if rows[y] != self._rows[y]]
+            if not changed:
+                return None
+            mask = 0
+            xor = bytearray()
+            for y in changed:
+                mask |= 1 << y
+                xor += (rows[y] ^ self._rows[y]).to_bytes(ROW_BYTES, "big")
+            payload = ROW_MASK.pack(mask) + rle_encode(xor)
+            kind = DELTA
+        self._rows = rows
+        self._since_keyframe += 1
+        return STREAM_HEADER.pack(kind, (frame or 0) & 0xFFFFFFFF, len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Rebuilds the screen from stream messages
+    """
+
+    def __init__(self):
+        self.rows = None    # None until the first keyframe
+
+    def decode(self, kind, payload):
+        """
+        Apply one message
+        :param kind: KEYFRAME or DELTA
+        :param payload: the message payload
+        :return: the screen, in the form returned by FrameBuffer.get_packed
+        """
+        if kind == KEYFRAME:
+            self.rows = list(FrameBuffer.PACKED_ROWS.unpack(rle_decode(payload)))
+        elif kind == DELTA:
+            if self.rows is None:
+                raise ValueError("Frame stream delta before the first keyframe")
+            mask = ROW_MASK.unpack_from(payload)[0]
+            xor = rle_decode(payload[ROW_MASK.size:])
+            pos = 0
+            for y in range(FrameBuffer.HEIGHT):
+                if mask & (1 << y):
+                    self.rows[y] ^= int.from_bytes(xor[pos:pos + ROW_BYTES], "big")
+                    pos += ROW_BYTES
+            if pos != len(xor):
+                raise ValueError("Frame stream delta does not match its row mask")
+        else:
+            raise ValueError("Unknown frame stream message kind {}".format(kind))
+        return FrameBuffer.PACKED_ROWS.pack(*self.rows)
+
+
+async def receive_frames(reader):
+    """
+    Async generator of the screens sent by a FrameStreamServer, until it disconnects
+    :param reader: asyncio.StreamReader connected to the server
+    :return: async generator of (frame number, packed screen)
+    """
+    decoder = FrameDecoder()
+    while True:
+        try:
+            header = await reader.readexactly(STREAM_HEADER.size)
+        except asyncio.IncompleteReadError:
+            return
+        kind, frame, length = STREAM_HEADER.unpack(header)
+        payload = await reader.readexactly(length)
+        yield frame, decoder.decode(kind, payload)
+
+
+async def send_keys(writer, key_pressed):
+    """
+    Send a client's key state to a FrameStreamServer
+    :param writer: asyncio.StreamWriter connected to the server
+    :param key_pressed: sequence of 16 key states
+    :return:
+    """
+    writer.write(KEY_STATE.pack(sum(1 << k for k, pressed in enumerate(key_pressed) if pressed)))
+    await writer.drain()
+
+
+class FrameStreamServer:
+    """
+    Serves the frames a VM publishes from run_async to socket clients, and applies their
+    key state to its keyboard
+    """
+
+    def __init__(self, vm, keyframe_interval=KEYFRAME_INTERVAL):
+        """
+        :param vm: Chip8VM, run with run_async on the same event loop
+        :param keyframe_interval: messages between keyframes
+        """
+        self.vm = vm
+        self.keyframe_interval = keyframe_interval
+        self.bytes_sent = 0
+        self._servers = []
+        self._client_keys = {}      # client writer -> its key state mask
+
+    async def start_tcp(self, host=None, port=0):
+        """
+        Listen for clients on a TCP port
+        :return: the asyncio Server
+        """
+        server = await asyncio.start_server(self._serve_client, host, port)
+        self._servers.append(server)
+        return server
+
+    async def start_unix(self, path):
+        """
+        Listen for clients on a Unix socket
+        :return: the asyncio Server
+        """
+        server = await asyncio.start_unix_server(self._serve_client, path)
+        self._servers.append(server)
+        return server
+
+    async def close(self):
+        """
+        Stop listening and disconnect the clients
+        """
+        for server in self._servers:
+            server.close()
+        for writer in list(self._client_keys):
+            writer.close()
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+
+    async def _serve_client(self, reader, writer):
+        queue = self.vm.subscribe()
+        self._client_keys[writer] = 0
+        keys = asyncio.ensure_future(self._read_keys(reader, writer))
+        try:
+            encoder = FrameEncoder(self.keyframe_interval)
+            while not keys.done():
+                frame = asyncio.ensure_future(queue.get())
+                await asyncio.wait((frame, keys), return_when=asyncio.FIRST_COMPLETED)
+                if not frame.done():
+                    frame.cancel()
+                    break
+                message = encoder.encode(*frame.result())
+                if message is not None:
+                    writer.write(message)
+                    self.bytes_sent += len(message)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            keys.cancel()
+            self.vm.unsubscribe(queue)
+            del self._client_keys[writer]
+            self._apply_keys()
+            writer.close()
+
+    async def _read_keys(self, reader, writer):
+        """
+        Apply a client's key state messages until it disconnects
+        """
+        while True:
+            try:
+                message = await reader.readexactly(KEY_STATE.size)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            self._client_keys[writer] = KEY_STATE.unpack(message)[0]
+            self._apply_keys()
+
+    def _apply_keys(self):
+        """
+        Set the VM's keyboard to the keys held down by any client
+        """
+        mask = 0
+        for keys in self._client_keys.values():
+            mask |= keys
+        keyboard = self.vm.keyboard
+        for k in range(len(keyboard.key_pressed)):
+            pressed = (mask >> k) & 1
+            if keyboard.key_pressed[k] != pressed:
+                keyboard.set_key(k, pressed)
@@ -0,0 +1,266 @@
+"""
+Instruction traces: a compact binary record of every instruction a CPU runs, with the
+registers each one changed, for diffing long runs.
+
+    tracer = TraceWriter("run.c8tr.gz", compression="gzip")
+    tracer.attach(vm.cpu)
+    vm.run_for(cycles=10 ** 9)
+    tracer.close()
+
+    for cycle, pc, opcode, changes in read_trace("run.c8tr.gz", pc_range=(0x200, 0x240)):
+        print(cycle, hex(pc), hex(opcode), changes)
+
+Like the profiler, tracing swaps in an instrumented execution loop (see
+chip8.instrument) and costs nothing while it is off.
+
+The stream is a header followed by one record per instruction: its PC, its opcode and
+a mask of the registers it changed, then the new value of each changed register.  Cycle
+numbers are implicit (one per record) except where the CPU's cycle count jumps, e.g.
+after a restore, where a sync record gives the new count.
+"""
+import bz2
+import gzip
+import lzma
+import struct
+
+from .instrument import instrument, uninstrument
+
+TRACE_MAGIC = b"C8TR"
+TRACE_VERSION = 2
+TRACE_HEADER = struct.Struct("<4sHQ")       # magic, version, first cycle
+TRACE_RECORD = struct.Struct("<HHI")        # PC, opcode, mask of changed registers
+TRACE_SYNC = struct.Struct("<HQ")           # SYNC_PC, cycle of the next record
+SYNC_PC = 0xFFFF                            # PC of a sync record; real PCs are below 4096
+WRITE_BUFFER_BYTES = 1 << 20
+READ_BLOCK_BYTES = 1 << 20
+
+# Changed register mask: bits 0-15 are V0-VF (a byte each), then I (four bytes, as Fx1E can carry it past 16 bits), SP, DT, ST (a byte each)
+I_BIT = 1 << 16
+SP_BIT = 1 << 17
+DT_BIT = 1 << 18
+ST_BIT = 1 << 19
+V_MASK = 0xFFFF
+
+COMPRESSED_OPEN = {
+    None: open,
+    "gzip": gzip.open,
+    "bz2": bz2.open,
+    "lzma": lzma.open,
+}
+
+
+def _traced_execute(self, cycles):
+    """
+    CPU._execute, writing each instruction to the CPU's tracer
+    """
+    ram = self.ram
+    V = self.V
+    dispatch_entry = self._dispatch_entry
+    tracer = self._tracer
+    max_pc = self.RAM_SIZE_BYTES - 2
+    tracer.sync(self.cycles)
+    for _ in range(cycles):
+        pc = self.PC
+        if pc >= max_pc:
+            raise ValueError("PC out of range: PC = {}    (max addr = {})".format(pc, max_pc))
+        opcode = (ram[pc] << 8) | ram[pc + 1]
+        handler, args, increment_pc = dispatch_entry(opcode)
+        before = (bytes(V), self.I, self.SP, self.DT, self.ST)
+        handler(self, *args)
+        if increment_pc:
+            self.PC += 2
+        tracer.record(pc, opcode, before, self)
+
+
+class TraceWriter:
+    """
+    Writes an instruction trace through a buffer and, optionally, a compressor
+    """
+
+    def __init__(self, filename, compression=None, first_cycle=0, buffer_bytes=WRITE_BUFFER_BYTES):
+        """
+        :param filename: file to write
+        :param compression: None, "gzip", "bz2" or "lzma"
+        :param first_cycle: cycle count of the first instruction to be traced
+        :param buffer_bytes: records are written out in batches of about this size
+        """
+        if compression not in COMPRESSED_OPEN:
+            raise ValueError("Unknown trace compression {}".format(compression))
+        self.filename = filename
+        self._file = COMPRESSED_OPEN[compression](filename, "wb")
+        self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, first_cycle))
+        self._buffer = bytearray()
+        self._buffer_bytes = buffer_bytes
+        self._next_cycle = first_cycle
+        self._cpus = []
+
+    def attach(self, cpu):
+        """
+        Start tracing every instruction a CPU runs
+        :param cpu: CPU, or an instance of a subclass such as JitCPU
+        :return:
+        """
+        instrument(cpu, _traced_execute, "Traced")
+        cpu._tracer = self
+        self._cpus.append(cpu)
+
+    def detach(self, cpu=None):
+        """
+        Stop tracing a CPU
+        :param cpu: the CPU to stop tracing (default: all of them)
+        :return:
+        """
+        for c in ([cpu] if cpu is not None else list(self._cpus)):
+            uninstrument(c)
+            c._tracer = None
+            self._cpus.remove(c)
+
+    def is_attached(self, cpu):
+        return any(c is cpu for c in self._cpus)
+
+    def sync(self, cycle):
+        """
+        Note the cycle count of the next instruction, writing a sync record if it is not
+        the one that follows the last traced instruction
+        """
+        if cycle != self._next_cycle:
+            self._buffer += TRACE_SYNC.pack(SYNC_PC, cycle)
+            self._next_cycle = cycle
+
+    def record(self, pc, opcode, before, cpu):
+        """
+        Write the record of one instruction
+        :param pc: its address
+        :param opcode: the instruction
+        :param before: (V, I, SP, DT, ST) before it ran
+        :param cpu: the CPU after it ran
+        :return:
+        """
+        V, I, SP, DT, ST = before
+        mask = 0
+        values = b""
+        if V != cpu.V:
+            changed = [r for r in range(16) if V[r] != cpu.V[r]]
+            for r in changed:
+                mask |= 1 << r
+            values = bytes(cpu.V[r] for r in changed)
+        if I != cpu.I:
+            mask |= I_BIT
+            values += cpu.I.to_bytes(4, "little")
+        if SP != cpu.SP:
+            mask |= SP_BIT
+            values += bytes([cpu.SP])
+        if DT != cpu.DT:
+            mask |= DT_BIT
+            values += bytes([cpu.DT])
+        if ST != cpu.ST:
+            mask |= ST_BIT
+            values += bytes([cpu.ST])
+        buffer = self._buffer
+        buffer += TRACE_RECORD.pack(pc, opcode, mask)
+        buffer += values
+        self._next_cycle += 1
+        if len(buffer) >= self._buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        self._file.write(self._buffer)
+        self._buffer.clear()
+
+    def close(self):
+        """
+        Stop tracing and finish the file
+        :return:
+        """
+        self.detach()
+        self.flush()
+        self._file.close()
+
+
+def _open_trace(filename):
+    """
+    Open a trace file, recognising the compressed formats by their leading bytes
+    """
+    with open(filename, "rb") as f:
+        start = f.read(6)
+    if start.startswith(b"\x1f\x8b"):
+        return gzip.open(filename, "rb")
+    if start.startswith(b"BZh"):
+        return bz2.open(filename, "rb")
+    if start.startswith(b"\xfd7zXZ\x00"):
+        return lzma.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def _values_length(mask):
+    """
+    Number of value bytes that follow a record with the given changed register mask
+    """
+    return bin(mask & V_MASK).count("1") + (4 if mask & I_BIT else 0) + bin(mask & (SP_BIT | DT_BIT | ST_BIT)).count("1")
+
+
+def _decode_changes(mask, values):
+    """
+    :return: dict of register name -> new value, e.g. {"V3": 7, "I": 0x300}
+    """
+    changes = {}
+    pos = 0
+    for r in range(16):
+        if mask & (1 << r):
+            changes["V{:X}".format(r)] = values[pos]
+            pos += 1
+    if mask & I_BIT:
+        changes["I"] = int.from_bytes(values[pos:pos + 4], "little")
+        pos += 4
+    for name, bit in (("SP", SP_BIT), ("DT", DT_BIT), ("ST", ST_BIT)):
+        if mask & bit:
+            changes[name] = values[pos]
+            pos += 1
+    return changes
+
+
+def read_trace(filename, pc_range=None, opcode=None, opcode_mask=0xFFFF):
+    """
+    Generator of the records in a trace file, read a block at a time
+    :param filename: file written by TraceWriter (compressed or not)
+    :param pc_range: if given, only records with start <= PC < end, as (start, end)
+    :param opcode: if given, only records with (record opcode & opcode_mask) == opcode
+    :param opcode_mask: e.g. opcode=0xD000, opcode_mask=0xF000 for all the sprite draws
+    :return: generator of (cycle, PC, opcode, dict of changed register name -> new value)
+    """
+    pc_start, pc_end = pc_range if pc_range is not None else (0, SYNC_PC)
+    with _open_trace(filename) as f:
+        header = f.read(TRACE_HEADER.size)
+        if len(header) != TRACE_HEADER.size:
+            raise ValueError("{} is not a chip8 trace".format(filename))
+        magic, version, cycle = TRACE_HEADER.unpack(header)
+        if magic != TRACE_MAGIC:
+            raise ValueError("{} is not a chip8 trace".format(filename))
+        if version != TRACE_VERSION:
+            raise ValueError("Unsupported trace version {} (expected {})".format(version, TRACE_VERSION))
+
+        data = b""
+        pos = 0
+        while True:
+            block = f.read(READ_BLOCK_BYTES)
+            if not block:
+                if pos != len(data):
+                    raise ValueError("Trace {} ends part way through a record".format(filename))
+                return
+            data = data[pos:] + block
+            pos = 0
+            while pos + TRACE_RECORD.size <= len(data):
+                pc, op, mask = TRACE_RECORD.unpack_from(data, pos)
+                if pc == SYNC_PC:
+                    if pos + TRACE_SYNC.size > len(data):
+                        break
+                    cycle = TRACE_SYNC.unpack_from(data, pos)[1]
+                    pos += TRACE_SYNC.size
+                    continue
+                end = pos + TRACE_RECORD.size + (_values_length(mask) if mask else 0)
+                if end > len(data):
+                    break
+                if pc_start <= pc < pc_end and (opcode is None or op & opcode_mask == opcode):
+                    yield cycle, pc, op, _decode_changes(mask, data[pos + TRACE_RECORD.size:end]) if mask else {}
+                cycle += 1
+                pos = end
@@ -0,0 +1,69 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from benchmarks.roms import alu_rom, draw_rom, jump_rom, memory_rom, paddle_rom, score_rom
+from chip8.batch import BatchCPU
+from chip8.cpu import CPU
+from chip8.headless import NullScreen
+from chip8.keyboard import Keyboard
+
+
+def make_cpu(program, clock_hz):
+    cpu = CPU(keyboard=Keyboard(), screen=NullScreen(), clock_hz=clock_hz, seed=0)
+    cpu.load_program(program)
+    return cpu
+
+
+def assert_same(batch, instance, cpu):
+    assert batch.get_state(instance) == cpu.get_state()
+    assert bytes(batch.ram[instance]) == bytes(cpu.ram)
+    assert batch.get_framebuffer(instance) == cpu.screen.get_framebuffer()
+
+
+@pytest.mark.parametrize("rom", [alu_rom, draw_rom, memory_rom, jump_rom, paddle_rom, score_rom])
+def test_each_machine_matches_cpu(rom):
+    batch = BatchCPU(3, clock_hz=1000, seed=0)
+    batch.load_program(rom())
+    cpu = make_cpu(rom(), 1000)
+    for _ in range(20):
+        batch.run_cycles(50)
+        for _ in range(50):
+            cpu.tick()
+        for instance in range(3):
+            assert_same(batch, instance, cpu)
+    assert not batch.faulted.any()
+
+
+def test_machines_with_different_programs_and_keys_match_their_cpus():
+    programs = [paddle_rom(), score_rom()]
+    batch = BatchCPU(2, clock_hz=1000, seed=0)
+    cpus = []
+    for instance, program in enumerate(programs):
+        batch.load_program(program, instances=[instance])
+        cpus.append(make_cpu(program, 1000))
+    keys = np.zeros((2, 16), dtype=bool)
+    for frame in range(30):
+        keys[0, 1] = frame % 10 < 5     # paddle down on key 1
+        batch.set_keys(keys)
+        for instance, cpu in enumerate(cpus):
+            for k in range(16):
+                cpu.keyboard.set_key(k, keys[instance, k])
+        batch.run_cycles(17)
+        for cpu in cpus:
+            cpu.run_cycles(17)
+        for instance, cpu in enumerate(cpus):
+            assert_same(batch, instance, cpu)
+
+
+def test_a_machine_that_fails_is_stopped_and_the_others_run_on():
+    batch = BatchCPU(2, clock_hz=1000, seed=0)
+    batch.load_program(alu_rom())
+    batch.load_program(bytes([0x00, 0xEE]), instances=[1])     # RET with an empty stack
+    batch.run_cycles(10)
+    assert list(batch.faulted) == [False, True]
+    assert 1 in batch.fault_reasons
+    assert batch.get_state(1)["PC"] == CPU.PROGRAM_START_ADDR
+    cpu = make_cpu(alu_rom(), 1000)
+    cpu.run_cycles(10)
+    assert batch.get_state(0) == cpu.get_state()
@@ -0,0 +1,90 @@
+import pytest
+
+from benchmarks.roms import maze_rom, paddle_rom, score_rom
+from chip8.chip8 import Chip8VM
+from chip8.cpu import CPU
+
+WAIT_FOR_KEY = bytes([0xF1, 0x0A,   # 200: LD V1, K
+                      0x12, 0x02])  # 202: JP 202
+
+
+def make_vm(program, **kwargs):
+    vm = Chip8VM.headless(seed=5, **kwargs)
+    vm.load_program(program)
+    return vm
+
+
+def test_run_for_counts_cycles_and_frames():
+    vm = make_vm(paddle_rom())
+    result = vm.run_for(frames=60)
+    assert result.frames == 60
+    assert result.cycles == vm.cpu_freq_hz    # one second of frames
+    assert result.state == vm.cpu.get_state()
+    assert result.framebuffer == vm.screen.get_framebuffer()
+
+    result = vm.run_for(cycles=100)
+    assert result.cycles == 100
+    assert result.frames == 6       # the last one cut short
+    assert vm.cpu.cycles == vm.cpu_freq_hz + 100
+    assert vm.frames_run == 66
+
+
+def test_run_for_stops_at_whichever_limit_comes_first():
+    assert make_vm(score_rom()).run_for(cycles=10000, frames=3).frames == 3
+    assert make_vm(score_rom()).run_for(cycles=20, frames=300).cycles == 20
+
+
+def test_run_for_needs_a_limit():
+    with pytest.raises(ValueError):
+        make_vm(score_rom()).run_for()
+
+
+def test_runs_with_the_same_seed_are_identical():
+    first = make_vm(maze_rom()).run_for(frames=100)
+    second = make_vm(maze_rom()).run_for(frames=100)
+    assert first.state == second.state
+    assert first.framebuffer == second.framebuffer
+    assert any(first.framebuffer)
+
+
+def test_scripted_keys_are_read_each_frame():
+    vm = Chip8VM.headless(script=[(2, 0xB, 1), (4, 0xB, 0)], seed=5)
+    vm.load_program(WAIT_FOR_KEY)
+    vm.run_for(frames=2)
+    assert vm.cpu.waiting_for_key
+    vm.run_for(frames=1)
+    assert not vm.cpu.waiting_for_key
+    assert vm.cpu.V[1] == 0xB
+    assert vm.keyboard.is_pressed(0xB)
+
+
+@pytest.mark.parametrize("rom", [paddle_rom, score_rom])
+def test_restoring_a_snapshot_continues_the_same_run(rom):
+    vm = make_vm(rom())
+    vm.run_for(frames=30)
+    snapshot = bytes(vm.snapshot())
+    assert len(snapshot) == CPU.SNAPSHOT_SIZE
+    expected = vm.run_for(frames=30)
+
+    other = make_vm(rom())
+    other.restore(snapshot)
+    assert bytes(other.snapshot()) == snapshot
+    result = other.run_for(frames=30)
+    assert result.state == expected.state
+    assert result.framebuffer == expected.framebuffer
+
+
+def test_state_files_round_trip(tmp_path):
+    vm = make_vm(score_rom())
+    vm.run_for(frames=20)
+    path = str(tmp_path / "score.c8s")
+    vm.save_state(path)
+
+    other = make_vm(score_rom())
+    other.load_state(path)
+    assert bytes(other.snapshot()) == bytes(vm.snapshot())
+
+
+def test_a_snapshot_of_the_wrong_size_is_refused():
+    with pytest.raises(ValueError):
+        make_vm(score_rom()).restore(bytes(CPU.SNAPSHOT_SIZE - 1))
@@ -0,0 +1,33 @@
+import pytest
+
+from chip8.cpu import CPU
+from chip8.headless import NullScreen
+from chip8.keyboard import Keyboard
+
+DT_POLL = bytes([0x60, 0x05,   # 200: LD V0, 5
+                 0xF0, 0x15,   # 202: LD DT, V0
+                 0xF3, 0x07,   # 204: LD V3, DT
+                 0x33, 0x00,   # 206: SE V3, 0
+                 0x12, 0x04,   # 208: JP 204
+                 0x12, 0x0A])  # 20A: JP 20A
+
+
+def make_cpu(program, clock_hz=600):
+    cpu = CPU(keyboard=Keyboard(), screen=NullScreen(), clock_hz=clock_hz, seed=1)
+    cpu.load_program(program)
+    return cpu
+
+
+def state(cpu):
+    return bytes(cpu.V), cpu.I, cpu.PC, cpu.SP, cpu.DT, cpu.ST, cpu.cycles
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 4, 7, 10, 64])
+def test_chunked_run_cycles_matches_tick_in_a_dt_polling_loop(chunk):
+    ticked = make_cpu(DT_POLL)
+    chunked = make_cpu(DT_POLL)
+    for _ in range(0, 120, chunk):
+        for _ in range(chunk):
+            ticked.tick()
+        chunked.run_cycles(chunk)
+        assert state(chunked) == state(ticked)
@@ -0,0 +1,31 @@
+from chip8.cpu import CPU
+from chip8.decoder import NUM_OPCODES, build_decode_table, decode, get_decode_table
+
+
+def test_the_table_matches_decode_for_every_opcode():
+    table = build_decode_table()
+    assert len(table) == NUM_OPCODES
+    for opcode in range(NUM_OPCODES):
+        assert table[opcode] == decode(opcode)
+
+
+def test_the_table_is_built_once():
+    assert get_decode_table() is get_decode_table()
+
+
+def test_a_few_decodings():
+    assert decode(0x00E0) == ("clear_screen", (), True)
+    assert decode(0x1ABC)[:2] == ("jump", (0xABC,))
+    assert decode(0x8A34)[:2] == ("addr", (0xA, 0x3))
+    assert decode(0xD125)[:2] == ("draw_sprite", (0x1, 0x2, 0x5))
+    assert decode(0xF155)[:2] == ("store_to_mem", (0x1,))
+
+
+def test_dispatch_entries_decode_on_first_use():
+    cpu = CPU()
+    for opcode in (0x6A05, 0x8A34, 0xF155, 0x00EE):
+        name, args, increment_pc = decode(opcode)
+        handler, handler_args, handler_increment_pc = cpu._dispatch_entry(opcode)
+        assert handler.__name__ == name
+        assert handler_args == args
+        assert handler_increment_pc == increment_pc
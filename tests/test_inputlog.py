@@ -0,0 +1,40 @@
+from chip8.chip8 import Chip8VM
+from chip8.inputlog import InputLogReader, KEY_PRESS, KEY_RELEASE, LOG_END
+
+TAP_DURING_WAIT = bytes([0xF1, 0x0A,   # 200: LD V1, K
+                         0x62, 0x01,   # 202: LD V2, 1
+                         0x12, 0x04])  # 204: JP 204
+
+
+def record(path, script, frames=10):
+    vm = Chip8VM.headless(script=script, seed=7)
+    vm.load_program(TAP_DURING_WAIT)
+    vm.start_recording(str(path))
+    vm.run_for(frames=frames)
+    vm.stop_recording()
+    return vm.cpu.get_state()
+
+
+def replay(path):
+    vm = Chip8VM.headless()
+    vm.load_program(TAP_DURING_WAIT)
+    return vm.replay(str(path))
+
+
+def test_replay_ends_in_the_recorded_state(tmp_path):
+    path = tmp_path / "run.c8in"
+    recorded = record(path, [(3, 7, 1), (5, 7, 0), (6, 2, 1)])
+    result = replay(path)
+    assert result.state == recorded
+
+
+def test_a_tap_within_one_frame_is_recorded(tmp_path):
+    path = tmp_path / "tap.c8in"
+    recorded = record(path, [(3, 7, 1), (3, 7, 0)])
+    kinds = [(key, kind) for _, key, kind in InputLogReader(str(path)).events()]
+    assert kinds == [(7, KEY_PRESS), (7, KEY_RELEASE), (0, LOG_END)]
+
+    result = replay(path)
+    assert result.state == recorded
+    assert result.state["V"][1] == 7
+    assert result.state["PC"] == 0x204
@@ -0,0 +1,76 @@
+import collections
+import os
+
+import pytest
+
+pygame = pytest.importorskip("pygame")
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from chip8.chip8 import Chip8VM
+from chip8.headless import NullScreen
+from chip8.io import PyGameKeyboard
+
+WAIT_FOR_KEY = bytes([0xF0, 0x0A,   # 200: LD V0, K
+                      0x12, 0x02])  # 202: JP 202
+
+
+def make_vm():
+    vm = Chip8VM(screen_factory=NullScreen, keyboard_factory=PyGameKeyboard, virtual_clock=True, seed=1)
+    vm.load_program(WAIT_FOR_KEY)
+    return vm
+
+
+def test_run_for_reads_pygame_key_events():
+    vm = make_vm()
+    vm.run_for(frames=2)
+    assert vm.cpu.waiting_for_key
+
+    pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_e))
+    vm.run_for(frames=1)
+    assert not vm.cpu.waiting_for_key
+    assert vm.cpu.V[0] == 0x4
+    assert vm.keyboard.key_pressed[0x4]
+
+    pygame.event.post(pygame.event.Event(pygame.KEYUP, key=pygame.K_e))
+    vm.run_for(frames=1)
+    assert not vm.keyboard.key_pressed[0x4]
+    vm.shutdown()
+
+
+def test_run_for_sees_a_tap_shorter_than_a_frame():
+    vm = make_vm()
+    vm.run_for(frames=1)
+    pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_v))
+    pygame.event.post(pygame.event.Event(pygame.KEYUP, key=pygame.K_v))
+    pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_e))
+    pygame.event.post(pygame.event.Event(pygame.KEYUP, key=pygame.K_e))
+    vm.run_for(frames=1)
+    assert not vm.cpu.waiting_for_key
+    assert vm.cpu.V[0] == 0x0   # lowest key pressed during the wait
+    assert not any(vm.keyboard.key_pressed)
+    vm.shutdown()
+
+
+def hold_key(monkeypatch, key):
+    monkeypatch.setattr(pygame.key, "get_pressed", lambda: collections.defaultdict(int, {key: 1}))
+
+
+def test_events_that_are_not_key_changes_leave_key_polling_on(monkeypatch):
+    keyboard = PyGameKeyboard()
+    keyboard.handle_event(pygame.event.Event(pygame.NOEVENT), 0.)
+    keyboard.handle_event(pygame.event.Event(pygame.MOUSEMOTION, pos=(1, 1), rel=(1, 1), buttons=(0, 0, 0)), 0.)
+    hold_key(monkeypatch, pygame.K_e)
+    keyboard.key_reader()
+    assert keyboard.key_pressed[0x4]
+
+
+def test_a_timed_out_event_wait_leaves_key_polling_on(monkeypatch):
+    vm = make_vm()
+    vm.run_for(frames=1)
+    pygame.event.clear()
+    vm._handle_event(pygame.event.wait(timeout=1), 0.)
+    hold_key(monkeypatch, pygame.K_e)
+    vm.run_for(frames=1)
+    assert not vm.cpu.waiting_for_key
+    assert vm.cpu.V[0] == 0x4
+    vm.shutdown()
@@ -0,0 +1,105 @@
+import pytest
+
+from benchmarks.roms import alu_rom, score_rom
+from chip8.cpu import CPU
+from chip8.headless import NullScreen
+from chip8.jit import INVALIDATION_PAGE_BYTES, JitCPU
+from chip8.keyboard import Keyboard
+
+# a block at 220 that rewrites two of its own instructions with Fx33, then loops back into it
+BCD_PATCH = bytes([0x6C, 0x00,   # 200: LD VC, 0
+                   0x12, 0x20])  # 202: JP 220
+BCD_PATCH += bytes(0x220 - 0x204) + bytes([
+    0x6C, 0x00,     # 220: LD VC, 0      (becomes LD VC, 1)
+    0x7D, 0x01,     # 222: ADD VD, 1     (becomes SYS 203, a no-op)
+    0x3E, 0x01,     # 224: SE VE, 1
+    0x12, 0x30,     # 226: JP 230
+    0x12, 0x20,     # 228: JP 220
+    0x00, 0x00,
+    0x00, 0x00,
+    0x00, 0x00,
+    0x6E, 0x01,     # 230: LD VE, 1
+    0x60, 0x7B,     # 232: LD V0, 123
+    0xA2, 0x21,     # 234: LD I, 221
+    0xF0, 0x33,     # 236: LD B, V0     (writes 1, 2, 3 to 221-223)
+    0x12, 0x20])    # 238: JP 220
+
+# a loop whose ADD is rewritten with Fx55 to add 5 rather than 1
+STORE_PATCH = bytes([
+    0x7D, 0x01,     # 200: ADD VD, 1     (becomes ADD VD, 5)
+    0x3D, 0x03,     # 202: SE VD, 3
+    0x12, 0x00,     # 204: JP 200
+    0x60, 0x7D,     # 206: LD V0, 7D
+    0x61, 0x05,     # 208: LD V1, 5
+    0xA2, 0x00,     # 20A: LD I, 200
+    0xF1, 0x55,     # 20C: LD [I], V1
+    0x12, 0x00])    # 20E: JP 200
+
+
+def make_cpu(cpu_cls, program, clock_hz=1000):
+    cpu = cpu_cls(keyboard=Keyboard(), screen=NullScreen(), clock_hz=clock_hz, seed=1)
+    cpu.load_program(program)
+    return cpu
+
+
+def machine_state(cpu):
+    return cpu.get_state(), bytes(cpu.ram), cpu.screen.get_framebuffer()
+
+
+def run_both(cpu, jit, chunk, cycles):
+    for _ in range(0, cycles, chunk):
+        cpu.run_cycles(chunk)
+        jit.run_cycles(chunk)
+        assert machine_state(jit) == machine_state(cpu)
+
+
+@pytest.mark.parametrize("program", [BCD_PATCH, STORE_PATCH], ids=["bcd", "store"])
+@pytest.mark.parametrize("chunk", [1, 5, 100])
+def test_writes_into_a_cached_block_are_seen(program, chunk):
+    cpu = make_cpu(CPU, program)
+    jit = make_cpu(JitCPU, program)
+    run_both(cpu, jit, chunk, 400)
+
+
+@pytest.mark.parametrize("rom", [alu_rom, score_rom])
+@pytest.mark.parametrize("chunk", [1, 3, 7, 11])
+def test_budgets_that_end_inside_a_block(rom, chunk):
+    cpu = make_cpu(CPU, rom())
+    jit = make_cpu(JitCPU, rom())
+    run_both(cpu, jit, chunk, 700)
+    assert jit._prefix_blocks
+
+
+def test_restore_drops_only_the_blocks_of_changed_pages():
+    # 200: ADD VD, 1 / JP 200 and 240: ADD VE, 1 / JP 240, in different pages
+    program = bytes([0x7D, 0x01, 0x12, 0x00]) + bytes(0x3C) + bytes([0x7E, 0x01, 0x12, 0x40])
+    changed = bytearray(program)
+    changed[0x240 - 0x200:0x242 - 0x200] = bytes([0x7E, 0x02])  # 240: ADD VE, 2 rather than 1
+    reference = make_cpu(CPU, bytes(changed))
+    reference.PC = 0x240
+    snapshot = bytes(reference.snapshot())
+
+    jit = make_cpu(JitCPU, program)
+    jit.run_cycles(50)
+    jit.PC = 0x240
+    jit.run_cycles(2)
+    kept = jit._blocks[0x200]
+    assert 0x240 in jit._blocks
+    assert 0x200 // INVALIDATION_PAGE_BYTES != 0x240 // INVALIDATION_PAGE_BYTES
+
+    jit.restore(snapshot)
+    assert jit._blocks.get(0x200) is kept
+    assert 0x240 not in jit._blocks
+    run_both(reference, jit, 10, 100)
+
+
+def test_load_program_replaces_cached_blocks():
+    jit = make_cpu(JitCPU, STORE_PATCH)
+    jit.run_cycles(100)
+    jit.load_program(alu_rom())
+    jit.PC = CPU.PROGRAM_START_ADDR
+    cpu = make_cpu(CPU, STORE_PATCH)
+    cpu.run_cycles(100)
+    cpu.load_program(alu_rom())
+    cpu.PC = CPU.PROGRAM_START_ADDR
+    run_both(cpu, jit, 7, 300)
@@ -0,0 +1,62 @@
+import pytest
+
+from benchmarks.roms import paddle_rom, score_rom
+from chip8.chip8 import Chip8VM
+from chip8.cpu import CPU
+from chip8.jit import JitCPU
+from chip8.library import RomLibrary
+
+
+@pytest.fixture
+def rom_dir(tmp_path):
+    directory = tmp_path / "roms"
+    directory.mkdir()
+    (directory / "PADDLE").write_bytes(paddle_rom())
+    (directory / "SCORE").write_bytes(score_rom())
+    return directory
+
+
+def run(library, rom, cpu_cls=JitCPU):
+    vm = Chip8VM.headless(cpu_cls=cpu_cls, seed=1)
+    library.load(vm, rom)
+    return vm, vm.run_for(frames=30)
+
+
+def test_a_second_launch_imports_the_compiled_blocks(rom_dir, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    vm, first = run(RomLibrary(str(rom_dir), cache_dir=str(cache_dir)), "PADDLE")
+    compiled = set(vm.cpu._blocks)
+
+    def compile_block(start, source, length):
+        raise AssertionError("block 0x{:03X} compiled again".format(start))
+
+    # a new library (as in another process) with the same cache needs to compile nothing that ran before
+    monkeypatch.setattr(JitCPU, "_compile", staticmethod(compile_block))
+    library = RomLibrary(str(rom_dir), cache_dir=str(cache_dir))
+    vm = Chip8VM.headless(cpu_cls=JitCPU, seed=1)
+    library.load(vm, "PADDLE")
+    assert set(vm.cpu._blocks) >= compiled & set(library.analysis("PADDLE").blocks)
+    monkeypatch.undo()
+
+    second = vm.run_for(frames=30)
+    assert second.state == first.state
+    assert second.framebuffer == first.framebuffer
+
+
+@pytest.mark.parametrize("rom", ["PADDLE", "SCORE"])
+def test_imported_blocks_run_like_the_interpreter(rom_dir, tmp_path, rom):
+    cache_dir = str(tmp_path / "cache")
+    run(RomLibrary(str(rom_dir), cache_dir=cache_dir), rom)
+    _, jit = run(RomLibrary(str(rom_dir), cache_dir=cache_dir), rom)
+    _, interpreted = run(RomLibrary(str(rom_dir)), rom, cpu_cls=CPU)
+    assert jit.state == interpreted.state
+    assert jit.framebuffer == interpreted.framebuffer
+
+
+def test_analysis_is_cached_by_rom_hash(rom_dir, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    library = RomLibrary(str(rom_dir), cache_dir=cache_dir)
+    entry = library.find("SCORE")
+    analysis = library.analysis("SCORE")
+    again = RomLibrary(str(rom_dir), cache_dir=cache_dir).analysis(entry.rom_hash)
+    assert again.to_dict() == analysis.to_dict()
@@ -0,0 +1,66 @@
+import pytest
+
+from benchmarks.roms import maze_rom, paddle_rom
+from chip8.chip8 import Chip8VM
+from chip8.rewind import RewindBuffer
+
+
+def record_frames(vm, frames):
+    snapshots = []
+    for _ in range(frames):
+        vm.run_for(frames=1)
+        vm.rewind.frame(vm)
+        snapshots.append(bytes(vm.snapshot()))
+    return snapshots
+
+
+@pytest.mark.parametrize("rom", [maze_rom, paddle_rom])
+def test_step_back_returns_each_recorded_snapshot(rom):
+    vm = Chip8VM.headless(seed=3)
+    vm.load_program(rom())
+    vm.enable_rewind()
+    snapshots = record_frames(vm, 50)
+    for expected in reversed(snapshots[:-1]):
+        assert vm.rewind_step()
+        assert bytes(vm.snapshot()) == expected
+    assert not vm.rewind_step()
+
+
+def test_running_on_after_a_rewind_matches_the_original_run():
+    vm = Chip8VM.headless(seed=3)
+    vm.load_program(paddle_rom())
+    vm.enable_rewind()
+    snapshots = record_frames(vm, 20)
+    for _ in range(10):
+        vm.rewind_step()
+    assert bytes(vm.snapshot()) == snapshots[9]
+    vm.run_for(frames=1)
+    assert bytes(vm.snapshot()) == snapshots[10]
+
+
+def test_a_full_ring_drops_the_oldest_history():
+    vm = Chip8VM.headless(seed=3)
+    vm.load_program(maze_rom())
+    vm.enable_rewind(history_bytes=2048)
+    snapshots = record_frames(vm, 200)
+    kept = len(vm.rewind)
+    assert 0 < kept < 199
+    assert vm.rewind.memory_bytes() <= len(snapshots[0]) + 2048
+    for steps in range(1, kept + 1):
+        assert vm.rewind_step()
+        assert bytes(vm.snapshot()) == snapshots[-1 - steps]
+    assert not vm.rewind_step()
+
+
+def test_capacity_limits_the_steps_kept():
+    vm = Chip8VM.headless(seed=3)
+    vm.load_program(maze_rom())
+    vm.enable_rewind(capacity=5)
+    record_frames(vm, 20)
+    assert len(vm.rewind) == 5
+
+
+@pytest.mark.parametrize("kwargs", [{"capacity": 0}, {"page_bytes": 0}, {"page_bytes": 256}])
+def test_settings_that_cannot_work_are_refused(kwargs):
+    with pytest.raises(ValueError):
+        RewindBuffer(**kwargs)
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from benchmarks.roms import maze_rom
+from chip8.chip8 import Chip8VM
+from chip8.stream import (DELTA, KEYFRAME, STREAM_HEADER, FrameDecoder, FrameEncoder, FrameStreamServer,
+                          receive_frames, rle_decode, rle_encode, send_keys)
+
+
+def maze_screens(frames):
+    vm = Chip8VM.headless(seed=2)
+    vm.load_program(maze_rom())
+    screens = []
+    for _ in range(frames):
+        vm.run_for(frames=1)
+        screens.append(vm.screen.get_packed())
+    return screens
+
+
+@pytest.mark.parametrize("data", [b"", b"\0", b"\1\2\3", bytes(1000), b"\0\0\7" * 100 + bytes(300)])
+def test_run_length_encoding_round_trips(data):
+    assert rle_decode(rle_encode(data)) == data
+
+
+def test_run_length_encoded_data_cut_part_way_through_a_run_is_refused():
+    with pytest.raises(ValueError):
+        rle_decode(rle_encode(bytes(10))[:-1])
+
+
+def test_decoding_the_stream_rebuilds_every_screen():
+    encoder = FrameEncoder(keyframe_interval=5)
+    decoder = FrameDecoder()
+    kinds = []
+    screen = None
+    for frame, packed in enumerate(maze_screens(80)):
+        message = encoder.encode(frame, packed)
+        if message is None:
+            assert packed == screen     # only unchanged screens are left out
+            continue
+        kind, number, length = STREAM_HEADER.unpack_from(message)
+        assert number == frame
+        assert length == len(message) - STREAM_HEADER.size
+        kinds.append(kind)
+        screen = decoder.decode(kind, message[STREAM_HEADER.size:])
+        assert screen == packed
+    assert kinds[0] == KEYFRAME
+    assert kinds[1:5] == [DELTA] * 4 and kinds[5] == KEYFRAME
+
+
+def test_a_delta_before_any_keyframe_is_refused():
+    with pytest.raises(ValueError):
+        FrameDecoder().decode(DELTA, bytes(4))
+
+
+def test_a_client_sees_the_vm_screen_and_drives_its_keys(tmp_path):
+    path = str(tmp_path / "chip8.sock")
+
+    async def session():
+        vm = Chip8VM.headless(seed=2)
+        vm.load_program(maze_rom())
+        server = FrameStreamServer(vm)
+        await server.start_unix(path)
+        reader, writer = await asyncio.open_unix_connection(path)
+        await send_keys(writer, [k == 0x5 for k in range(16)])
+        screens = []
+
+        async def client():
+            async for frame, packed in receive_frames(reader):
+                screens.append(packed)
+
+        receiving = asyncio.ensure_future(client())
+        await vm.run_async(frames=20)
+        await asyncio.sleep(0.05)
+        held = vm.keyboard.is_pressed(0x5)
+        await server.close()
+        await receiving
+        writer.close()
+        return vm, screens, held
+
+    vm, screens, held = asyncio.run(session())
+    assert len(screens) > 1
+    assert screens[-1] == vm.screen.get_packed()
+    assert held
+    assert not vm.keyboard.is_pressed(0x5)     # released when the client went away